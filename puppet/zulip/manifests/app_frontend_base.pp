@@ -23,12 +23,16 @@ class zulip::app_frontend_base {
     source => "puppet:///modules/zulip/nginx/zulip-include-frontend/app",
     notify => Service["nginx"],
   }
+  # The number of Tornado processes to shard event queues across; see
+  # TORNADO_PROCESSES in zproject/settings.py, which reads the same
+  # setting.
+  $tornado_processes = zulipconf("application_server", "tornado_processes", 1)
   file { "/etc/nginx/zulip-include/upstreams":
     require => Package["nginx-full"],
     owner  => "root",
     group  => "root",
     mode => 644,
-    source => "puppet:///modules/zulip/nginx/zulip-include-frontend/upstreams",
+    content => template("zulip/nginx/upstreams.template.erb"),
     notify => Service["nginx"],
   }
   file { "/etc/nginx/zulip-include/uploads.types":
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+import configparser
 import datetime
 import errno
 import hashlib
@@ -15,7 +16,7 @@ import json
 import uuid
 
 if False:
-    from typing import Sequence, Set, Text, Any
+    from typing import Any, List, Sequence, Set, Text
 
 DEPLOYMENTS_DIR = "/home/zulip/deployments"
 LOCK_DIR = os.path.join(DEPLOYMENTS_DIR, "lock")
@@ -83,6 +84,18 @@ def subprocess_text_output(args):
     # type: (Sequence[str]) -> str
     return subprocess.check_output(args, universal_newlines=True).strip()
 
+def get_tornado_programs():
+    # type: () -> List[str]
+    """The supervisord programs for the Tornado shards; see
+    tornado_processes in the supervisord config template."""
+    config_file = configparser.RawConfigParser()
+    config_file.read("/etc/zulip/zulip.conf")
+    tornado_processes = 1
+    if config_file.has_option('application_server', 'tornado_processes'):
+        tornado_processes = config_file.getint('application_server', 'tornado_processes')
+    return ["zulip-tornado"] + ["zulip-tornado-%d" % (shard,)
+                                for shard in range(1, tornado_processes)]
+
 def su_to_zulip():
     # type: () -> None
     pwent = pwd.getpwnam("zulip")
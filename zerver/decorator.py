@@ -129,6 +129,14 @@ def require_realm_admin(func: ViewFuncT) -> ViewFuncT:
         return func(request, user_profile, *args, **kwargs)
     return wrapper  # type: ignore # https://github.com/python/mypy/issues/1927
 
+def require_server_admin_api(func: ViewFuncT) -> ViewFuncT:
+    @wraps(func)
+    def wrapper(request: HttpRequest, user_profile: UserProfile, *args: Any, **kwargs: Any) -> HttpResponse:
+        if not user_profile.is_staff:
+            raise JsonableError(_("Must be a server administrator"))
+        return func(request, user_profile, *args, **kwargs)
+    return wrapper  # type: ignore # https://github.com/python/mypy/issues/1927
+
 from zerver.lib.user_agent import parse_user_agent
 
 def get_client_name(request: HttpRequest, is_browser_view: bool) -> Text:
@@ -626,13 +634,16 @@ def statsd_increment(counter: Text, val: int=1,
         return wrapped_func
     return wrapper
 
-def rate_limit_user(request: HttpRequest, user: UserProfile, domain: Text) -> None:
+def rate_limit_user(request: HttpRequest, user: UserProfile, domain: Text, calls: int=1) -> None:
     """Returns whether or not a user was rate limited. Will raise a RateLimited exception
     if the user has been rate limited, otherwise returns and modifies request to contain
-    the rate limit information"""
+    the rate limit information.  Requests that do the work of several API calls can
+    charge for them with `calls`."""
 
     entity = RateLimitedUser(user, domain=domain)
     ratelimited, time = is_ratelimited(entity)
+    if not ratelimited and calls > 1:
+        ratelimited = api_calls_left(entity)[0] < calls
     request._ratelimit_applied_limits = True
     request._ratelimit_secs_to_freedom = time
     request._ratelimit_over_limit = ratelimited
@@ -641,7 +652,7 @@ def rate_limit_user(request: HttpRequest, user: UserProfile, domain: Text) -> No
         statsd.incr("ratelimiter.limited.%s.%s" % (type(user), user.id))
         raise RateLimited()
 
-    incr_ratelimit(entity)
+    incr_ratelimit(entity, calls)
     calls_remaining, time_reset = api_calls_left(entity)
 
     request._ratelimit_remaining = calls_remaining
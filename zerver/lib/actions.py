@@ -1,5 +1,5 @@
 from typing import (
-    AbstractSet, Any, AnyStr, Callable, Dict, Iterable, List, Mapping, MutableMapping,
+    AbstractSet, Any, AnyStr, Callable, Dict, FrozenSet, Iterable, List, Mapping, MutableMapping,
     Optional, Sequence, Set, Text, Tuple, TypeVar, Union, cast
 )
 from mypy_extensions import TypedDict
@@ -22,7 +22,9 @@ from zerver.lib.addressee import (
     user_profiles_from_unvalidated_emails,
 )
 from zerver.lib.cache import (
+    delete_stream_recipient_info_cache,
     delete_user_profile_caches,
+    flush_realm_mention_data,
     to_dict_cache_key_id,
 )
 from zerver.lib.context_managers import lockfile
@@ -36,11 +38,13 @@ from zerver.lib.message import (
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.retention import move_message_to_archive
 from zerver.lib.send_email import send_email, FromAddress
+from zerver.lib.spans import span
 from zerver.lib.stream_subscription import (
     get_active_subscriptions_for_stream_id,
     get_active_subscriptions_for_stream_ids,
     get_bulk_stream_subscriber_info,
     get_stream_subscriptions_for_user,
+    get_stream_recipient_info,
     get_stream_subscriptions_for_users,
     num_subscribers_for_stream_id,
 )
@@ -55,7 +59,7 @@ from zerver.lib.user_groups import create_user_group, access_user_group_by_id
 from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity, \
     RealmDomain, \
     Subscription, Recipient, Message, Attachment, UserMessage, RealmAuditLog, \
-    UserHotspot, ScheduledMessage, \
+    UserHotspot, ScheduledMessage, PendingMessageFanout, \
     Client, DefaultStream, DefaultStreamGroup, UserPresence, PushDeviceToken, \
     ScheduledEmail, MAX_SUBJECT_LENGTH, \
     MAX_MESSAGE_LENGTH, get_client, get_stream, get_personal_recipient, get_huddle, \
@@ -88,6 +92,7 @@ from django.utils.timezone import now as timezone_now
 from confirmation.models import Confirmation, create_confirmation_link
 from confirmation import settings as confirmation_settings
 from six import unichr
+from bitfield.types import Bit
 
 from zerver.lib.bulk_create import bulk_create_users
 from zerver.lib.create_user import random_api_key
@@ -111,9 +116,10 @@ from zerver.lib.sessions import delete_user_sessions
 from zerver.lib.upload import attachment_url_re, attachment_url_to_path_id, \
     claim_attachment, delete_message_image
 from zerver.lib.str_utils import NonBinaryStr, force_str
-from zerver.tornado.event_queue import request_event_queue, send_event
+from zerver.tornado.event_queue import batch_events, request_event_queue, send_event
 
 import DNS
+import io
 import ujson
 import time
 import traceback
@@ -130,6 +136,10 @@ from operator import itemgetter
 # works on both str and unicode in python 2 but in python 3 it only works on str.
 SizedTextIterable = Union[Sequence[Text], AbstractSet[Text]]
 
+# With at least this many rows, bulk_insert_ums streams the rows to postgres
+# with COPY rather than building one enormous INSERT statement.
+BULK_INSERT_UMS_COPY_THRESHOLD = 1000
+
 STREAM_ASSIGNMENT_COLORS = [
     "#76ce90", "#fae589", "#a6c7e5", "#e79ab5",
     "#bfd56f", "#f4ae55", "#b0a5fd", "#addfe5",
@@ -659,6 +669,7 @@ def do_deactivate_stream(stream: Stream, log: bool=True) -> None:
     affected_user_ids = can_access_stream_user_ids(stream)
 
     get_active_subscriptions_for_stream_id(stream.id).update(active=False)
+    delete_stream_recipient_info_cache([stream.id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -847,6 +858,9 @@ def get_recipient_info(recipient: Recipient,
         assert(stream_topic is not None)
 
     stream_push_user_ids = set()  # type: Set[int]
+    # For stream messages, these are the (cached) UserProfile rows
+    # for the stream's active subscribers.
+    cached_rows = []  # type: List[Dict[str, Any]]
 
     if recipient.type == Recipient.PERSONAL:
         # The sender and recipient may be the same id, so
@@ -855,11 +869,9 @@ def get_recipient_info(recipient: Recipient,
         assert(len(message_to_user_ids) in [1, 2])
 
     elif recipient.type == Recipient.STREAM:
-        subscription_rows = stream_topic.get_active_subscriptions().values(
-            'user_profile_id',
-            'push_notifications',
-            'in_home_view',
-        ).order_by('user_profile_id')
+        stream_recipient_info = get_stream_recipient_info(stream_topic.stream_id)
+        subscription_rows = stream_recipient_info['subscription_rows']
+        cached_rows = stream_recipient_info['user_rows']
 
         message_to_user_ids = [
             row['user_profile_id']
@@ -891,7 +903,11 @@ def get_recipient_info(recipient: Recipient,
         # for our data structures not related to bots
         user_ids |= possibly_mentioned_user_ids
 
-    if user_ids:
+    # We only need to query for the users we don't already have
+    # cached rows for, which for stream messages is usually nobody.
+    uncached_user_ids = user_ids - {row['id'] for row in cached_rows}
+
+    if uncached_user_ids:
         query = UserProfile.objects.filter(
             is_active=True,
         ).values(
@@ -906,10 +922,12 @@ def get_recipient_info(recipient: Recipient,
         # need this codepath to be fast (it's part of sending messages)
         query = query_for_ids(
             query=query,
-            user_ids=sorted(list(user_ids)),
+            user_ids=sorted(list(uncached_user_ids)),
             field='id'
         )
-        rows = list(query)
+        rows = cached_rows + list(query)
+    elif user_ids:
+        rows = cached_rows
     else:
         # TODO: We should always have at least one user_id as a recipient
         #       of any message we send.  Right now the exception to this
@@ -1055,7 +1073,26 @@ def do_schedule_messages(messages: Sequence[Optional[MutableMapping[str, Any]]])
 
 
 def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str, Any]]],
-                     email_gateway: Optional[bool]=False) -> List[int]:
+                     email_gateway: Optional[bool]=False,
+                     defer_fanout: bool=False) -> List[int]:
+    '''
+    With defer_fanout, we return as soon as the Message rows (and the
+    sender's UserMessage rows) are committed, and leave creating the
+    other UserMessage rows and delivering the events to the
+    message_fanout queue worker; see do_fan_out_message.  That keeps
+    the latency of sending to a huge stream independent of its size.
+
+    That queue is processed in order, by a single worker.  While a
+    sender has deferred messages to a recipient (a stream, or the
+    participants of a private conversation) that haven't been fanned
+    out yet, their later messages to it are deferred too; see
+    get_pending_deferred_fanouts.  So every user receives a sender's
+    messages to a given stream or private conversation in the order
+    they were sent.  That is the only ordering guarantee: messages
+    from different senders, or from one sender to different
+    recipients, can be delivered out of ID order while some of them
+    are deferred.
+    '''
     # Filter out messages which didn't pass internal_prep_message properly
     messages = [message for message in messages_maybe_none if message is not None]
 
@@ -1079,47 +1116,64 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         message['sender_queue_id'] = message.get('sender_queue_id', None)
         message['realm'] = message.get('realm', message['message'].sender.realm)
 
-        mention_data = bugdown.MentionData(
-            realm_id=message['realm'].id,
-            content=message['message'].content,
-        )
-        message['mention_data'] = mention_data
-
-        if message['message'].is_stream_message():
-            stream_id = message['message'].recipient.type_id
-            stream_topic = StreamTopicTarget(
-                stream_id=stream_id,
-                topic_name=message['message'].topic_name()
+        with span('mention_data'):
+            message['mention_data'] = bugdown.MentionData(
+                realm_id=message['realm'].id,
+                content=message['message'].content,
             )
-        else:
-            stream_topic = None
-
-        info = get_recipient_info(
-            recipient=message['message'].recipient,
-            sender_id=message['message'].sender_id,
-            stream_topic=stream_topic,
-            possibly_mentioned_user_ids=mention_data.get_user_ids(),
-        )
 
-        message['active_user_ids'] = info['active_user_ids']
-        message['push_notify_user_ids'] = info['push_notify_user_ids']
-        message['stream_push_user_ids'] = info['stream_push_user_ids']
-        message['um_eligible_user_ids'] = info['um_eligible_user_ids']
-        message['long_term_idle_user_ids'] = info['long_term_idle_user_ids']
-        message['default_bot_user_ids'] = info['default_bot_user_ids']
+    # Mirror bots and importers often send many messages to the same
+    # conversation at once, so we only compute recipient info once per
+    # distinct (recipient, sender, topic, possible mentions).
+    recipient_info_by_key = {}  # type: Dict[Tuple[int, int, Text, FrozenSet[int]], RecipientInfoResult]
+    for message in messages:
+        possibly_mentioned_user_ids = message['mention_data'].get_user_ids()
+        key = (message['message'].recipient.id,
+               message['message'].sender_id,
+               message['message'].topic_name().lower(),
+               frozenset(possibly_mentioned_user_ids))
+        if key not in recipient_info_by_key:
+            if message['message'].is_stream_message():
+                stream_id = message['message'].recipient.type_id
+                stream_topic = StreamTopicTarget(
+                    stream_id=stream_id,
+                    topic_name=message['message'].topic_name()
+                )  # type: Optional[StreamTopicTarget]
+            else:
+                stream_topic = None
+
+            with span('recipient_info'):
+                recipient_info_by_key[key] = get_recipient_info(
+                    recipient=message['message'].recipient,
+                    sender_id=message['message'].sender_id,
+                    stream_topic=stream_topic,
+                    possibly_mentioned_user_ids=possibly_mentioned_user_ids,
+                )
+        info = recipient_info_by_key[key]
+
+        # We modify some of these sets below, so each message gets
+        # its own copies.
+        message['active_user_ids'] = set(info['active_user_ids'])
+        message['push_notify_user_ids'] = set(info['push_notify_user_ids'])
+        message['stream_push_user_ids'] = set(info['stream_push_user_ids'])
+        message['um_eligible_user_ids'] = set(info['um_eligible_user_ids'])
+        message['long_term_idle_user_ids'] = set(info['long_term_idle_user_ids'])
+        message['default_bot_user_ids'] = set(info['default_bot_user_ids'])
         message['service_bot_tuples'] = info['service_bot_tuples']
 
+    for message in messages:
         # Render our messages.
         assert message['message'].rendered_content is None
 
-        rendered_content = render_incoming_message(
-            message['message'],
-            message['message'].content,
-            message['active_user_ids'],
-            message['realm'],
-            mention_data=message['mention_data'],
-            email_gateway=email_gateway,
-        )
+        with span('render'):
+            rendered_content = render_incoming_message(
+                message['message'],
+                message['message'].content,
+                message['active_user_ids'],
+                message['realm'],
+                mention_data=message['mention_data'],
+                email_gateway=email_gateway,
+            )
         message['message'].rendered_content = rendered_content
         message['message'].rendered_content_version = bugdown_version
         links_for_embed |= message['message'].links_for_preview
@@ -1144,138 +1198,300 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         # Update calculated fields of the message
         message['message'].update_calculated_fields()
 
+    pending_fanouts = get_pending_deferred_fanouts(messages) if messages else set()
+    deferred_messages = []  # type: List[MutableMapping[str, Any]]
+    immediate_messages = []  # type: List[MutableMapping[str, Any]]
+    for message in messages:
+        conversation = (message['message'].sender_id, message['message'].recipient_id)
+        if defer_fanout or conversation in pending_fanouts:
+            deferred_messages.append(message)
+            pending_fanouts.add(conversation)
+        else:
+            immediate_messages.append(message)
+
     # Save the message receipts in the database
-    user_message_flags = defaultdict(dict)  # type: Dict[int, Dict[int, List[str]]]
     with transaction.atomic():
-        Message.objects.bulk_create([message['message'] for message in messages])
-        ums = []  # type: List[UserMessageLite]
-        for message in messages:
-            # Service bots (outgoing webhook bots and embedded bots) don't store UserMessage rows;
-            # they will be processed later.
-            mentioned_user_ids = message['message'].mentions_user_ids
-            user_messages = create_user_messages(
-                message=message['message'],
-                um_eligible_user_ids=message['um_eligible_user_ids'],
-                long_term_idle_user_ids=message['long_term_idle_user_ids'],
-                mentioned_user_ids=mentioned_user_ids,
-            )
-
-            for um in user_messages:
-                user_message_flags[message['message'].id][um.user_profile_id] = um.flags_list()
-
-            ums.extend(user_messages)
-
-            message['message'].service_queue_events = get_service_bot_events(
-                sender=message['message'].sender,
-                service_bot_tuples=message['service_bot_tuples'],
-                mentioned_user_ids=mentioned_user_ids,
-                active_user_ids=message['active_user_ids'],
-                recipient_type=message['message'].recipient.type,
-            )
-
-        bulk_insert_ums(ums)
+        with span('message_save'):
+            Message.objects.bulk_create([message['message'] for message in messages])
+            PendingMessageFanout.objects.bulk_create([
+                PendingMessageFanout(message=message['message'])
+                for message in deferred_messages])
+        with span('usermessage_insert'):
+            user_message_flags = create_sent_user_messages(immediate_messages)
+            # The sender's own UserMessage rows can't wait for the
+            # worker, or the message would be missing from their
+            # narrows, and updating its flags would fail.
+            create_sent_user_messages(deferred_messages, sender_only=True)
 
         # Claim attachments in message
         for message in messages:
             if Message.content_has_attachment(message['message'].content):
                 do_claim_attachments(message['message'])
 
+    for message in deferred_messages:
+        with span('queue_publish'):
+            queue_json_publish('message_fanout',
+                               get_message_fanout_event(message, links_for_embed))
+    if immediate_messages:
+        deliver_sent_messages(immediate_messages, user_message_flags, links_for_embed)
+
+    # Note that this does not preserve the order of message ids
+    # returned.  In practice, this shouldn't matter, as we only
+    # mirror single zephyr messages at a time and don't otherwise
+    # intermingle sending zephyr messages with other messages.
+    return already_sent_ids + [message['message'].id for message in messages]
+
+def create_sent_user_messages(messages: Sequence[MutableMapping[str, Any]],
+                              sender_only: bool=False,
+                              skip_sender: bool=False) -> Dict[int, Dict[int, List[str]]]:
+    '''
+    Creates the UserMessage rows for a batch of newly saved messages,
+    returning their flags by message ID and then user ID.  For
+    defer_fanout, the sender's rows are created first with
+    sender_only, and the others later with skip_sender.
+    '''
+    user_message_flags = defaultdict(dict)  # type: Dict[int, Dict[int, List[str]]]
+    ums = []  # type: List[UserMessageLite]
     for message in messages:
-        # Deliver events to the real-time push system, as well as
-        # enqueuing any additional processing triggered by the message.
-        wide_message_dict = MessageDict.wide_dict(message['message'])
-
-        user_flags = user_message_flags.get(message['message'].id, {})
-        sender = message['message'].sender
-        message_type = wide_message_dict['type']
-
-        presence_idle_user_ids = get_active_presence_idle_user_ids(
-            realm=sender.realm,
-            sender_id=sender.id,
-            message_type=message_type,
-            active_user_ids=message['active_user_ids'],
-            user_flags=user_flags,
+        sender_id = message['message'].sender_id
+        um_eligible_user_ids = message['um_eligible_user_ids']
+        if sender_only:
+            um_eligible_user_ids = um_eligible_user_ids & {sender_id}
+
+        # Service bots (outgoing webhook bots and embedded bots) don't store UserMessage rows;
+        # they will be processed later.
+        mentioned_user_ids = message['message'].mentions_user_ids
+        user_messages = create_user_messages(
+            message=message['message'],
+            um_eligible_user_ids=um_eligible_user_ids,
+            long_term_idle_user_ids=message['long_term_idle_user_ids'],
+            mentioned_user_ids=mentioned_user_ids,
         )
+        if sender_only:
+            ums.extend(user_messages)
+            continue
 
-        event = dict(
-            type='message',
-            message=message['message'].id,
-            message_dict=wide_message_dict,
-            presence_idle_user_ids=presence_idle_user_ids,
+        # Most users share the same flags, so only convert each
+        # distinct flags value to a list once.
+        flags_lists = {}  # type: Dict[int, List[str]]
+        for um in user_messages:
+            if um.flags not in flags_lists:
+                flags_lists[um.flags] = um.flags_list()
+            user_message_flags[message['message'].id][um.user_profile_id] = flags_lists[um.flags]
+
+        if skip_sender:
+            ums.extend(um for um in user_messages if um.user_profile_id != sender_id)
+        else:
+            ums.extend(user_messages)
+
+        message['message'].service_queue_events = get_service_bot_events(
+            sender=message['message'].sender,
+            service_bot_tuples=message['service_bot_tuples'],
+            mentioned_user_ids=mentioned_user_ids,
+            active_user_ids=message['active_user_ids'],
+            recipient_type=message['message'].recipient.type,
         )
 
-        '''
-        TODO:  We may want to limit user_ids to only those users who have
-               UserMessage rows, if only for minor performance reasons.
+    bulk_insert_ums(ums)
+    return user_message_flags
+
+def deliver_sent_messages(messages: Sequence[MutableMapping[str, Any]],
+                          user_message_flags: Dict[int, Dict[int, List[str]]],
+                          links_for_embed: Set[Text]) -> None:
+    # Fetch any streams our callers didn't provide in a single query.
+    stream_ids_to_fetch = {
+        message['message'].recipient.type_id
+        for message in messages
+        if message['message'].is_stream_message() and message['stream'] is None
+    }
+    if stream_ids_to_fetch:
+        streams_by_id = {
+            stream.id: stream
+            for stream in Stream.objects.select_related("realm").filter(id__in=stream_ids_to_fetch)
+        }
+        for message in messages:
+            if message['message'].is_stream_message() and message['stream'] is None:
+                message['stream'] = streams_by_id[message['message'].recipient.type_id]
 
-               For now we queue events for all subscribers/sendees of the
-               message, since downstream code may still do notifications
-               that don't require UserMessage rows.
+    # Publish the events for all of the messages to Tornado together.
+    with batch_events():
+        for message in messages:
+            deliver_sent_message(message, user_message_flags, links_for_embed)
 
-               Our automated tests have gotten better on this codepath,
-               but we may have coverage gaps, so we should be careful
-               about changing the next line.
-        '''
-        user_ids = message['active_user_ids'] | set(user_flags.keys())
-
-        users = [
-            dict(
-                id=user_id,
-                flags=user_flags.get(user_id, []),
-                always_push_notify=(user_id in message['push_notify_user_ids']),
-                stream_push_notify=(user_id in message['stream_push_user_ids']),
-            )
-            for user_id in user_ids
-        ]
+def get_message_fanout_event(message: MutableMapping[str, Any],
+                             links_for_embed: Set[Text]) -> Dict[str, Any]:
+    '''
+    Everything do_fan_out_message needs from the message-sending
+    pipeline, in a form we can put on a queue.
+    '''
+    return dict(
+        message_id=message['message'].id,
+        local_id=message['local_id'],
+        sender_queue_id=message['sender_queue_id'],
+        active_user_ids=list(message['active_user_ids']),
+        push_notify_user_ids=list(message['push_notify_user_ids']),
+        stream_push_user_ids=list(message['stream_push_user_ids']),
+        um_eligible_user_ids=list(message['um_eligible_user_ids']),
+        long_term_idle_user_ids=list(message['long_term_idle_user_ids']),
+        service_bot_tuples=message['service_bot_tuples'],
+        mentions_user_ids=list(message['message'].mentions_user_ids),
+        mentions_wildcard=message['message'].mentions_wildcard,
+        user_ids_with_alert_words=list(message['message'].user_ids_with_alert_words),
+        links_for_embed=list(links_for_embed),
+    )
 
-        if message['message'].is_stream_message():
-            # Note: This is where authorization for single-stream
-            # get_updates happens! We only attach stream data to the
-            # notify new_message request if it's a public stream,
-            # ensuring that in the tornado server, non-public stream
-            # messages are only associated to their subscribed users.
-            if message['stream'] is None:
-                stream_id = message['message'].recipient.type_id
-                message['stream'] = Stream.objects.select_related("realm").get(id=stream_id)
-            assert message['stream'] is not None  # assert needed because stubs for django are missing
-            if message['stream'].is_public():
-                event['realm_id'] = message['stream'].realm_id
-                event['stream_name'] = message['stream'].name
-            if message['stream'].invite_only:
-                event['invite_only'] = True
-        if message['local_id'] is not None:
-            event['local_id'] = message['local_id']
-        if message['sender_queue_id'] is not None:
-            event['sender_queue_id'] = message['sender_queue_id']
-        send_event(event, users)
-
-        if url_embed_preview_enabled_for_realm(message['message']) and links_for_embed:
-            event_data = {
-                'message_id': message['message'].id,
-                'message_content': message['message'].content,
-                'message_realm_id': message['realm'].id,
-                'urls': links_for_embed}
+def do_fan_out_message(event: Mapping[str, Any]) -> None:
+    '''
+    The second half of do_send_messages with defer_fanout: creates the
+    UserMessage rows for an already-saved message and delivers it.
+    '''
+    message = Message.objects.select_related(
+        'sender', 'sender__realm', 'recipient', 'sending_client').get(id=event['message_id'])
+
+    # These are normally set on the Message while rendering it.
+    message.mentions_user_ids = set(event['mentions_user_ids'])
+    message.mentions_wildcard = event['mentions_wildcard']
+    message.user_ids_with_alert_words = set(event['user_ids_with_alert_words'])
+
+    message_dict = dict(
+        message=message,
+        realm=message.sender.realm,
+        stream=None,
+        local_id=event['local_id'],
+        sender_queue_id=event['sender_queue_id'],
+        active_user_ids=set(event['active_user_ids']),
+        push_notify_user_ids=set(event['push_notify_user_ids']),
+        stream_push_user_ids=set(event['stream_push_user_ids']),
+        um_eligible_user_ids=set(event['um_eligible_user_ids']),
+        long_term_idle_user_ids=set(event['long_term_idle_user_ids']),
+        service_bot_tuples=[tuple(t) for t in event['service_bot_tuples']],
+    )  # type: Dict[str, Any]
+
+    with transaction.atomic():
+        user_message_flags = create_sent_user_messages([message_dict], skip_sender=True)
+    deliver_sent_messages([message_dict], user_message_flags, set(event['links_for_embed']))
+    # Only once its events are out, so that a message sent immediately
+    # can't overtake this one.  If we fail before this, later messages
+    # in the conversation just keep being deferred.
+    PendingMessageFanout.objects.filter(message_id=message.id).delete()
+
+def get_pending_deferred_fanouts(
+        messages: Sequence[MutableMapping[str, Any]]) -> Set[Tuple[int, int]]:
+    '''
+    Returns the (sender_id, recipient_id) pairs of these messages that
+    have deferred messages which the worker hasn't fanned out yet.  A
+    message delivered immediately would overtake those, so
+    do_send_messages defers these messages too.
+    '''
+    conversations = {(message['message'].sender_id, message['message'].recipient_id)
+                     for message in messages}
+    with span('deferred_fanout_check'):
+        pending_fanouts = PendingMessageFanout.objects.filter(
+            message__sender_id__in={sender_id for (sender_id, recipient_id) in conversations},
+            message__recipient_id__in={recipient_id for (sender_id, recipient_id) in conversations},
+        ).values_list('message__sender_id', 'message__recipient_id').distinct()
+        return set(pending_fanouts) & conversations
+
+def deliver_sent_message(message: MutableMapping[str, Any],
+                         user_message_flags: Dict[int, Dict[int, List[str]]],
+                         links_for_embed: Set[Text]) -> None:
+    '''
+    Deliver events to the real-time push system, as well as
+    enqueuing any additional processing triggered by the message.
+    This is the last stage of do_send_messages.
+    '''
+    wide_message_dict = MessageDict.wide_dict(message['message'])
+
+    user_flags = user_message_flags.get(message['message'].id, {})
+    sender = message['message'].sender
+    message_type = wide_message_dict['type']
+
+    presence_idle_user_ids = get_active_presence_idle_user_ids(
+        realm=sender.realm,
+        sender_id=sender.id,
+        message_type=message_type,
+        active_user_ids=message['active_user_ids'],
+        user_flags=user_flags,
+    )
+
+    event = dict(
+        type='message',
+        message=message['message'].id,
+        message_dict=wide_message_dict,
+        presence_idle_user_ids=presence_idle_user_ids,
+    )
+
+    '''
+    TODO:  We may want to limit user_ids to only those users who have
+           UserMessage rows, if only for minor performance reasons.
+
+           For now we queue events for all subscribers/sendees of the
+           message, since downstream code may still do notifications
+           that don't require UserMessage rows.
+
+           Our automated tests have gotten better on this codepath,
+           but we may have coverage gaps, so we should be careful
+           about changing the next line.
+    '''
+    user_ids = message['active_user_ids'] | set(user_flags.keys())
+
+    users = [
+        dict(
+            id=user_id,
+            flags=user_flags.get(user_id, []),
+            always_push_notify=(user_id in message['push_notify_user_ids']),
+            stream_push_notify=(user_id in message['stream_push_user_ids']),
+        )
+        for user_id in user_ids
+    ]
+
+    if message['message'].is_stream_message():
+        # Note: This is where authorization for single-stream
+        # get_updates happens! We only attach stream data to the
+        # notify new_message request if it's a public stream,
+        # ensuring that in the tornado server, non-public stream
+        # messages are only associated to their subscribed users.
+        assert message['stream'] is not None  # assert needed because stubs for django are missing
+        if message['stream'].is_public():
+            event['realm_id'] = message['stream'].realm_id
+            event['stream_name'] = message['stream'].name
+        if message['stream'].invite_only:
+            event['invite_only'] = True
+    if message['local_id'] is not None:
+        event['local_id'] = message['local_id']
+    if message['sender_queue_id'] is not None:
+        event['sender_queue_id'] = message['sender_queue_id']
+    send_event(event, users)
+
+    if url_embed_preview_enabled_for_realm(message['message']) and links_for_embed:
+        event_data = {
+            'message_id': message['message'].id,
+            'message_content': message['message'].content,
+            'message_realm_id': message['realm'].id,
+            'urls': links_for_embed}
+        with span('queue_publish'):
             queue_json_publish('embed_links', event_data)
 
-        if (settings.ENABLE_FEEDBACK and settings.FEEDBACK_BOT and
-                message['message'].recipient.type == Recipient.PERSONAL):
+    if (settings.ENABLE_FEEDBACK and settings.FEEDBACK_BOT and
+            message['message'].recipient.type == Recipient.PERSONAL):
 
-            feedback_bot_id = get_system_bot(email=settings.FEEDBACK_BOT).id
-            if feedback_bot_id in message['active_user_ids']:
-                queue_json_publish(
-                    'feedback_messages',
-                    wide_message_dict,
-                    lambda x: None
-                )
+        feedback_bot_id = get_system_bot(email=settings.FEEDBACK_BOT).id
+        if feedback_bot_id in message['active_user_ids']:
+            queue_json_publish(
+                'feedback_messages',
+                wide_message_dict,
+                lambda x: None
+            )
 
-        if message['message'].recipient.type == Recipient.PERSONAL:
-            welcome_bot_id = get_system_bot(settings.WELCOME_BOT).id
-            if (welcome_bot_id in message['active_user_ids'] and
-                    welcome_bot_id != message['message'].sender_id):
-                send_welcome_bot_response(message)
+    if message['message'].recipient.type == Recipient.PERSONAL:
+        welcome_bot_id = get_system_bot(settings.WELCOME_BOT).id
+        if (welcome_bot_id in message['active_user_ids'] and
+                welcome_bot_id != message['message'].sender_id):
+            send_welcome_bot_response(message)
 
-        for queue_name, events in message['message'].service_queue_events.items():
-            for event in events:
+    for queue_name, events in message['message'].service_queue_events.items():
+        for event in events:
+            with span('queue_publish'):
                 queue_json_publish(
                     queue_name,
                     {
@@ -1285,22 +1501,18 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
                     }
                 )
 
-    # Note that this does not preserve the order of message ids
-    # returned.  In practice, this shouldn't matter, as we only
-    # mirror single zephyr messages at a time and don't otherwise
-    # intermingle sending zephyr messages with other messages.
-    return already_sent_ids + [message['message'].id for message in messages]
-
 class UserMessageLite:
     '''
     The Django ORM is too slow for bulk operations.  This class
     is optimized for the simple use case of inserting a bunch of
     rows into zerver_usermessage.
     '''
-    def __init__(self, user_profile_id: int, message_id: int) -> None:
+    __slots__ = ['user_profile_id', 'message_id', 'flags']
+
+    def __init__(self, user_profile_id: int, message_id: int, flags: int=0) -> None:
         self.user_profile_id = user_profile_id
         self.message_id = message_id
-        self.flags = 0
+        self.flags = flags
 
     def flags_list(self) -> List[str]:
         return UserMessage.flags_list_for_flags(self.flags)
@@ -1309,40 +1521,46 @@ def create_user_messages(message: Message,
                          um_eligible_user_ids: Set[int],
                          long_term_idle_user_ids: Set[int],
                          mentioned_user_ids: Set[int]) -> List[UserMessageLite]:
-    ums_to_create = []
-
-    for user_profile_id in um_eligible_user_ids:
-        um = UserMessageLite(
-            user_profile_id=user_profile_id,
-            message_id=message.id,
-        )
-        ums_to_create.append(um)
+    # Nearly all recipients of a message get the same flags, so rather
+    # than checking every flag for every recipient, we compute the
+    # common flags once, and then the flags for the handful of users
+    # (the sender, mentioned users, etc.) who differ, using set
+    # operations.  This matters for messages to streams with
+    # thousands of subscribers.
 
     # These properties on the Message are set via
     # render_markdown by code in the bugdown inline patterns
-    wildcard = message.mentions_wildcard
-    ids_with_alert_words = message.user_ids_with_alert_words
-
-    for um in ums_to_create:
-        if um.user_profile_id == message.sender.id and \
-                message.sent_by_human():
-            um.flags |= UserMessage.flags.read
-        if wildcard:
-            um.flags |= UserMessage.flags.wildcard_mentioned
-        if um.user_profile_id in mentioned_user_ids:
-            um.flags |= UserMessage.flags.mentioned
-        if um.user_profile_id in ids_with_alert_words:
-            um.flags |= UserMessage.flags.has_alert_word
-
-    user_messages = []
-    for um in ums_to_create:
-        if (um.user_profile_id in long_term_idle_user_ids and
-                message.is_stream_message() and
-                int(um.flags) == 0):
-            continue
-        user_messages.append(um)
-
-    return user_messages
+    base_flags = 0
+    if message.mentions_wildcard:
+        base_flags |= int(UserMessage.flags.wildcard_mentioned)
+
+    flags_by_user_id = {}  # type: Dict[int, int]
+
+    def add_flag(user_ids: Iterable[int], flag: int) -> None:
+        for user_id in user_ids:
+            flags_by_user_id[user_id] = flags_by_user_id.get(user_id, base_flags) | flag
+
+    if message.sender_id in um_eligible_user_ids and message.sent_by_human():
+        add_flag([message.sender_id], int(UserMessage.flags.read))
+    add_flag(mentioned_user_ids & um_eligible_user_ids,
+             int(UserMessage.flags.mentioned))
+    add_flag(message.user_ids_with_alert_words & um_eligible_user_ids,
+             int(UserMessage.flags.has_alert_word))
+
+    user_ids = um_eligible_user_ids
+    if message.is_stream_message() and base_flags == 0:
+        # Long-term idle users don't get UserMessage rows for stream
+        # messages that don't have any flags for them.
+        user_ids = user_ids - (long_term_idle_user_ids - set(flags_by_user_id))
+
+    return [
+        UserMessageLite(
+            user_profile_id=user_id,
+            message_id=message.id,
+            flags=flags_by_user_id.get(user_id, base_flags),
+        )
+        for user_id in user_ids
+    ]
 
 def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     '''
@@ -1354,6 +1572,10 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     if not ums:
         return
 
+    if len(ums) >= BULK_INSERT_UMS_COPY_THRESHOLD:
+        copy_insert_ums(ums)
+        return
+
     vals = ','.join([
         '(%d, %d, %d)' % (um.user_profile_id, um.message_id, um.flags)
         for um in ums
@@ -1367,6 +1589,22 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     with connection.cursor() as cursor:
         cursor.execute(query)
 
+def copy_insert_ums(ums: List[UserMessageLite]) -> None:
+    '''
+    For messages sent to very large streams, even formatting and
+    parsing the INSERT statement in bulk_insert_ums is expensive, so
+    we instead stream the rows to postgres in COPY's text format,
+    which skips SQL parsing entirely.
+    '''
+    buf = io.StringIO()
+    for um in ums:
+        buf.write('%d\t%d\t%d\n' % (um.user_profile_id, um.message_id, um.flags))
+    buf.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.copy_from(buf, 'zerver_usermessage',
+                         columns=('user_profile_id', 'message_id', 'flags'))
+
 def notify_reaction_update(user_profile: UserProfile, message: Message,
                            reaction: Reaction, op: Text) -> None:
     user_dict = {'user_id': user_profile.id,
@@ -1680,7 +1918,8 @@ def check_send_message(sender: UserProfile, client: Client, message_type_name: T
                        forged: bool=False, forged_timestamp: Optional[float]=None,
                        forwarder_user_profile: Optional[UserProfile]=None,
                        local_id: Optional[Text]=None,
-                       sender_queue_id: Optional[Text]=None) -> int:
+                       sender_queue_id: Optional[Text]=None,
+                       defer_fanout: bool=False) -> int:
 
     addressee = Addressee.legacy_build(
         sender,
@@ -1688,10 +1927,11 @@ def check_send_message(sender: UserProfile, client: Client, message_type_name: T
         message_to,
         topic_name)
 
-    message = check_message(sender, client, addressee,
-                            message_content, realm, forged, forged_timestamp,
-                            forwarder_user_profile, local_id, sender_queue_id)
-    return do_send_messages([message])[0]
+    with span('validate'):
+        message = check_message(sender, client, addressee,
+                                message_content, realm, forged, forged_timestamp,
+                                forwarder_user_profile, local_id, sender_queue_id)
+    return do_send_messages([message], defer_fanout=defer_fanout)[0]
 
 def check_schedule_message(sender: UserProfile, client: Client,
                            message_type_name: Text, message_to: Sequence[Text],
@@ -2239,6 +2479,7 @@ def get_user_ids_for_streams(streams: Iterable[Stream]) -> Dict[int, List[int]]:
     return all_subscribers_by_stream
 
 SubT = Tuple[List[Tuple[UserProfile, Stream]], List[Tuple[UserProfile, Stream]]]
+@batch_events()
 def bulk_add_subscriptions(streams: Iterable[Stream],
                            users: Iterable[UserProfile],
                            from_stream_creation: bool=False,
@@ -2296,6 +2537,8 @@ def bulk_add_subscriptions(streams: Iterable[Stream],
         sub_ids = [sub.id for (sub, stream) in subs_to_activate]
         Subscription.objects.filter(id__in=sub_ids).update(active=True)
         occupied_streams_after = list(get_occupied_streams(user_profile.realm))
+    delete_stream_recipient_info_cache({stream.id for (sub, stream)
+                                        in subs_to_add + subs_to_activate})
 
     # Log Subscription Activities in RealmAuditLog
     event_time = timezone_now()
@@ -2409,6 +2652,7 @@ def notify_subscriptions_removed(user_profile: UserProfile, streams: Iterable[St
     send_event(event, [user_profile.id])
 
 SubAndRemovedT = Tuple[List[Tuple[UserProfile, Stream]], List[Tuple[UserProfile, Stream]]]
+@batch_events()
 def bulk_remove_subscriptions(users: Iterable[UserProfile],
                               streams: Iterable[Stream],
                               acting_user: Optional[UserProfile]=None) -> SubAndRemovedT:
@@ -2462,6 +2706,8 @@ def bulk_remove_subscriptions(users: Iterable[UserProfile],
             id__in=sub_ids_to_deactivate,
         ) .update(active=False)
         occupied_streams_after = list(get_occupied_streams(our_realm))
+    delete_stream_recipient_info_cache({stream.id for (sub, stream)
+                                        in subs_to_deactivate})
 
     # Log Subscription Activities in RealmAuditLog
     event_time = timezone_now()
@@ -3418,33 +3664,56 @@ def get_user_info_for_message_updates(message_id: int) -> MessageUpdateUserInfoR
         mention_user_ids=mention_user_ids,
     )
 
-def update_user_message_flags(message: Message, ums: Iterable[UserMessage]) -> None:
-    wildcard = message.mentions_wildcard
-    mentioned_ids = message.mentions_user_ids
-    ids_with_alert_words = message.user_ids_with_alert_words
-    changed_ums = set()  # type: Set[UserMessage]
-
-    def update_flag(um: UserMessage, should_set: bool, flag: int) -> None:
-        if should_set:
-            if not (um.flags & flag):
-                um.flags |= flag
-                changed_ums.add(um)
-        else:
-            if (um.flags & flag):
-                um.flags &= ~flag
-                changed_ums.add(um)
+def update_user_message_flags(message: Message) -> None:
+    '''
+    Updates the flags of the message's UserMessage rows that are driven
+    by its (just re-rendered) content.  Rather than loading and saving
+    each row, we issue UPDATE queries that only match the rows whose
+    flags actually change, so that the cost of an edit is proportional
+    to the number of changed mentions and alert words, not to the
+    number of recipients.
+    '''
+    ums = UserMessage.objects.filter(message=message.id)
 
-    for um in ums:
-        has_alert_word = um.user_profile_id in ids_with_alert_words
-        update_flag(um, has_alert_word, UserMessage.flags.has_alert_word)
+    def update_flag(user_ids: Set[int], flag: Bit) -> None:
+        ums.filter(flags=flag).exclude(user_profile_id__in=user_ids).update(
+            flags=F('flags').bitand(~flag))
+        if user_ids:
+            ums.filter(flags=~flag, user_profile_id__in=user_ids).update(
+                flags=F('flags').bitor(flag))
 
-        mentioned = um.user_profile_id in mentioned_ids
-        update_flag(um, mentioned, UserMessage.flags.mentioned)
+    update_flag(message.user_ids_with_alert_words, UserMessage.flags.has_alert_word)
+    update_flag(message.mentions_user_ids, UserMessage.flags.mentioned)
 
-        update_flag(um, wildcard, UserMessage.flags.wildcard_mentioned)
+    if message.mentions_wildcard:
+        ums.filter(flags=~UserMessage.flags.wildcard_mentioned).update(
+            flags=F('flags').bitor(UserMessage.flags.wildcard_mentioned))
+    else:
+        ums.filter(flags=UserMessage.flags.wildcard_mentioned).update(
+            flags=F('flags').bitand(~UserMessage.flags.wildcard_mentioned))
 
-    for um in changed_ums:
-        um.save(update_fields=['flags'])
+def get_message_update_event_users(event: Dict[str, Any], message_id: int) -> List[int]:
+    '''
+    Returns the users to send an update_message event to, adding their
+    flags to the event.  Most recipients of a message share the same
+    flags, so rather than a dict per user, we group the users by their
+    flags, which Tornado expands into each user's event; see
+    process_message_update_event.
+    '''
+    rows = UserMessage.objects.filter(message=message_id).values_list('user_profile_id', 'flags')
+    user_ids_by_flags = defaultdict(list)  # type: Dict[int, List[int]]
+    for user_id, flags in rows:
+        user_ids_by_flags[int(flags)].append(user_id)
+
+    event['user_flags_groups'] = [
+        dict(flags=UserMessage.flags_list_for_flags(flags), user_ids=user_ids)
+        for flags, user_ids in user_ids_by_flags.items()
+    ]
+    return [
+        user_id
+        for user_ids in user_ids_by_flags.values()
+        for user_id in user_ids
+    ]
 
 def update_to_dict_cache(changed_messages: List[Message]) -> List[int]:
     """Updates the message as stored in the to_dict cache (for serving
@@ -3472,10 +3741,8 @@ def do_update_embedded_data(user_profile: UserProfile,
         'message_id': message.id}  # type: Dict[str, Any]
     changed_messages = [message]
 
-    ums = UserMessage.objects.filter(message=message.id)
-
     if content is not None:
-        update_user_message_flags(message, ums)
+        update_user_message_flags(message)
         message.content = content
         message.rendered_content = rendered_content
         message.rendered_content_version = bugdown_version
@@ -3485,13 +3752,7 @@ def do_update_embedded_data(user_profile: UserProfile,
     message.save(update_fields=["content", "rendered_content"])
 
     event['message_ids'] = update_to_dict_cache(changed_messages)
-
-    def user_info(um: UserMessage) -> Dict[str, Any]:
-        return {
-            'id': um.user_profile_id,
-            'flags': um.flags_list()
-        }
-    send_event(event, list(map(user_info, ums)))
+    send_event(event, get_message_update_event_users(event, message.id))
 
 # We use transaction.atomic to support select_for_update in the attachment codepath.
 @transaction.atomic
@@ -3526,10 +3787,8 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
             if 'prev_rendered_content' in old_edit_history_event:
                 first_rendered_content = old_edit_history_event['prev_rendered_content']
 
-    ums = UserMessage.objects.filter(message=message.id)
-
     if content is not None:
-        update_user_message_flags(message, ums)
+        update_user_message_flags(message)
 
         # We are turning off diff highlighting everywhere until ticket #1532 is addressed.
         if False:
@@ -3638,13 +3897,7 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
                                 "edit_history"])
 
     event['message_ids'] = update_to_dict_cache(changed_messages)
-
-    def user_info(um: UserMessage) -> Dict[str, Any]:
-        return {
-            'id': um.user_profile_id,
-            'flags': um.flags_list()
-        }
-    send_event(event, list(map(user_info, ums)))
+    send_event(event, get_message_update_event_users(event, message.id))
     return len(changed_messages)
 
 
@@ -4424,6 +4677,8 @@ def bulk_add_members_to_user_group(user_group: UserGroup,
                                        user_profile=user_profile)
                    for user_profile in user_profiles]
     UserGroupMembership.objects.bulk_create(memberships)
+    # bulk_create doesn't send the signal that does this.
+    flush_realm_mention_data(user_group.realm_id, ['user_groups'])
 
     user_ids = [up.id for up in user_profiles]
     do_send_user_group_members_update_event('add_members', user_group, user_ids)
@@ -16,11 +16,12 @@ import twitter
 import platform
 import time
 import functools
+import random
 import ujson
 import xml.etree.cElementTree as etree
 from xml.etree.cElementTree import Element, SubElement
 
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
 
 import requests
 
@@ -35,7 +36,10 @@ from zerver.lib.camo import get_camo_url
 from zerver.lib.mention import possible_mentions, \
     possible_user_group_mentions, extract_user_group
 from zerver.lib.timeout import timeout, TimeoutExpired
-from zerver.lib.cache import cache_with_key, NotFoundInCache
+from zerver.lib.cache import cache_with_key, cache_add, cache_get_many, cache_set, \
+    NotFoundInCache, realm_mention_data_generation_cache_key, \
+    realm_mention_user_change_cache_key, REALM_MENTION_DATA_TIMEOUT
+from zerver.lib.utils import generate_random_token
 from zerver.lib.url_preview import preview as link_preview
 from zerver.models import (
     all_realm_filters,
@@ -1808,25 +1812,160 @@ def get_full_name_info(realm_id: int, full_names: Set[Text]) -> Dict[Text, FullN
     }
     return dct
 
+class RealmMentionIndex:
+    '''
+    The data MentionData needs about a realm's active users and user
+    groups, indexed by the names they can be mentioned with.  The user
+    groups are reloaded when their generation changes; users are
+    reloaded individually as they change (see
+    note_realm_mention_user_change).
+    '''
+    def __init__(self, realm_id: int) -> None:
+        self.realm_id = realm_id
+        self.user_groups_generation = None  # type: Optional[Text]
+        self.user_change_count = None  # type: Optional[int]
+        self.full_name_info = {}  # type: Dict[Text, FullNameInfo]
+        self.user_names = {}  # type: Dict[int, Text]
+        self.user_groups_by_name = {}  # type: Dict[Text, UserGroup]
+        self.user_group_members = {}  # type: Dict[int, List[int]]
+
+    def update(self, user_groups_generation: Text, user_change_count: int) -> None:
+        if (self.user_change_count is None or
+                not 0 <= user_change_count - self.user_change_count <= MAX_MENTION_INDEX_USER_CHANGES):
+            self.load_users()
+        elif user_change_count != self.user_change_count:
+            keys = [realm_mention_user_change_cache_key(self.realm_id, change)
+                    for change in range(self.user_change_count + 1, user_change_count + 1)]
+            changes = cache_get_many(keys)
+            if len(changes) == len(keys):
+                self.reload_users({changes[key][0] for key in keys})
+            else:
+                # Some changes were evicted, so we can't tell who changed.
+                self.load_users()
+        self.user_change_count = user_change_count
+
+        if user_groups_generation != self.user_groups_generation:
+            self.load_user_groups()
+        self.user_groups_generation = user_groups_generation
+
+    def add_user(self, row: FullNameInfo) -> None:
+        self.full_name_info[row['full_name'].lower()] = row
+        self.user_names[row['id']] = row['full_name'].lower()
+
+    def load_users(self) -> None:
+        self.full_name_info = {}
+        self.user_names = {}
+        rows = UserProfile.objects.filter(
+            realm_id=self.realm_id,
+            is_active=True,
+        ).values(
+            'id',
+            'full_name',
+            'email',
+        )
+        for row in rows:
+            self.add_user(row)
+
+    def reload_users(self, user_ids: Set[int]) -> None:
+        for user_id in user_ids:
+            name = self.user_names.pop(user_id, None)
+            # Another user with the same name may have the entry; if
+            # we remove theirs, MentionData looks them up instead.
+            if name is not None:
+                self.full_name_info.pop(name, None)
+        rows = UserProfile.objects.filter(
+            id__in=user_ids,
+            realm_id=self.realm_id,
+            is_active=True,
+        ).values(
+            'id',
+            'full_name',
+            'email',
+        )
+        for row in rows:
+            self.add_user(row)
+
+    def load_user_groups(self) -> None:
+        self.user_groups_by_name = {
+            group.name: group
+            for group in UserGroup.objects.filter(realm_id=self.realm_id)
+        }
+
+        self.user_group_members = defaultdict(list)
+        membership = UserGroupMembership.objects.filter(user_group__realm_id=self.realm_id)
+        for info in membership.values('user_group_id', 'user_profile_id'):
+            self.user_group_members[info['user_group_id']].append(info['user_profile_id'])
+
+# Each process keeps the RealmMentionIndex for recently active realms,
+# so that resolving mentions doesn't need any database queries.  To
+# notice changes made by other processes, each index is checked
+# against the realm's user change counter and user group generation
+# in memcached, which the cache flush signals update.
+MAX_REALM_MENTION_INDEXES = 100
+# An index that's further behind than this reloads all of the users.
+MAX_MENTION_INDEX_USER_CHANGES = 100
+realm_mention_indexes = OrderedDict()  # type: OrderedDict[int, RealmMentionIndex]
+
+def get_realm_mention_index(realm_id: int) -> RealmMentionIndex:
+    users_key = realm_mention_data_generation_cache_key(realm_id, 'users')
+    user_groups_key = realm_mention_data_generation_cache_key(realm_id, 'user_groups')
+    cached = cache_get_many([users_key, user_groups_key])
+
+    if users_key in cached:
+        user_change_count = cached[users_key]
+    else:
+        # Start the counter somewhere random, so that indexes which
+        # saw a previous counter reload all of the users.  If another
+        # process beats us to it, our index just reloads them again.
+        user_change_count = random.randrange(2**32)
+        cache_add(users_key, user_change_count, timeout=REALM_MENTION_DATA_TIMEOUT)
+
+    if user_groups_key in cached:
+        user_groups_generation = cached[user_groups_key][0]
+    else:
+        user_groups_generation = generate_random_token(32)
+        cache_set(user_groups_key, user_groups_generation, timeout=REALM_MENTION_DATA_TIMEOUT)
+
+    index = realm_mention_indexes.pop(realm_id, None)
+    if index is None:
+        index = RealmMentionIndex(realm_id)
+    index.update(user_groups_generation, user_change_count)
+    realm_mention_indexes[realm_id] = index
+    if len(realm_mention_indexes) > MAX_REALM_MENTION_INDEXES:
+        realm_mention_indexes.popitem(last=False)
+    return index
+
 class MentionData:
     def __init__(self, realm_id: int, content: Text) -> None:
         full_names = possible_mentions(content)
-        self.full_name_info = get_full_name_info(realm_id, full_names)
+        user_group_names = possible_user_group_mentions(content)
+
+        self.full_name_info = {}  # type: Dict[Text, FullNameInfo]
+        self.user_group_name_info = {}  # type: Dict[Text, UserGroup]
+        self.user_group_members = {}  # type: Dict[int, List[int]]
+        if full_names or user_group_names:
+            index = get_realm_mention_index(realm_id)
+            missing_names = set()  # type: Set[Text]
+            for full_name in full_names:
+                row = index.full_name_info.get(full_name.lower())
+                if row is not None:
+                    self.full_name_info[full_name.lower()] = row
+                else:
+                    missing_names.add(full_name)
+            # New users don't invalidate the index, so look up any
+            # names we don't know about.
+            self.full_name_info.update(get_full_name_info(realm_id, missing_names))
+            for user_group_name in user_group_names:
+                group = index.user_groups_by_name.get(user_group_name)
+                if group is not None:
+                    self.user_group_name_info[user_group_name.lower()] = group
+                    self.user_group_members[group.id] = index.user_group_members.get(group.id, [])
+
         self.user_ids = {
             row['id']
             for row in self.full_name_info.values()
         }
 
-        user_group_names = possible_user_group_mentions(content)
-        self.user_group_name_info = get_user_group_name_info(realm_id, user_group_names)
-        group_ids = [group.id for group in self.user_group_name_info.values()]
-        membership = UserGroupMembership.objects.filter(user_group_id__in=group_ids)
-        self.user_group_members = defaultdict(list)  # type: Dict[int, List[int]]
-        for info in membership.values('user_group_id', 'user_profile_id'):
-            group_id = info['user_group_id']
-            user_profile_id = info['user_profile_id']
-            self.user_group_members[group_id].append(user_profile_id)
-
     def get_user(self, name: Text) -> Optional[FullNameInfo]:
         return self.full_name_info.get(name.lower(), None)
 
@@ -1845,15 +1984,6 @@ class MentionData:
     def get_group_members(self, user_group_id: int) -> List[int]:
         return self.user_group_members.get(user_group_id, [])
 
-def get_user_group_name_info(realm_id: int, user_group_names: Set[Text]) -> Dict[Text, UserGroup]:
-    if not user_group_names:
-        return dict()
-
-    rows = UserGroup.objects.filter(realm_id=realm_id,
-                                    name__in=user_group_names)
-    dct = {row.name.lower(): row for row in rows}
-    return dct
-
 def get_stream_name_info(realm: Realm, stream_names: Set[Text]) -> Dict[Text, FullNameInfo]:
     if not stream_names:
         return dict()
@@ -1,9 +1,11 @@
 
+from collections import OrderedDict
 from functools import wraps
 
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 from django.core.cache.backends.base import BaseCache
 
@@ -198,6 +200,27 @@ def cache_set_many(items: Dict[Text, Any], cache_name: Optional[str]=None,
     get_cache_backend(cache_name).set_many(items, timeout=timeout)
     remote_cache_stats_finish()
 
+def cache_add(key: Text, val: Any, cache_name: Optional[str]=None,
+              timeout: Optional[int]=None) -> bool:
+    """Sets the key only if it isn't already set, returning whether it
+    was.  Unlike cache_set, the value isn't wrapped in a tuple, so that
+    counters stored this way can be incremented with cache_incr."""
+    remote_cache_stats_start()
+    ret = get_cache_backend(cache_name).add(KEY_PREFIX + key, val, timeout=timeout)
+    remote_cache_stats_finish()
+    return ret
+
+def cache_incr(key: Text, cache_name: Optional[str]=None) -> Optional[int]:
+    """Atomically increments a counter stored with cache_add, returning
+    its new value, or None if it isn't in the cache."""
+    remote_cache_stats_start()
+    try:
+        return get_cache_backend(cache_name).incr(KEY_PREFIX + key)
+    except ValueError:
+        return None
+    finally:
+        remote_cache_stats_finish()
+
 def cache_delete(key: Text, cache_name: Optional[str]=None) -> None:
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
@@ -209,6 +232,15 @@ def cache_delete_many(items: Iterable[Text], cache_name: Optional[str]=None) ->
         KEY_PREFIX + item for item in items)
     remote_cache_stats_finish()
 
+def cache_delete_many_on_commit(items: Iterable[Text], cache_name: Optional[str]=None) -> None:
+    """For caches of data that the current transaction changes.  Until
+    it commits, other processes still read the old rows, and could
+    refill the cache with them after we delete it, so we delete it
+    again once the transaction commits."""
+    items = list(items)
+    cache_delete_many(items, cache_name)
+    transaction.on_commit(lambda: cache_delete_many(items, cache_name))
+
 # Generic_bulk_cached fetch and its helpers
 ObjKT = TypeVar('ObjKT')
 ItemT = TypeVar('ItemT')
@@ -344,6 +376,62 @@ def get_stream_cache_key(stream_name: Text, realm_id: int) -> Text:
     return u"stream_by_realm_and_name:%s:%s" % (
         realm_id, make_safe_digest(stream_name.strip().lower()))
 
+def stream_recipient_info_cache_key(stream_id: int) -> Text:
+    return u"stream_recipient_info:%s" % (stream_id,)
+
+# Fields of UserProfile that are part of the cached
+# get_stream_recipient_info data.
+stream_recipient_info_user_fields = [
+    'id', 'is_active', 'enable_online_push_notifications',
+    'is_bot', 'bot_type', 'long_term_idle']  # type: List[str]
+
+def delete_stream_recipient_info_cache(stream_ids: Iterable[int]) -> None:
+    cache_delete_many_on_commit([stream_recipient_info_cache_key(stream_id)
+                                 for stream_id in stream_ids])
+
+def delete_user_stream_recipient_info_cache(user_profile):
+    # type: (UserProfile) -> None
+    from zerver.models import Subscription, Recipient  # We need to import here to avoid cyclic dependency.
+    stream_ids = Subscription.objects.filter(
+        user_profile=user_profile,
+        recipient__type=Recipient.STREAM,
+    ).values_list('recipient__type_id', flat=True)
+    delete_stream_recipient_info_cache(stream_ids)
+
+# The per-process mention indexes (see get_realm_mention_index) keep
+# a realm's users and its user groups separately.  The user groups
+# are tagged with a generation token, and reloaded when it changes.
+# The users' "generation" is instead a counter of changes to the
+# realm's users, each recorded under its count by
+# note_realm_mention_user_change, so that an index only reloads the
+# users changed since the count it last saw.  Deleting either key
+# (see flush_realm_mention_data) makes indexes reload all of it.
+REALM_MENTION_DATA_KINDS = ['users', 'user_groups']
+REALM_MENTION_DATA_TIMEOUT = 3600*24*7
+
+def realm_mention_data_generation_cache_key(realm_id: int, kind: str) -> Text:
+    return u"realm_mention_data_generation:%s:%s" % (kind, realm_id)
+
+def realm_mention_user_change_cache_key(realm_id: int, change: int) -> Text:
+    return u"realm_mention_user_change:%s:%s" % (realm_id, change)
+
+def note_realm_mention_user_change(realm_id: int, user_profile_id: int) -> None:
+    """Makes the mention indexes reload the user.  Like
+    cache_delete_many_on_commit, we do this again once the transaction
+    commits, in case an index reloads the user before then."""
+    def note_change() -> None:
+        change = cache_incr(realm_mention_data_generation_cache_key(realm_id, 'users'))
+        # Without a counter, indexes reload all of the users anyway.
+        if change is not None:
+            cache_set(realm_mention_user_change_cache_key(realm_id, change), user_profile_id,
+                      timeout=REALM_MENTION_DATA_TIMEOUT)
+    note_change()
+    transaction.on_commit(note_change)
+
+def flush_realm_mention_data(realm_id: int, kinds: Iterable[str]=REALM_MENTION_DATA_KINDS) -> None:
+    cache_delete_many_on_commit([realm_mention_data_generation_cache_key(realm_id, kind)
+                                 for kind in kinds])
+
 def delete_user_profile_caches(user_profiles):
     # type: (Iterable[UserProfile]) -> None
     keys = []
@@ -389,9 +477,21 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     if changed(['is_active']):
         cache_delete(active_user_ids_cache_key(user_profile.realm_id))
 
+    # Update the user in the per-process mention indexes.  New users
+    # don't need this, since MentionData looks up names missing from
+    # the index.
+    if kwargs.get('update_fields') is not None and changed(['full_name', 'email', 'is_active']):
+        note_realm_mention_user_change(user_profile.realm_id, user_profile.id)
+
     if changed(['email', 'full_name', 'short_name', 'id', 'is_mirror_dummy']):
         delete_display_recipient_cache(user_profile)
 
+    # This needs a query for the user's subscriptions, so we skip it
+    # for full saves; all the code that changes these fields passes
+    # update_fields, and new users aren't subscribed to anything yet.
+    if kwargs.get('update_fields') is not None and changed(stream_recipient_info_user_fields):
+        delete_user_stream_recipient_info_cache(user_profile)
+
     # Invalidate our bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
     if user_profile.is_bot and changed(bot_dict_fields):
@@ -420,6 +520,7 @@ def flush_realm(sender: Any, **kwargs: Any) -> None:
         cache_delete(active_user_ids_cache_key(realm.id))
         cache_delete(bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
+        flush_realm_mention_data(realm.id)
 
 def realm_alert_words_cache_key(realm):
     # type: (Realm) -> Text
@@ -444,6 +545,33 @@ def flush_stream(sender: Any, **kwargs: Any) -> None:
            Q(default_events_register_stream=stream)).exists():
         cache_delete(bot_dicts_in_realm_cache_key(stream.realm))
 
+# Called by models.py to flush the per-process user group mention
+# indexes whenever we save or delete a UserGroup or UserGroupMembership.
+def flush_user_group(sender: Any, **kwargs: Any) -> None:
+    from zerver.models import UserGroupMembership
+    instance = kwargs['instance']
+    if isinstance(instance, UserGroupMembership):
+        realm_id = instance.user_group.realm_id
+    else:
+        realm_id = instance.realm_id
+    flush_realm_mention_data(realm_id, ['user_groups'])
+
+# Called by models.py to flush the stream recipient info cache whenever
+# we save a Subscription object.  Bulk updates of subscriptions, which
+# don't send signals, need to call delete_stream_recipient_info_cache
+# themselves.
+def flush_subscription(sender: Any, **kwargs: Any) -> None:
+    from zerver.models import Recipient, get_recipient_by_id
+    recipient = get_recipient_by_id(kwargs['instance'].recipient_id)
+    if recipient.type == Recipient.STREAM:
+        delete_stream_recipient_info_cache([recipient.type_id])
+
+def rendered_content_cache_key(realm_id: int, sender_id: int, content: Text,
+                               possible_words: Iterable[Text], email_gateway: bool) -> Text:
+    return u"rendered_content:%s:%s:%s:%s:%s" % (
+        realm_id, sender_id, int(email_gateway), make_safe_digest(content),
+        make_safe_digest(u"\n".join(sorted(possible_words))))
+
 def to_dict_cache_key_id(message_id: int) -> Text:
     return 'message_dict:%d' % (message_id,)
 
@@ -451,6 +579,32 @@ def to_dict_cache_key(message):
     # type: (Message) -> Text
     return to_dict_cache_key_id(message.id)
 
+# An in-process LRU of decoded message dicts, in front of the to_dict
+# cache in memcached, for hot messages (e.g. the latest messages in a
+# busy stream) which many clients fetch.  It's keyed by the encoded
+# message dict as stored in memcached, so it saves decoding messages,
+# not fetching them: changing a message changes (or deletes) its
+# memcached entry, so every process stops using the old dict as soon
+# as memcached has the change, without any extra memcached requests.
+# Old entries just age out of the LRU.
+MESSAGE_DICT_LRU_SIZE = 5000
+message_dict_lru = OrderedDict()  # type: OrderedDict[bytes, Dict[str, Any]]
+
+def message_dict_lru_extract(message_bytes: bytes,
+                             extractor: Callable[[bytes], Dict[str, Any]]) -> Dict[str, Any]:
+    """Returns a copy of the message dict encoded in message_bytes, which
+    the caller is free to modify, decoding it with extractor only if
+    it's not in the LRU."""
+    message_dict = message_dict_lru.get(message_bytes)
+    if message_dict is None:
+        message_dict = extractor(message_bytes)
+        message_dict_lru[message_bytes] = message_dict
+        if len(message_dict_lru) > MESSAGE_DICT_LRU_SIZE:
+            message_dict_lru.popitem(last=False)
+    else:
+        message_dict_lru.move_to_end(message_bytes)
+    return dict(message_dict)
+
 def flush_message(sender: Any, **kwargs: Any) -> None:
     message = kwargs['instance']
     cache_delete(to_dict_cache_key_id(message.id))
@@ -3,6 +3,7 @@ import datetime
 import ujson
 import zlib
 
+from django.conf import settings
 from django.utils.translation import ugettext as _
 from django.utils.timezone import now as timezone_now
 from django.db.models import Sum
@@ -14,11 +15,14 @@ import zerver.lib.bugdown as bugdown
 from zerver.lib.cache import (
     cache_with_key,
     generic_bulk_cached_fetch,
+    message_dict_lru_extract,
     to_dict_cache_key,
     to_dict_cache_key_id,
     realm_first_visible_message_id_cache_key,
+    rendered_content_cache_key,
     cache_get, cache_set,
 )
+from zerver.lib.mention import possible_mentions, possible_user_group_mentions
 from zerver.lib.request import JsonableError
 from zerver.lib.stream_subscription import (
     get_stream_subscriptions_for_user,
@@ -28,6 +32,7 @@ from zerver.lib.topic_mutes import (
     build_topic_mute_checker,
     topic_is_muted,
 )
+from zerver.lib.utils import statsd
 
 from zerver.models import (
     get_display_recipient_by_id,
@@ -43,7 +48,7 @@ from zerver.models import (
     Reaction
 )
 
-from typing import Any, Dict, List, Optional, Set, Tuple, Text, Union
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Text, Union
 from mypy_extensions import TypedDict
 
 RealmAlertWords = Dict[int, List[Text]]
@@ -77,12 +82,17 @@ def messages_for_ids(message_ids: List[int],
     cache_transformer = MessageDict.build_dict_from_raw_db_row
     id_fetcher = lambda row: row['id']
 
+    # Cache hits are decoded through the in-process LRU, so hot
+    # messages are only decoded once per process.
+    extractor = lambda message_bytes: message_dict_lru_extract(message_bytes,
+                                                               extract_message_dict)
+
     message_dicts = generic_bulk_cached_fetch(to_dict_cache_key_id,
                                               MessageDict.get_raw_db_rows,
                                               message_ids,
                                               id_fetcher=id_fetcher,
                                               cache_transformer=cache_transformer,
-                                              extractor=extract_message_dict,
+                                              extractor=extractor,
                                               setter=stringify_message_dict)
 
     message_list = []  # type: List[Dict[str, Any]]
@@ -121,11 +131,81 @@ def sew_messages_and_reactions(messages: List[Dict[str, Any]],
     return list(converted_messages.values())
 
 
+# The keys every message dict in the to_dict cache has (see
+# MessageDict.build_message_dict), in the order that the packed codecs
+# store their values, so that entries don't need to repeat the keys.
+PACKED_MESSAGE_DICT_KEYS = [
+    'id',
+    'sender_id',
+    'content',
+    'recipient_type_id',
+    'recipient_type',
+    'recipient_id',
+    'subject',
+    'timestamp',
+    'client',
+    'sender_realm_id',
+    'raw_display_recipient',
+    'subject_links',
+    'rendered_content',
+    'is_me_message',
+    'reactions',
+]
+
+def pack_message_dict(message_dict: Dict[str, Any]) -> bytes:
+    # A JSON array of the values of PACKED_MESSAGE_DICT_KEYS, followed
+    # by a dict of any other keys (e.g. edit_history).
+    values = [message_dict[key] for key in PACKED_MESSAGE_DICT_KEYS]
+    values.append({key: value for (key, value) in message_dict.items()
+                   if key not in PACKED_MESSAGE_DICT_KEYS})
+    return ujson.dumps(values).encode()
+
+def unpack_message_dict(message_bytes: bytes) -> Dict[str, Any]:
+    values = ujson.loads(message_bytes.decode("utf-8"))
+    message_dict = values.pop()
+    message_dict.update(zip(PACKED_MESSAGE_DICT_KEYS, values))
+    return message_dict
+
+# Codecs for message dicts in the to_dict cache, as (encoder, decoder)
+# pairs; settings.MESSAGE_DICT_CACHE_CODEC selects the one we encode
+# new entries with.  Each codec's encodings start with a different
+# byte, which extract_message_dict dispatches on, so that changing the
+# setting doesn't invalidate the existing entries.
+MESSAGE_DICT_CODECS = {
+    # zlib's header starts with 'x'.
+    'zlib_json': (
+        lambda message_dict: zlib.compress(ujson.dumps(message_dict).encode()),
+        lambda message_bytes: ujson.loads(zlib.decompress(message_bytes).decode("utf-8")),
+    ),
+    # Starts with '{'.
+    'json': (
+        lambda message_dict: ujson.dumps(message_dict).encode(),
+        lambda message_bytes: ujson.loads(message_bytes.decode("utf-8")),
+    ),
+    # Starts with '['.
+    'packed': (
+        pack_message_dict,
+        unpack_message_dict,
+    ),
+    'zlib_packed': (
+        lambda message_dict: b'z' + zlib.compress(pack_message_dict(message_dict)),
+        lambda message_bytes: unpack_message_dict(zlib.decompress(message_bytes[1:])),
+    ),
+}  # type: Dict[str, Tuple[Callable[[Dict[str, Any]], bytes], Callable[[bytes], Dict[str, Any]]]]
+
+MESSAGE_DICT_CODECS_BY_FIRST_BYTE = {
+    ord('x'): 'zlib_json',
+    ord('{'): 'json',
+    ord('['): 'packed',
+    ord('z'): 'zlib_packed',
+}
+
 def extract_message_dict(message_bytes: bytes) -> Dict[str, Any]:
-    return ujson.loads(zlib.decompress(message_bytes).decode("utf-8"))
+    codec = MESSAGE_DICT_CODECS_BY_FIRST_BYTE[message_bytes[0]]
+    return MESSAGE_DICT_CODECS[codec][1](message_bytes)
 
 def stringify_message_dict(message_dict: Dict[str, Any]) -> bytes:
-    return zlib.compress(ujson.dumps(message_dict).encode())
+    return MESSAGE_DICT_CODECS[settings.MESSAGE_DICT_CACHE_CODEC][0](message_dict)
 
 @cache_with_key(to_dict_cache_key, timeout=3600*24)
 def message_to_dict_json(message: Message) -> bytes:
@@ -496,6 +576,18 @@ def access_message(user_profile: UserProfile, message_id: int) -> Tuple[Message,
     # stream in your realm, so return the message, user_message pair
     return (message, user_message)
 
+# Monitoring integrations often send byte-identical messages over and
+# over, so we cache the rendering of bot messages, keyed by the
+# content, sender and the recipients' alert words.  Since the key
+# doesn't cover realm emoji, filters, or stream names, the timeout is
+# short.
+RENDERED_CONTENT_CACHE_TIMEOUT = 60 * 10
+
+def can_cache_rendered_content(content: Text) -> bool:
+    # Mentions of users and groups depend on data that can change
+    # while the rendering is cached, and have per-message side effects.
+    return not possible_mentions(content) and not possible_user_group_mentions(content)
+
 def render_markdown(message: Message,
                     content: Text,
                     realm: Optional[Realm]=None,
@@ -537,16 +629,37 @@ def render_markdown(message: Message,
     else:
         sent_by_bot = get_user_profile_by_id(message.sender_id).is_bot
 
-    # DO MAIN WORK HERE -- call bugdown to convert
-    rendered_content = bugdown.convert(
-        content,
-        message=message,
-        message_realm=realm,
-        possible_words=possible_words,
-        sent_by_bot=sent_by_bot,
-        mention_data=mention_data,
-        email_gateway=email_gateway
-    )
+    rendered_content = None  # type: Optional[Text]
+    cache_key = None  # type: Optional[Text]
+    if message is not None and sent_by_bot and can_cache_rendered_content(content):
+        assert realm is not None
+        cache_key = rendered_content_cache_key(realm.id, message.sender_id, content,
+                                               possible_words, bool(email_gateway))
+        cached = cache_get(cache_key)
+        if cached is not None:
+            (rendered_content, mentions_wildcard, alert_words, links_for_preview) = cached[0]
+            message.mentions_wildcard = mentions_wildcard
+            message.alert_words = set(alert_words)
+            message.links_for_preview = set(links_for_preview)
+            statsd.incr("render_cache.hit")
+        else:
+            statsd.incr("render_cache.miss")
+
+    if rendered_content is None:
+        # DO MAIN WORK HERE -- call bugdown to convert
+        rendered_content = bugdown.convert(
+            content,
+            message=message,
+            message_realm=realm,
+            possible_words=possible_words,
+            sent_by_bot=sent_by_bot,
+            mention_data=mention_data,
+            email_gateway=email_gateway
+        )
+        if cache_key is not None:
+            cache_set(cache_key, (rendered_content, message.mentions_wildcard,
+                                  list(message.alert_words), list(message.links_for_preview)),
+                      timeout=RENDERED_CONTENT_CACHE_TIMEOUT)
 
     if message is not None:
         message.user_ids_with_alert_words = set()
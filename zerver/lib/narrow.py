@@ -1,7 +1,8 @@
 from zerver.lib.request import JsonableError
 from django.utils.translation import ugettext as _
+from django.utils.lru_cache import lru_cache
 
-from typing import Any, Callable, Iterable, Mapping, Sequence, Text
+from typing import Any, Callable, Iterable, List, Mapping, Optional, Sequence, Text, Tuple
 
 
 def check_supported_events_narrow_filter(narrow: Iterable[Sequence[Text]]) -> None:
@@ -10,42 +11,67 @@ def check_supported_events_narrow_filter(narrow: Iterable[Sequence[Text]]) -> No
         if operator not in ["stream", "topic", "sender", "is"]:
             raise JsonableError(_("Operator %s not supported.") % (operator,))
 
-def build_narrow_filter(narrow: Iterable[Sequence[Text]]) -> Callable[[Mapping[str, Any]], bool]:
-    """Changes to this function should come with corresponding changes to
-    BuildNarrowFilterTest."""
-    check_supported_events_narrow_filter(narrow)
+NarrowCheck = Callable[[Mapping[str, Any], Iterable[str]], bool]
+
+def compile_narrow_element(operator: Text, operand: Text) -> Optional[NarrowCheck]:
+    """Returns a check of a single narrow element against a message and
+    its flags, or None if the element doesn't restrict anything."""
+    if operator == "stream":
+        stream = operand.lower()
+        return lambda message, flags: (message["type"] == "stream" and
+                                       message["display_recipient"].lower() == stream)
+    elif operator == "topic":
+        topic = operand.lower()
+        return lambda message, flags: (message["type"] == "stream" and
+                                       message["subject"].lower() == topic)
+    elif operator == "sender":
+        sender = operand.lower()
+        return lambda message, flags: message["sender_email"].lower() == sender
+    elif operator == "is" and operand == "private":
+        return lambda message, flags: message["type"] == "private"
+    elif operator == "is" and operand in ["starred"]:
+        return lambda message, flags: operand in flags
+    elif operator == "is" and operand == "unread":
+        return lambda message, flags: "read" not in flags
+    elif operator == "is" and operand in ["alerted", "mentioned"]:
+        return lambda message, flags: "mentioned" in flags
+    return None
+
+def accept_all(event: Mapping[str, Any]) -> bool:
+    return True
+
+@lru_cache(maxsize=1024)
+def compile_narrow_filter(narrow: Tuple[Tuple[Text, Text], ...]) -> Callable[[Mapping[str, Any]], bool]:
+    """Narrows are compiled once, when an event queue is registered, and
+    identical narrows (e.g. those of several bots or mirrors following
+    the same stream) share the compiled filter."""
+    checks = []  # type: List[NarrowCheck]
+    for (operator, operand) in narrow:
+        check = compile_narrow_element(operator, operand)
+        if check is not None:
+            checks.append(check)
+
+    if not checks:
+        return accept_all
+
+    if len(checks) == 1:
+        check = checks[0]
+
+        def single_narrow_filter(event: Mapping[str, Any]) -> bool:
+            return check(event["message"], event["flags"])
+        return single_narrow_filter
 
     def narrow_filter(event: Mapping[str, Any]) -> bool:
         message = event["message"]
         flags = event["flags"]
-        for element in narrow:
-            operator = element[0]
-            operand = element[1]
-            if operator == "stream":
-                if message["type"] != "stream":
-                    return False
-                if operand.lower() != message["display_recipient"].lower():
-                    return False
-            elif operator == "topic":
-                if message["type"] != "stream":
-                    return False
-                if operand.lower() != message["subject"].lower():
-                    return False
-            elif operator == "sender":
-                if operand.lower() != message["sender_email"].lower():
-                    return False
-            elif operator == "is" and operand == "private":
-                if message["type"] != "private":
-                    return False
-            elif operator == "is" and operand in ["starred"]:
-                if operand not in flags:
-                    return False
-            elif operator == "is" and operand == "unread":
-                if "read" in flags:
-                    return False
-            elif operator == "is" and operand in ["alerted", "mentioned"]:
-                if "mentioned" not in flags:
-                    return False
-
+        for check in checks:
+            if not check(message, flags):
+                return False
         return True
     return narrow_filter
+
+def build_narrow_filter(narrow: Iterable[Sequence[Text]]) -> Callable[[Mapping[str, Any]], bool]:
+    """Changes to this function should come with corresponding changes to
+    BuildNarrowFilterTest."""
+    check_supported_events_narrow_filter(narrow)
+    return compile_narrow_filter(tuple((element[0], element[1]) for element in narrow))
@@ -175,10 +175,14 @@ def is_ratelimited(entity: RateLimitedObject) -> Tuple[bool, float]:
     # No api calls recorded yet
     return False, 0.0
 
-def incr_ratelimit(entity: RateLimitedObject) -> None:
-    """Increases the rate-limit for the specified entity"""
+def incr_ratelimit(entity: RateLimitedObject, calls: int=1) -> None:
+    """Increases the rate-limit for the specified entity by `calls` API calls"""
     list_key, set_key, _ = entity.get_keys()
     now = time.time()
+    # The timestamps are also the members of the sorted set, so each
+    # call needs a distinct one; oldest first, so `now` ends up at the
+    # head of the list.
+    timestamps = [now - (calls - 1 - i) * 1e-6 for i in range(calls)]
 
     # If we have no rules, we don't store anything
     if len(rules) == 0:
@@ -195,26 +199,28 @@ def incr_ratelimit(entity: RateLimitedObject) -> None:
                 # When watching a value, the pipeline is set to Immediate mode
                 pipe.watch(list_key)
 
-                # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                last_val = pipe.lindex(list_key, max_api_calls(entity) - 1)
+                # Get the last elems that we'll trim (so we can remove them from our sorted set)
+                trimmed_vals = pipe.lrange(list_key, max_api_calls(entity) - calls,
+                                           max_api_calls(entity) - 1)
 
                 # Restart buffered execution
                 pipe.multi()
 
-                # Add this timestamp to our list
-                pipe.lpush(list_key, now)
+                # Add these timestamps to our list
+                pipe.lpush(list_key, *timestamps)
 
                 # Trim our list to the oldest rule we have
                 pipe.ltrim(list_key, 0, max_api_calls(entity) - 1)
 
-                # Add our new value to the sorted set that we keep
+                # Add our new values to the sorted set that we keep
                 # We need to put the score and val both as timestamp,
                 # as we sort by score but remove by value
-                pipe.zadd(set_key, now, now)
+                for timestamp in timestamps:
+                    pipe.zadd(set_key, timestamp, timestamp)
 
-                # Remove the trimmed value from our sorted set, if there was one
-                if last_val is not None:
-                    pipe.zrem(set_key, last_val)
+                # Remove the trimmed values from our sorted set, if there were any
+                if trimmed_vals:
+                    pipe.zrem(set_key, *trimmed_vals)
 
                 # Set the TTL for our keys as well
                 api_window = max_api_window(entity)
@@ -30,6 +30,43 @@ def json_method_not_allowed(methods: List[Text]) -> HttpResponseNotAllowed:
                                 "allowed_methods": methods}).encode()
     return resp
 
+class PreencodedDict(dict):
+    """A dict that is included in many responses (e.g. the payload of a
+    message event, which is delivered to every client of every
+    recipient), and so caches its JSON encoding.  It must not be
+    modified after it has been encoded; copying it yields a plain dict.
+    """
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.encoded = None  # type: Optional[str]
+
+    def to_json(self) -> str:
+        if self.encoded is None:
+            self.encoded = ujson.dumps(self)
+        return self.encoded
+
+def encode_event(event: Dict[str, Any]) -> str:
+    shared = [(key, value) for (key, value) in event.items()
+              if isinstance(value, PreencodedDict)]
+    if not shared:
+        return ujson.dumps(event)
+
+    rest = ujson.dumps({key: value for (key, value) in event.items()
+                        if not isinstance(value, PreencodedDict)})
+    spliced = ','.join(ujson.dumps(key) + ':' + value.to_json() for (key, value) in shared)
+    if rest == '{}':
+        return '{' + spliced + '}'
+    return rest[:-1] + ',' + spliced + '}'
+
+def encode_response_content(content: Dict[str, Any]) -> str:
+    if not isinstance(content.get('events'), list):
+        return ujson.dumps(content)
+    # Splice in the pre-encoded parts of the events, rather than
+    # re-encoding them for every client.
+    rest = ujson.dumps({key: value for (key, value) in content.items() if key != 'events'})
+    events = '"events":[' + ','.join(encode_event(event) for event in content['events']) + ']'
+    return rest[:-1] + ',' + events + '}'
+
 def json_response(res_type: Text="success",
                   msg: Text="",
                   data: Optional[Dict[str, Any]]=None,
@@ -37,7 +74,7 @@ def json_response(res_type: Text="success",
     content = {"result": res_type, "msg": msg}
     if data is not None:
         content.update(data)
-    return HttpResponse(content=ujson.dumps(content) + "\n",
+    return HttpResponse(content=encode_response_content(content) + "\n",
                         content_type='application/json', status=status)
 
 def json_success(data: Optional[Dict[str, Any]]=None) -> HttpResponse:
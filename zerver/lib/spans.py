@@ -0,0 +1,50 @@
+"""
+Lightweight tracing of where the time goes within a request.
+
+Code wraps the interesting stages of a slow code path (e.g. sending a
+message) in `with span(name):`; the time spent in each named span is
+accumulated on the current request (as `request._spans`), and the
+logging middleware prints the totals in the request's log line and
+sends them to statsd.
+"""
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from django.http import HttpRequest
+
+# The `_spans` dict of the request being processed, or None between
+# requests, while Tornado has a request suspended waiting for events,
+# and outside of requests (e.g. in queue workers), where spans aren't
+# recorded.  The logging middleware sets this when it starts handling
+# a request and clears it when it's done, so that a request never
+# records into (or leaks its spans into) another request's dict.
+current_spans = None  # type: Optional[Dict[str, float]]
+
+def start_span_recording(request: HttpRequest) -> None:
+    """Starts recording spans for the request, into `request._spans`."""
+    global current_spans
+    request._spans = OrderedDict()
+    current_spans = request._spans
+
+def stop_span_recording() -> None:
+    """Stops recording spans; the request's `_spans` are left as they are."""
+    global current_spans
+    current_spans = None
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Adds the time spent in the block to the named span of the current
+    request.  Spans with the same name (e.g. from a loop) accumulate."""
+    if current_spans is None:
+        yield
+        return
+
+    times = current_spans
+    start = time.time()
+    try:
+        yield
+    finally:
+        times[name] = times.get(name, 0) + time.time() - start
@@ -1,7 +1,12 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, Hashable, Optional, Tuple
+
 from django.db import connection
 from zerver.lib.db import TimeTrackingConnection
 
+import logging
 import sqlalchemy
+from sqlalchemy.sql.compiler import Compiled
 
 # This is a Pool that doesn't close connections.  Therefore it can be used with
 # existing Django database connections.
@@ -35,3 +40,71 @@ def get_sqlalchemy_connection() -> sqlalchemy.engine.base.Connection:
     sa_connection = sqlalchemy_engine.connect()
     sa_connection.execution_options(autocommit=False)
     return sa_connection
+
+# Compiled SQLAlchemy queries, keyed by the "shape" of the query (see
+# get_query_template), most recently used last.  Each entry is the
+# Compiled query along with the names of its named bound parameters;
+# or None if the query can't be used as a template.
+QUERY_TEMPLATE_CACHE_SIZE = 500
+QueryTemplate = Tuple[Compiled, FrozenSet[str]]
+query_template_cache = OrderedDict()  # type: OrderedDict[Hashable, Optional[QueryTemplate]]
+
+def get_named_params(compiled: Compiled) -> FrozenSet[str]:
+    """Returns the names of the compiled query's named bound parameters
+    (those created with `bindparam` and a key), as opposed to anonymous
+    ones (e.g. from `literal`, or comparing a column to a value)."""
+    return frozenset(name for (name, bind_param) in compiled.binds.items()
+                     if not bind_param.unique)
+
+def get_query_template(sa_conn: sqlalchemy.engine.base.Connection,
+                       shape: Optional[Hashable], params: Dict[str, Any],
+                       build_query: Callable[[], Any]) -> Compiled:
+    """Returns the compiled query for a query of the given shape, to be
+    filled in with the given values of its named bound parameters.
+
+    Queries with the same shape compile to the same SQL, so we only
+    build a query (with build_query) and compile it the first time we
+    see its shape.  The caller is responsible for the shape capturing
+    everything that affects the SQL other than the values of the bound
+    parameters, and for any value which can differ between queries of
+    the same shape being a `bindparam` with a key of its own, whose
+    value is in `params`; anonymous parameters keep the values they
+    had in the first query.  Queries with a shape of None aren't cached.
+    """
+    if shape is not None and shape in query_template_cache:
+        query_template_cache.move_to_end(shape)
+        template = query_template_cache[shape]
+        if template is not None:
+            (compiled, names) = template
+            if names == frozenset(params):
+                return compiled
+            # This shouldn't happen, since queries with the same shape
+            # have the same parameters; but if it does, the template
+            # isn't for this query.
+            logging.warning("Query template for shape %s doesn't match query" % (shape,))
+        return build_query().compile(dialect=sa_conn.dialect)
+
+    compiled = build_query().compile(dialect=sa_conn.dialect)
+    if shape is None:
+        return compiled
+
+    names = get_named_params(compiled)
+    if names == frozenset(params):
+        query_template_cache[shape] = (compiled, names)
+    else:
+        # We wouldn't be able to fill in every parameter that can
+        # differ for another query of the same shape.
+        logging.warning("Query for shape %s has parameters %s, not %s" % (
+            shape, sorted(names), sorted(params)))
+        query_template_cache[shape] = None
+    while len(query_template_cache) > QUERY_TEMPLATE_CACHE_SIZE:
+        query_template_cache.popitem(last=False)
+    return compiled
+
+def execute_query_template(sa_conn: sqlalchemy.engine.base.Connection,
+                           shape: Optional[Hashable], params: Dict[str, Any],
+                           build_query: Callable[[], Any]) -> Any:
+    """Executes the query with the given shape and named parameters; see
+    get_query_template."""
+    compiled = get_query_template(sa_conn, shape, params, build_query)
+    return sa_conn.execute(compiled, params)
@@ -1,7 +1,9 @@
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List, Tuple
 from mypy_extensions import TypedDict
 
 from django.db.models.query import QuerySet
+from zerver.lib.cache import cache_with_key, stream_recipient_info_cache_key, \
+    stream_recipient_info_user_fields
 from zerver.models import (
     Recipient,
     Stream,
@@ -70,6 +72,38 @@ def get_bulk_stream_subscriber_info(
 
     return result
 
+StreamRecipientInfo = TypedDict('StreamRecipientInfo', {
+    'subscription_rows': List[Dict[str, Any]],
+    'user_rows': List[Dict[str, Any]],
+})
+
+@cache_with_key(stream_recipient_info_cache_key, timeout=3600*24*7)
+def get_stream_recipient_info(stream_id: int) -> StreamRecipientInfo:
+    '''
+    The subscription and user data that get_recipient_info needs to
+    send a message to a stream.  Subscriber sets change far less
+    often than messages are sent, so we cache this; the cache is
+    flushed when a subscription to the stream or one of the
+    stream_recipient_info_user_fields of a subscriber changes.
+    '''
+    subscription_rows = get_active_subscriptions_for_stream_id(stream_id).values(
+        'user_profile_id',
+        'push_notifications',
+        'in_home_view',
+    ).order_by('user_profile_id')
+
+    user_rows = UserProfile.objects.filter(
+        is_active=True,
+        subscription__recipient__type=Recipient.STREAM,
+        subscription__recipient__type_id=stream_id,
+        subscription__active=True,
+    ).values(*stream_recipient_info_user_fields)
+
+    return dict(
+        subscription_rows=list(subscription_rows),
+        user_rows=list(user_rows),
+    )
+
 def num_subscribers_for_stream_id(stream_id: int) -> int:
     return get_active_subscriptions_for_stream_id(stream_id).filter(
         user_profile__is_active=True,
@@ -18,7 +18,7 @@ from django.db.utils import IntegrityError
 import zerver.lib.upload
 from zerver.lib.upload import S3UploadBackend, LocalUploadBackend
 from zerver.lib.avatar import avatar_url
-from zerver.lib.cache import get_cache_backend
+from zerver.lib.cache import get_cache_backend, message_dict_lru
 from zerver.lib.initial_password import initial_password
 from zerver.lib.db import TimeTrackingCursor
 from zerver.lib import cache
@@ -106,6 +106,23 @@ def tornado_redirected_to_list(lst: List[Mapping[str, Any]]) -> Iterator[None]:
     yield
     event_queue.process_notification = real_event_queue_process_notification
 
+def allocate_test_client_descriptor(user_profile: UserProfile,
+                                    event_types: Optional[List[str]]=None
+                                    ) -> event_queue.ClientDescriptor:
+    """Allocates an event queue for the user, like a web app client's."""
+    return event_queue.allocate_client_descriptor(dict(
+        all_public_streams=False,
+        apply_markdown=True,
+        client_gravatar=True,
+        client_type_name='website',
+        event_types=event_types,
+        last_connection_time=time.time(),
+        queue_timeout=0,
+        realm_id=user_profile.realm_id,
+        user_profile_id=user_profile.id,
+        user_profile_email=user_profile.email,
+    ))
+
 @contextmanager
 def simulated_empty_cache() -> Generator[
         List[Tuple[str, Union[Text, List[Text]], Text]], None, None]:
@@ -144,6 +161,7 @@ def queries_captured(include_savepoints: Optional[bool]=False) -> Generator[
                         params: Iterable[Any]=()) -> None:
         cache = get_cache_backend(None)
         cache.clear()
+        message_dict_lru.clear()
         start = time.time()
         try:
             return action(sql, params)
@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from collections import defaultdict
 from django.db import transaction
 from django.utils.translation import ugettext as _
+from zerver.lib.cache import flush_realm_mention_data
 from zerver.lib.exceptions import JsonableError
 from zerver.models import UserProfile, Realm, UserGroupMembership, UserGroup
 from typing import Dict, Iterable, List, Text, Tuple, Any
@@ -72,6 +73,8 @@ def create_user_group(name: Text, members: List[UserProfile], realm: Realm,
             UserGroupMembership(user_profile=member, user_group=user_group)
             for member in members
         ])
+        # bulk_create doesn't send the signal that does this.
+        flush_realm_mention_data(realm.id, ['user_groups'])
         return user_group
 
 def get_memberships_of_users(user_group: UserGroup, members: List[UserProfile]) -> List[int]:
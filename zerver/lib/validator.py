@@ -92,6 +92,7 @@ def check_list(sub_validator: Optional[Validator], length: Optional[int]=None) -
 
 def check_dict(required_keys: Iterable[Tuple[str, Validator]]=[],
                value_validator: Validator=None,
+               optional_keys: Iterable[Tuple[str, Validator]]=[],
                _allow_only_listed_keys: bool=False) -> Validator:
     def f(var_name: str, val: object) -> Optional[str]:
         if not isinstance(val, dict):
@@ -106,6 +107,13 @@ def check_dict(required_keys: Iterable[Tuple[str, Validator]]=[],
             if error:
                 return error
 
+        for k, sub_validator in optional_keys:
+            if k in val:
+                vname = '%s["%s"]' % (var_name, k)
+                error = sub_validator(vname, val[k])
+                if error:
+                    return error
+
         if value_validator:
             for key in val:
                 vname = '%s contains a value that' % (var_name,)
@@ -114,7 +122,8 @@ def check_dict(required_keys: Iterable[Tuple[str, Validator]]=[],
                     return error
 
         if _allow_only_listed_keys:
-            delta_keys = set(val.keys()) - set(x[0] for x in required_keys)
+            delta_keys = (set(val.keys()) - set(x[0] for x in required_keys) -
+                          set(x[0] for x in optional_keys))
             if len(delta_keys) != 0:
                 return _("Unexpected arguments: %s" % (", ".join(list(delta_keys))))
 
@@ -20,6 +20,8 @@ from zerver.tornado.event_queue import add_client_gc_hook, \
 # zerver.lib.queue (which will instantiate the Tornado ioloop) before
 # this.
 from zerver.tornado.ioloop_logging import instrument_tornado_ioloop
+from zerver.tornado.sharding import get_shard_for_port, notify_tornado_queue_name, \
+    set_current_shard, tornado_return_queue_name
 from zerver.tornado.socket import respond_send_message
 
 settings.RUNNING_INSIDE_TORNADO = True
@@ -66,6 +68,13 @@ class Command(BaseCommand):
         if not port.isdigit():
             raise CommandError("%r is not a valid port number." % (port,))
 
+        try:
+            shard = get_shard_for_port(int(port))
+        except ValueError:
+            raise CommandError("Port %s is not one of TORNADO_PORTS %r." %
+                               (port, settings.TORNADO_PORTS))
+        set_current_shard(shard)
+
         xheaders = options.get('xheaders', True)
         no_keep_alive = options.get('no_keep_alive', False)
         quit_command = 'CTRL-C'
@@ -88,8 +97,10 @@ class Command(BaseCommand):
             if settings.USING_RABBITMQ:
                 queue_client = get_queue_client()
                 # Process notifications received via RabbitMQ
-                queue_client.register_json_consumer('notify_tornado', process_notification)
-                queue_client.register_json_consumer('tornado_return', respond_send_message)
+                queue_client.register_json_consumer(notify_tornado_queue_name(shard),
+                                                    process_notification)
+                queue_client.register_json_consumer(tornado_return_queue_name(shard),
+                                                    respond_send_message)
 
             try:
                 # Application is an instance of Django's standard wsgi handler.
@@ -24,6 +24,7 @@ from zerver.lib.debug import maybe_tracemalloc_listen
 from zerver.lib.exceptions import ErrorCode, JsonableError, RateLimited
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.response import json_error, json_response_from_error
+from zerver.lib.spans import start_span_recording, stop_span_recording
 from zerver.lib.subdomains import get_subdomain
 from zerver.lib.utils import statsd
 from zerver.models import Realm, flush_per_request_caches, get_realm
@@ -41,6 +42,9 @@ def record_request_stop_data(log_data: MutableMapping[str, Any]) -> None:
 
 def async_request_stop(request: HttpRequest) -> None:
     record_request_stop_data(request._log_data)
+    # Whatever Tornado does while this request waits for events isn't
+    # part of it; see zerver/lib/spans.py.
+    stop_span_recording()
 
 def record_request_restart_data(log_data: MutableMapping[str, Any]) -> None:
     if settings.PROFILE_ALL_REQUESTS:
@@ -167,6 +171,18 @@ def write_log_line(log_data: MutableMapping[str, Any], path: Text, method: str,
                 statsd.timing("%s.markdown.time" % (statsd_path,), timedelta_ms(bugdown_time_delta))
                 statsd.incr("%s.markdown.count" % (statsd_path,), bugdown_count_delta)
 
+    # Break down the time spent in any spans the request recorded, in
+    # the order they first ran (see zerver/lib/spans.py).
+    span_output = ""
+    if log_data.get('span_times'):
+        span_output = " (%s)" % (" ".join(
+            "%s: %s" % (name, format_timedelta(span_time))
+            for name, span_time in log_data['span_times'].items()),)
+
+        if not suppress_statsd:
+            for name, span_time in log_data['span_times'].items():
+                statsd.timing("%s.span.%s" % (statsd_path, name), timedelta_ms(span_time))
+
     # Get the amount of time spent doing database queries
     db_time_output = ""
     queries = connection.connection.queries if connection.connection is not None else []
@@ -186,9 +202,9 @@ def write_log_line(log_data: MutableMapping[str, Any], path: Text, method: str,
     else:
         extra_request_data = ""
     logger_client = "(%s via %s)" % (email, client_name)
-    logger_timing = ('%5s%s%s%s%s%s %s' %
+    logger_timing = ('%5s%s%s%s%s%s%s %s' %
                      (format_timedelta(time_delta), optional_orig_delta,
-                      remote_cache_output, bugdown_output,
+                      remote_cache_output, bugdown_output, span_output,
                       db_time_output, startup_output, path))
     logger_line = ('%-15s %-7s %3d %s%s %s' %
                    (remote_ip, method, status_code,
@@ -228,6 +244,7 @@ class LogRequests(MiddlewareMixin):
         maybe_tracemalloc_listen()
         request._log_data = dict()
         record_request_start_data(request._log_data)
+        start_span_recording(request)
         if connection.connection is not None:
             connection.connection.queries = []
 
@@ -241,6 +258,7 @@ class LogRequests(MiddlewareMixin):
         # And then completely reset our tracking to only cover work
         # done as part of this request
         record_request_start_data(request._log_data)
+        start_span_recording(request)
         if connection.connection is not None:
             connection.connection.queries = []
 
@@ -268,9 +286,14 @@ class LogRequests(MiddlewareMixin):
             content = response.content
             content_iter = None
 
-        write_log_line(request._log_data, request.path, request.method,
-                       remote_ip, email, client, status_code=response.status_code,
-                       error_content=content, error_content_iter=content_iter)
+        try:
+            request._log_data['span_times'] = getattr(request, '_spans', None)
+            write_log_line(request._log_data, request.path, request.method,
+                           remote_ip, email, client, status_code=response.status_code,
+                           error_content=content, error_content_iter=content_iter)
+        finally:
+            stop_span_recording()
+            request._spans = None
         return response
 
 class JsonErrorHandler(MiddlewareMixin):
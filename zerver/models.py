@@ -22,7 +22,8 @@ from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     display_recipient_cache_key, cache_delete, active_user_ids_cache_key, \
     get_stream_cache_key, realm_user_dicts_cache_key, \
     bot_dicts_in_realm_cache_key, realm_user_dict_fields, \
-    bot_dict_fields, flush_message, bot_profile_cache_key
+    bot_dict_fields, flush_message, bot_profile_cache_key, flush_subscription, \
+    flush_user_group
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from django.db import transaction
 from django.utils.timezone import now as timezone_now
@@ -769,6 +770,11 @@ class UserGroupMembership(models.Model):
     class Meta:
         unique_together = (('user_group', 'user_profile'),)
 
+post_save.connect(flush_user_group, sender=UserGroup)
+post_delete.connect(flush_user_group, sender=UserGroup)
+post_save.connect(flush_user_group, sender=UserGroupMembership)
+post_delete.connect(flush_user_group, sender=UserGroupMembership)
+
 def receives_offline_push_notifications(user_profile: UserProfile) -> bool:
     return (user_profile.enable_offline_push_notifications and
             not user_profile.is_bot)
@@ -1032,6 +1038,14 @@ def get_recipient_cache_key(type: int, type_id: int) -> Text:
 def get_recipient(type: int, type_id: int) -> Recipient:
     return Recipient.objects.get(type_id=type_id, type=type)
 
+def get_recipient_by_id_cache_key(recipient_id: int) -> Text:
+    return u"%s:get_recipient_by_id:%s" % (cache.KEY_PREFIX, recipient_id,)
+
+# Recipient rows never change, so this needs no invalidation.
+@cache_with_key(get_recipient_by_id_cache_key, timeout=3600*24*7)
+def get_recipient_by_id(recipient_id: int) -> Recipient:
+    return Recipient.objects.get(id=recipient_id)
+
 def get_stream_recipient(stream_id: int) -> Recipient:
     return get_recipient(Recipient.STREAM, stream_id)
 
@@ -1213,6 +1227,15 @@ def get_context_for_message(message):
 
 post_save.connect(flush_message, sender=Message)
 
+# A message sent with defer_fanout whose fanout (see
+# do_fan_out_message) hasn't finished yet.  It's created in the same
+# transaction as the message, and deleted once the message has been
+# delivered, so that, unlike a cache, it can't be lost or expire while
+# the message_fanout queue is backed up; see
+# get_pending_deferred_fanouts.
+class PendingMessageFanout(models.Model):
+    message = models.OneToOneField(Message, on_delete=CASCADE)  # type: Message
+
 class Reaction(models.Model):
     user_profile = models.ForeignKey(UserProfile, on_delete=CASCADE)  # type: UserProfile
     message = models.ForeignKey(Message, on_delete=CASCADE)  # type: Message
@@ -1401,6 +1424,9 @@ class Subscription(models.Model):
     def __str__(self) -> Text:
         return "<Subscription: %s -> %s>" % (self.user_profile, self.recipient)
 
+post_save.connect(flush_subscription, sender=Subscription)
+post_delete.connect(flush_subscription, sender=Subscription)
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7)
 def get_user_profile_by_id(uid: int) -> UserProfile:
     return UserProfile.objects.select_related().get(id=uid)
@@ -4,6 +4,8 @@ from django.test import TestCase, override_settings
 
 from zerver.lib import bugdown
 from zerver.lib.actions import (
+    bulk_add_members_to_user_group,
+    do_change_full_name,
     do_remove_realm_emoji,
     do_set_alert_words,
     get_realm,
@@ -21,6 +23,9 @@ from zerver.lib.user_groups import create_user_group
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
+from zerver.lib.cache import cache_delete, cache_get_many, \
+    realm_mention_data_generation_cache_key, realm_mention_user_change_cache_key
+from zerver.lib.test_helpers import queries_captured
 from zerver.lib.test_runner import slow
 from zerver.lib import mdiff
 from zerver.models import (
@@ -213,6 +218,73 @@ class BugdownMiscTest(ZulipTestCase):
         user = mention_data.get_user('king hamLET')
         self.assertEqual(user['email'], hamlet.email)
 
+    def test_mention_data_cache(self) -> None:
+        realm = get_realm('zulip')
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        user_group = create_user_group('support', [hamlet], realm)
+        content = '@**King Hamlet** @*support*'
+
+        mention_data = bugdown.MentionData(realm.id, content)
+        self.assertEqual(mention_data.get_user_ids(), {hamlet.id})
+        self.assertEqual(mention_data.get_group_members(user_group.id), [hamlet.id])
+
+        # Once a realm's index is built, mentions need no queries.
+        with queries_captured() as queries:
+            bugdown.MentionData(realm.id, content)
+        self.assert_length(queries, 0)
+
+        # Names missing from the index, e.g. of new users, are looked up.
+        content += ' @**Prince Hamlet**'
+        with queries_captured() as queries:
+            mention_data = bugdown.MentionData(realm.id, content)
+        self.assert_length(queries, 1)
+        self.assertEqual(mention_data.get_user_ids(), {hamlet.id})
+
+        # Changes to users and user groups are picked up.  A renamed
+        # user is reloaded on their own, not with the rest of the realm.
+        do_change_full_name(cordelia, 'Prince Hamlet', cordelia)
+        with queries_captured() as queries:
+            mention_data = bugdown.MentionData(realm.id, content)
+        self.assert_length(queries, 1)
+        self.assertEqual(mention_data.get_user_ids(), {hamlet.id, cordelia.id})
+        mention_data = bugdown.MentionData(realm.id, '@**Cordelia Lear**')
+        self.assertEqual(mention_data.get_user_ids(), set())
+
+        # If the changes can't be found (e.g. they were evicted), all of
+        # the users are reloaded.
+        users_key = realm_mention_data_generation_cache_key(realm.id, 'users')
+        do_change_full_name(cordelia, 'Cordelia Lear', cordelia)
+        change = cache_get_many([users_key])[users_key]
+        cache_delete(realm_mention_user_change_cache_key(realm.id, change))
+        index = bugdown.realm_mention_indexes[realm.id]
+        with mock.patch.object(index, 'load_users', wraps=index.load_users) as load_users:
+            mention_data = bugdown.MentionData(realm.id, '@**Cordelia Lear**')
+        load_users.assert_called_once()
+        self.assertEqual(mention_data.get_user_ids(), {cordelia.id})
+
+
+        bulk_add_members_to_user_group(user_group, [othello])
+        with queries_captured() as queries:
+            mention_data = bugdown.MentionData(realm.id, content)
+        self.assert_length(queries, 2)
+        self.assertEqual(set(mention_data.get_group_members(user_group.id)),
+                         {hamlet.id, othello.id})
+
+        # Saves that don't name the mentionable fields don't reload anything.
+        othello.save()
+        with queries_captured() as queries:
+            bugdown.MentionData(realm.id, content)
+        self.assert_length(queries, 0)
+
+        # Content without mentions never needs the index.
+        bugdown.realm_mention_indexes.clear()
+        with queries_captured() as queries:
+            mention_data = bugdown.MentionData(realm.id, 'no mentions here')
+        self.assert_length(queries, 0)
+        self.assertEqual(mention_data.get_user_ids(), set())
+
 class BugdownTest(ZulipTestCase):
     def assertEqual(self, first: Any, second: Any, msg: Text = "") -> None:
         if isinstance(first, Text) and isinstance(second, Text):
@@ -546,6 +546,21 @@ class ValidatorTestCase(TestCase):
         error = check_dict_only(keys)('x', x)
         self.assertEqual(error, 'Unexpected arguments: state')
 
+        # test optional keys
+        optional_keys = [
+            ('state', check_string),
+        ]  # type: List[Tuple[str, Validator]]
+        error = check_dict(keys, optional_keys=optional_keys, _allow_only_listed_keys=True)('x', x)
+        self.assertEqual(error, None)
+
+        del x['state']
+        error = check_dict(keys, optional_keys=optional_keys)('x', x)
+        self.assertEqual(error, None)
+
+        x['state'] = 5
+        error = check_dict(keys, optional_keys=optional_keys)('x', x)
+        self.assertEqual(error, 'x["state"] is not a string')
+
     def test_encapsulation(self) -> None:
         # There might be situations where we want deep
         # validation, but the error message should be customized.
@@ -57,6 +57,7 @@ class DocPageTest(ZulipTestCase):
         self._test('/api/private-message', 'steal away your hearts')
         self._test('/api/stream-message', 'rotten in the state of Denmark')
         self._test('/api/render-message', '**foo**')
+        self._test('/api/send-messages-bulk', 'meant for bridges and importers')
         self._test('/api/get-all-streams', 'include_public')
         self._test('/api/get-stream-id', 'The name of the stream to retrieve the ID for.')
         self._test('/api/get-subscribed-streams', 'Get all streams that the user is subscribed to.')
@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
-from typing import Any, Callable, Dict, List, Optional, Set, Text, Tuple, Union
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Text, Tuple, Union
 import os
 import shutil
 import sys
+import tempfile
 
 from django.conf import settings
 from django.http import HttpRequest, HttpResponse
@@ -90,6 +91,11 @@ from zerver.lib.events import (
     apply_events,
     fetch_initial_state_data,
 )
+from zerver.lib.response import (
+    PreencodedDict,
+    encode_event,
+    encode_response_content,
+)
 from zerver.lib.message import (
     aggregate_unread_data,
     get_raw_unread_data,
@@ -97,7 +103,8 @@ from zerver.lib.message import (
     UnreadMessagesResult,
 )
 from zerver.lib.test_helpers import POSTRequestMock, get_subscription, \
-    stub_event_queue_user_events, queries_captured
+    stub_event_queue_user_events, queries_captured, tornado_redirected_to_list, \
+    allocate_test_client_descriptor
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
@@ -114,12 +121,27 @@ from zerver.views.events_register import _default_all_public_streams, _default_n
 from zerver.views.users import add_service
 
 from zerver.tornado.event_queue import (
+    add_event_to_clients,
     allocate_client_descriptor,
+    batch_events,
     clear_client_event_queues_for_testing,
+    dump_event_queues,
+    estimate_event_size,
+    fetch_events,
+    flush_event_queue_journal,
+    gc_event_queues,
+    get_client_descriptors_for_user_event_type,
+    get_client_descriptor,
+    load_event_queues,
     get_client_info_for_message_event,
     process_message_event,
+    process_notification,
+    send_event,
     EventQueue,
+    EVENT_QUEUE_GC_FREQ_MSECS,
+    IDLE_EVENT_QUEUE_TIMEOUT_SECS,
 )
+from zerver.tornado.stats import clear_stats_for_testing, merge_stats
 from zerver.tornado.views import get_events_backend
 
 from collections import OrderedDict
@@ -150,6 +172,33 @@ class LogEventsTest(ZulipTestCase):
 
 
 class EventsEndpointTest(ZulipTestCase):
+    def test_tornado_stats_endpoint(self) -> None:
+        clear_stats_for_testing()
+        hamlet = self.example_user('hamlet')
+        process_notification(dict(event=dict(type='presence'), users=[hamlet.id]))
+
+        result = self.api_get(hamlet.email, '/json/tornado/stats')
+        self.assert_json_error(result, "Must be a server administrator")
+
+        hamlet.is_staff = True
+        hamlet.save(update_fields=['is_staff'])
+        result = self.api_get(hamlet.email, '/json/tornado/stats')
+        self.assert_json_success(result)
+        stats = result.json()['stats']
+        self.assertEqual(stats['fanout_clients.presence']['count'], 1)
+        self.assertEqual(stats['fanout_time.presence']['count'], 1)
+
+    def test_merge_tornado_stats(self) -> None:
+        shard_stats = [
+            dict(response_bytes=dict(count=2, mean=3.0, max=4, buckets=[[2, 1], [4, 1]])),
+            dict(response_bytes=dict(count=2, mean=5.0, max=2 ** 30, buckets=[[4, 1], [None, 1]]),
+                 wakeup_latency=dict(count=1, mean=1.0, max=1, buckets=[[1, 1]])),
+        ]
+        self.assertEqual(merge_stats(shard_stats), dict(
+            response_bytes=dict(count=4, mean=4.0, max=2 ** 30,
+                                buckets=[[2, 1], [4, 2], [None, 1]]),
+            wakeup_latency=dict(count=1, mean=1.0, max=1, buckets=[[1, 1]])))
+
     def test_events_register_endpoint(self) -> None:
 
         # This test is intended to get minimal coverage on the
@@ -2223,6 +2272,46 @@ class GetUnreadMsgsTest(ZulipTestCase):
         self.assertEqual(result['mentions'], [stream_message_id])
 
 class EventQueueTest(TestCase):
+    def test_size_accounting(self) -> None:
+        queue = EventQueue("1")
+        queue.push({"type": "unknown", "value": 1})
+        queue.push({"type": "pointer", "pointer": 1})
+        queue.push({"type": "unknown", "value": 2})
+        self.assertEqual(queue.size, sum(queue.sizes))
+        self.assertEqual(len(queue.sizes), 2)
+        queue.contents()
+        self.assertEqual(len(queue.sizes), 3)
+        self.assertEqual(queue.size, sum(queue.sizes))
+        queue.prune(1)
+        self.assertEqual(len(queue.sizes), 1)
+        self.assertEqual(queue.size, sum(queue.sizes))
+
+    def test_overflow(self) -> None:
+        queue = EventQueue("1")
+        with mock.patch('zerver.tornado.event_queue.EVENT_QUEUE_MAX_BYTES', 100):
+            for i in range(10):
+                queue.push({"type": "unknown", "value": i})
+        self.assertTrue(queue.overflowed)
+        self.assertTrue(queue.empty())
+        self.assertEqual(queue.size, 0)
+        queue.push({"type": "unknown"})
+        self.assertTrue(queue.empty())
+
+    def test_estimate_event_size(self) -> None:
+        message = PreencodedDict(id=5, content='<p>hello</p>', subject='lunch')
+        event = dict(type='message', message=message, flags=['read', 'mentioned'])
+        self.assertIsNone(message.encoded)
+        estimate = estimate_event_size(event)
+        # The shared payload is encoded once, and reused when sending.
+        self.assertIsNotNone(message.encoded)
+        actual = len(encode_event(event))
+        self.assertTrue(actual / 2 <= estimate <= actual * 2)
+
+        event = dict(type='update_message_flags', operation='add', flag='read',
+                     messages=list(range(1000000, 1001000)), all=False)
+        actual = len(encode_event(event))
+        self.assertTrue(actual / 2 <= estimate_event_size(event) <= actual * 2)
+
     def test_one_event(self) -> None:
         queue = EventQueue("1")
         queue.push({"type": "pointer",
@@ -2351,7 +2440,94 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+class EventQueueGCTest(ZulipTestCase):
+    def test_gc_only_expired_queues(self) -> None:
+        hamlet = self.example_user('hamlet')
+        clear_client_event_queues_for_testing()
+
+        idle_queue_id = allocate_test_client_descriptor(hamlet).event_queue.id
+        active_queue_id = allocate_test_client_descriptor(hamlet).event_queue.id
+        # The active client reconnected after its queue was created.
+        get_client_descriptor(active_queue_id).last_connection_time += 100
+
+        now = time.time() + IDLE_EVENT_QUEUE_TIMEOUT_SECS + 1
+        with mock.patch('zerver.tornado.event_queue.time.time', return_value=now):
+            gc_event_queues()
+        self.assertIsNone(get_client_descriptor(idle_queue_id))
+        self.assertIsNotNone(get_client_descriptor(active_queue_id))
+
+        # It's checked again on the next GC pass.
+        now += EVENT_QUEUE_GC_FREQ_MSECS / 1000
+        with mock.patch('zerver.tornado.event_queue.time.time', return_value=now):
+            gc_event_queues()
+        self.assertIsNone(get_client_descriptor(active_queue_id))
+        clear_client_event_queues_for_testing()
+
+class PreencodedResponseTest(TestCase):
+    def test_encode_response_content(self) -> None:
+        message = PreencodedDict(id=5, content='<p>hello</p>')
+        content = dict(result='success', msg='', queue_id='1:2',
+                       events=[dict(type='message', message=message, flags=['read'], id=0),
+                               dict(type='heartbeat', id=1),
+                               dict(message=message)])
+        self.assertEqual(ujson.loads(encode_response_content(content)),
+                         ujson.loads(ujson.dumps(content)))
+        # The shared payload was only encoded once
+        self.assertEqual(message.encoded, ujson.dumps(message))
+        self.assertEqual(type(message.copy()), dict)
+
+        content = dict(result='success', msg='')
+        self.assertEqual(encode_response_content(content), ujson.dumps(content))
+
 class ClientDescriptorsTest(ZulipTestCase):
+    def test_coalescing_window(self) -> None:
+        hamlet = self.example_user('hamlet')
+        clear_client_event_queues_for_testing()
+        client = allocate_test_client_descriptor(hamlet)
+        client.current_handler_id = 17
+
+        with self.settings(EVENT_QUEUE_COALESCING_WINDOW_MSECS={'website': 20}), \
+                mock.patch('zerver.tornado.event_queue.get_handler_by_id'), \
+                mock.patch('zerver.tornado.event_queue.async_request_restart'), \
+                mock.patch('zerver.tornado.event_queue.clear_descriptor_by_handler_id'), \
+                mock.patch('zerver.tornado.event_queue.clear_handler_by_id'), \
+                mock.patch('zerver.tornado.event_queue.finish_handler') as finish, \
+                mock.patch('tornado.ioloop.IOLoop.instance') as ioloop:
+            client.add_event(dict(type='typing', op='start'))
+            client.add_event(dict(type='typing', op='stop'))
+            finish.assert_not_called()
+            ioloop().call_later.assert_called_once_with(0.02, client.finish_coalesced_handler)
+
+            client.finish_coalesced_handler()
+            finish.assert_called_once()
+            self.assertEqual([event['op'] for event in finish.call_args[0][2]],
+                             ['start', 'stop'])
+            self.assertIsNone(client.current_handler_id)
+        clear_client_event_queues_for_testing()
+
+    def test_event_type_index(self) -> None:
+        hamlet = self.example_user('hamlet')
+        clear_client_event_queues_for_testing()
+
+        message_client = allocate_test_client_descriptor(hamlet, ['message'])
+        all_client = allocate_test_client_descriptor(hamlet)
+        self.assertEqual(get_client_descriptors_for_user_event_type(hamlet.id, 'message'),
+                         [message_client, all_client])
+        self.assertEqual(get_client_descriptors_for_user_event_type(hamlet.id, 'typing'),
+                         [all_client])
+
+        # The index is updated as queues come and go.
+        typing_client = allocate_test_client_descriptor(hamlet, ['typing'])
+        self.assertEqual(get_client_descriptors_for_user_event_type(hamlet.id, 'typing'),
+                         [all_client, typing_client])
+        all_client.cleanup()
+        self.assertEqual(get_client_descriptors_for_user_event_type(hamlet.id, 'typing'),
+                         [typing_client])
+        self.assertEqual(get_client_descriptors_for_user_event_type(self.example_user('othello').id,
+                                                                    'typing'),
+                         [])
+        clear_client_event_queues_for_testing()
+
     def test_get_client_info_for_all_public_streams(self) -> None:
         hamlet = self.example_user('hamlet')
         realm = hamlet.realm
@@ -2635,6 +2811,210 @@ class ClientDescriptorsTest(ZulipTestCase):
             ),
         ])
 
+class EventQueueJournalTest(ZulipTestCase):
+    def test_journal_replay(self) -> None:
+        hamlet = self.example_user('hamlet')
+        clear_client_event_queues_for_testing()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        with self.settings(JSON_PERSISTENT_QUEUE_FILENAME=os.path.join(tmp_dir, 'queues.json'),
+                           JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME=os.path.join(tmp_dir, 'queues.journal')), \
+                mock.patch('zerver.tornado.event_queue.journal_enabled', True):
+            client = allocate_test_client_descriptor(hamlet)
+            other_client = allocate_test_client_descriptor(hamlet)
+            queue_id = client.event_queue.id
+            add_event_to_clients(dict(type='unknown', value=0), [client])
+            add_event_to_clients(dict(type='pointer', pointer=5), [client])
+            dump_event_queues()
+
+            # Everything after the snapshot only exists in the journal.
+            add_event_to_clients(dict(type='unknown', value=2), [client, other_client])
+            add_event_to_clients(dict(type='pointer', pointer=7), [client])
+            add_event_to_clients(dict(type='unknown', value=4), [client])
+            with open(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME) as journal:
+                journal_size = len(journal.read())
+            flush_event_queue_journal()
+            with open(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME) as journal:
+                records = [ujson.loads(line) for line in journal.read()[journal_size:].splitlines()]
+            # An event is journaled once for all of the queues it was added to.
+            self.assertEqual(records[0], ['event', [queue_id, other_client.event_queue.id],
+                                          dict(type='unknown', value=2)])
+
+            # Connecting and acknowledging events are journaled as the
+            # queue's latest state when the journal is flushed.
+            fetch_events(dict(queue_id=queue_id, dont_block=True, last_event_id=2,
+                              user_profile_id=hamlet.id, new_queue_data=None,
+                              user_profile_email=hamlet.email, client_type_name='website',
+                              handler_id=1))
+            flush_event_queue_journal()
+            with open(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME) as journal:
+                self.assertEqual(ujson.loads(journal.read().splitlines()[-1]),
+                                 ['state', queue_id, dict(pruned_through=2)])
+
+            clear_client_event_queues_for_testing()
+            load_event_queues()
+            restored = get_client_descriptor(queue_id)
+            self.assertEqual(restored.event_queue.contents(),
+                             [dict(type='pointer', pointer=7, id=3),
+                              dict(type='unknown', value=4, id=4)])
+            self.assertEqual(get_client_descriptor(other_client.event_queue.id).event_queue.contents(),
+                             [dict(type='unknown', value=2, id=0)])
+
+            # Loading carries on with the journal it replayed rather than
+            # writing a new snapshot, dropping a torn final record so that
+            # it doesn't hide what's journaled after it.
+            with open(settings.JSON_PERSISTENT_QUEUE_FILENAME) as stored_queues:
+                snapshot = stored_queues.read()
+            with open(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME, 'a') as journal:
+                journal.write('["event",["%s"],{"type":"unkn' % (queue_id,))
+            clear_client_event_queues_for_testing()
+            with mock.patch('logging.warning') as mock_warning:
+                load_event_queues()
+            mock_warning.assert_called_once()
+            add_event_to_clients(dict(type='unknown', value=6), [get_client_descriptor(queue_id)])
+            flush_event_queue_journal()
+            clear_client_event_queues_for_testing()
+            load_event_queues()
+            self.assertEqual(get_client_descriptor(queue_id).event_queue.contents()[-1],
+                             dict(type='unknown', value=6, id=5))
+            with open(settings.JSON_PERSISTENT_QUEUE_FILENAME) as stored_queues:
+                self.assertEqual(stored_queues.read(), snapshot)
+
+            # A journal that was already folded into the snapshot
+            # (e.g. because we crashed while compacting) is skipped.
+            with open(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME, 'w') as journal:
+                journal.write(ujson.dumps(['header', 'stale', None]) + '\n')
+                journal.write(ujson.dumps(['gc', queue_id, None]) + '\n')
+            clear_client_event_queues_for_testing()
+            with mock.patch('logging.warning') as mock_warning:
+                load_event_queues()
+            self.assertIsNotNone(get_client_descriptor(queue_id))
+            mock_warning.assert_called_once()
+            # ...and replaced by a new journal continuing the snapshot.
+            with open(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME) as journal:
+                self.assertEqual([ujson.loads(line) for line in journal],
+                                 [['header', ujson.loads(snapshot)['journal_id'], None]])
+        clear_client_event_queues_for_testing()
+
+class BatchEventsTest(ZulipTestCase):
+    def test_batch_events(self) -> None:
+        with mock.patch('zerver.tornado.event_queue.queue_json_publish') as m:
+            with batch_events():
+                send_event(dict(type='presence'), [1])
+                with batch_events():
+                    send_event(dict(type='typing'), [2])
+                m.assert_not_called()
+            m.assert_called_once()
+            (queue_name, notice, processor) = m.call_args[0]
+            self.assertEqual(queue_name, 'notify_tornado')
+            self.assertEqual(notice, dict(notices=[dict(event=dict(type='presence'), users=[1]),
+                                                   dict(event=dict(type='typing'), users=[2])]))
+
+        with mock.patch('zerver.tornado.event_queue.process_event') as m:
+            process_notification(notice)
+            self.assertEqual([call[0] for call in m.call_args_list],
+                             [(dict(type='presence'), [1]), (dict(type='typing'), [2])])
+
+        events = []  # type: List[Mapping[str, Any]]
+        with tornado_redirected_to_list(events):
+            with batch_events():
+                send_event(dict(type='presence'), [1])
+                send_event(dict(type='typing'), [2])
+        self.assertEqual(len(events), 2)
+
+        # Events sent before the block raised describe changes that were
+        # already made (and possibly committed), so they're still sent.
+        events = []
+        with tornado_redirected_to_list(events):
+            with self.assertRaises(ValueError):
+                with batch_events():
+                    send_event(dict(type='presence'), [1])
+                    raise ValueError()
+            self.assertEqual(events, [dict(event=dict(type='presence'), users=[1])])
+            send_event(dict(type='typing'), [2])
+        self.assertEqual(events, [dict(event=dict(type='presence'), users=[1]),
+                                  dict(event=dict(type='typing'), users=[2])])
+
+class TornadoShardingTest(ZulipTestCase):
+    def test_send_event_routes_by_user(self) -> None:
+        with self.settings(TORNADO_PROCESSES=2, TORNADO_PORTS=[9993, 9994]), \
+                mock.patch('zerver.tornado.event_queue.queue_json_publish') as m:
+            send_event(dict(type='presence'), [1, 2, 3])
+            published = {call[0][0]: call[0][1]['users'] for call in m.call_args_list}
+            self.assertEqual(published, {'notify_tornado': [2],
+                                         'notify_tornado_1': [1, 3]})
+
+            m.reset_mock()
+            send_event(dict(type='message', stream_name='Denmark'), [dict(id=2, flags=[])])
+            published = {call[0][0]: call[0][1]['users'] for call in m.call_args_list}
+            self.assertEqual(published, {'notify_tornado': [dict(id=2, flags=[])],
+                                         'notify_tornado_1': []})
+
+    def test_fetch_events_rejects_other_shards_users(self) -> None:
+        user_profile = self.example_user('hamlet')
+        query = dict(queue_id=None, dont_block=True, last_event_id=None,
+                     user_profile_id=user_profile.id, user_profile_email=user_profile.email,
+                     client_type_name='website', handler_id=0,
+                     new_queue_data=dict(user_profile_id=user_profile.id,
+                                         realm_id=user_profile.realm_id,
+                                         user_profile_email=user_profile.email,
+                                         event_types=None, client_type_name='website',
+                                         apply_markdown=True, client_gravatar=False,
+                                         all_public_streams=False, queue_timeout=0,
+                                         last_connection_time=time.time(), narrow=[]))
+        other_shard = (user_profile.id + 1) % 2
+        with self.settings(TORNADO_PROCESSES=2, TORNADO_PORTS=[9993, 9994]), \
+                mock.patch('zerver.tornado.event_queue.get_current_shard',
+                           return_value=other_shard):
+            result = fetch_events(query)
+        self.assertEqual(result['type'], 'error')
+        self.assertIn('not hosted by this server', str(result['exception']))
+
+        with self.settings(TORNADO_PROCESSES=2, TORNADO_PORTS=[9993, 9994]), \
+                mock.patch('zerver.tornado.event_queue.get_current_shard',
+                           return_value=user_profile.id % 2):
+            result = fetch_events(query)
+        self.assertEqual(result['type'], 'response')
+        self.assertIn('queue_id', result['response'])
+        clear_client_event_queues_for_testing()
+
+    def test_delete_queue_forwarded_to_its_shard(self) -> None:
+        user_profile = self.example_user('hamlet')
+        self.login(user_profile.email)
+        with self.settings(TORNADO_PROCESSES=2, TORNADO_PORTS=[9993, 9994],
+                           TORNADO_SERVER='http://localhost:9993'), \
+                mock.patch('zerver.tornado.event_queue.get_current_shard', return_value=1):
+            queue_id = allocate_test_client_descriptor(user_profile).event_queue.id
+        self.assertTrue(queue_id.startswith('1-'))
+
+        # DELETE sends queue_id in the body, so nginx routes it to shard
+        # 0, which passes it on to shard 1 rather than failing to find
+        # the queue.
+        with self.settings(TORNADO_PROCESSES=2, TORNADO_PORTS=[9993, 9994],
+                           TORNADO_SERVER='http://localhost:9993'), \
+                mock.patch('zerver.tornado.event_queue.requests_client.post') as mock_post:
+            mock_post.return_value = mock.Mock(content=b'{"result":"success","msg":""}',
+                                               status_code=200,
+                                               headers={'Content-Type': 'application/json'})
+            result = self.client_delete('/json/events', dict(queue_id=queue_id))
+        self.assert_json_success(result)
+        mock_post.assert_called_once_with(
+            'http://127.0.0.1:9994/cleanup_event_queue',
+            data=dict(queue_id=queue_id, user_profile_id=user_profile.id,
+                      secret=settings.SHARED_SECRET))
+
+        # Shard 1 deletes its own queue.
+        with self.settings(TORNADO_PROCESSES=2, TORNADO_PORTS=[9993, 9994],
+                           TORNADO_SERVER='http://localhost:9993'), \
+                mock.patch('zerver.tornado.views.get_current_shard', return_value=1), \
+                mock.patch('zerver.tornado.event_queue.requests_client.post') as mock_post:
+            result = self.client_delete('/json/events', dict(queue_id=queue_id))
+        self.assert_json_success(result)
+        mock_post.assert_not_called()
+        self.assertIsNone(get_client_descriptor(queue_id))
+        clear_client_event_queues_for_testing()
+
 class FetchQueriesTest(ZulipTestCase):
     def test_queries(self) -> None:
         user = self.example_user("hamlet")
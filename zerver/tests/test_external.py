@@ -20,6 +20,7 @@ from zerver.lib.test_classes import (
 import DNS
 import mock
 import time
+import ujson
 
 import urllib
 from typing import Text
@@ -85,6 +86,25 @@ class RateLimitTests(ZulipTestCase):
         newlimit = int(result['X-RateLimit-Remaining'])
         self.assertEqual(limit, newlimit + 1)
 
+    def test_bulk_send_charges_each_message(self) -> None:
+        user = self.example_user('hamlet')
+        clear_history(RateLimitedUser(user))
+
+        def bulk_send(count: int) -> HttpResponse:
+            messages = [dict(type="stream", to="Verona", subject="bridge",
+                             content="message %s" % (i,))
+                        for i in range(count)]
+            return self.api_post(user.email, "/api/v1/messages/bulk",
+                                 {"messages": ujson.dumps(messages)})
+
+        with mock.patch('time.time', return_value=time.time()):
+            result = bulk_send(3)
+            self.assert_json_success(result)
+            self.assertEqual(int(result['X-RateLimit-Remaining']), 2)
+
+            result = bulk_send(4)
+            self.assertEqual(result.status_code, 429)
+
     def test_hit_ratelimits(self) -> None:
         user = self.example_user('cordelia')
         email = user.email
@@ -7,14 +7,20 @@ from django.utils.timezone import now as timezone_now
 from zerver.lib import bugdown
 from zerver.decorator import JsonableError
 from zerver.lib.test_runner import slow
-from zerver.lib.cache import get_stream_cache_key, cache_delete
+from zerver.lib.cache import get_stream_cache_key, cache_delete, \
+    get_remote_cache_requests, message_dict_lru, to_dict_cache_key_id
 
 from zerver.lib.addressee import Addressee
 
 from zerver.lib.actions import (
+    copy_insert_ums,
+    create_user_messages,
+    do_fan_out_message,
     do_send_messages,
     get_active_presence_idle_user_ids,
+    get_recipient_info,
     get_user_info_for_message_updates,
+    internal_prep_stream_message,
     internal_send_private_message,
     check_message,
     check_send_stream_message,
@@ -27,7 +33,10 @@ from zerver.lib.actions import (
 )
 
 from zerver.lib.message import (
+    MESSAGE_DICT_CODECS,
     MessageDict,
+    extract_message_dict,
+    stringify_message_dict,
     messages_for_ids,
     sew_messages_and_reactions,
     get_first_visible_message_id,
@@ -42,6 +51,7 @@ from zerver.lib.test_helpers import (
     most_recent_message,
     most_recent_usermessage,
     queries_captured,
+    tornado_redirected_to_list,
 )
 
 from zerver.lib.test_classes import (
@@ -56,7 +66,7 @@ from zerver.models import (
     Message, Realm, Recipient, Stream, UserMessage, UserProfile, Attachment,
     RealmAuditLog, RealmDomain, get_realm, UserPresence, Subscription,
     get_stream, get_stream_recipient, get_system_bot, get_user, Reaction,
-    flush_per_request_caches, ScheduledMessage
+    flush_per_request_caches, PendingMessageFanout, ScheduledMessage
 )
 
 
@@ -71,7 +81,7 @@ import DNS
 import mock
 import time
 import ujson
-from typing import Any, Dict, List, Optional, Set, Text
+from typing import Any, Dict, List, Mapping, Optional, Set, Text
 
 from collections import namedtuple
 
@@ -580,6 +590,112 @@ class StreamMessagesTest(ZulipTestCase):
         message = most_recent_message(user_profile)
         assert(UserMessage.objects.get(user_profile=user_profile, message=message).flags.mentioned.is_set)
 
+    def test_message_to_stream_with_copy_insert(self) -> None:
+        self.subscribe(self.example_user('iago'), "Denmark")
+        with mock.patch('zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD', 1), \
+                mock.patch('zerver.lib.actions.copy_insert_ums',
+                           wraps=copy_insert_ums) as m:
+            self.send_stream_message(self.example_email("hamlet"), "Denmark",
+                                     content="test @**Iago** rules")
+        m.assert_called_once()
+
+        message = most_recent_message(self.example_user('hamlet'))
+        ums = UserMessage.objects.filter(message=message)
+        subscribers = self.users_subscribed_to_stream("Denmark", message.sender.realm)
+        self.assertEqual({um.user_profile_id for um in ums},
+                         {user.id for user in subscribers
+                          if user.bot_type != UserProfile.OUTGOING_WEBHOOK_BOT})
+        iago_um = ums.get(user_profile=self.example_user('iago'))
+        self.assertTrue(iago_um.flags.mentioned.is_set)
+
+    def test_bot_message_render_cache(self) -> None:
+        bot_email = self.example_email('webhook_bot')
+        content = '**Alert**: disk full on https://example.com'
+        with mock.patch('zerver.lib.bugdown.convert', wraps=bugdown.convert) as m, \
+                mock.patch('zerver.lib.message.statsd') as statsd_mock:
+            first_id = self.send_stream_message(bot_email, "Denmark", content=content)
+            second_id = self.send_stream_message(bot_email, "Denmark", content=content)
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual([call[0][0] for call in statsd_mock.incr.call_args_list],
+                             ['render_cache.miss', 'render_cache.hit'])
+
+            # Messages with mentions, or from humans, are always rendered.
+            self.send_stream_message(bot_email, "Denmark", content='@**King Hamlet** ' + content)
+            self.send_stream_message(bot_email, "Denmark", content='@**King Hamlet** ' + content)
+            self.send_stream_message(self.example_email('hamlet'), "Denmark", content=content)
+            self.send_stream_message(self.example_email('hamlet'), "Denmark", content=content)
+            self.assertEqual(m.call_count, 5)
+
+        first_message = Message.objects.get(id=first_id)
+        second_message = Message.objects.get(id=second_id)
+        self.assertEqual(first_message.rendered_content, second_message.rendered_content)
+        self.assertTrue(second_message.has_link)
+
+    def test_create_user_messages_flags(self) -> None:
+        sender = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        iago = self.example_user('iago')
+        message = Message(
+            sender=sender,
+            recipient=get_stream_recipient(get_stream('Denmark', sender.realm).id),
+            sending_client=make_client(name='website'),
+        )
+        message.id = 1
+        message.mentions_wildcard = False
+        message.user_ids_with_alert_words = {cordelia.id}
+
+        def get_flags(long_term_idle_user_ids: Set[int]) -> Dict[int, List[str]]:
+            ums = create_user_messages(
+                message=message,
+                um_eligible_user_ids={sender.id, cordelia.id, othello.id, iago.id},
+                long_term_idle_user_ids=long_term_idle_user_ids,
+                mentioned_user_ids={othello.id},
+            )
+            return {um.user_profile_id: um.flags_list() for um in ums}
+
+        self.assertEqual(get_flags(set()), {
+            sender.id: ['read'],
+            cordelia.id: ['has_alert_word'],
+            othello.id: ['mentioned'],
+            iago.id: [],
+        })
+
+        # Long-term idle users only get rows for messages with flags.
+        self.assertEqual(set(get_flags({othello.id, iago.id})),
+                         {sender.id, cordelia.id, othello.id})
+
+        message.mentions_wildcard = True
+        self.assertEqual(get_flags({othello.id, iago.id}), {
+            sender.id: ['read', 'wildcard_mentioned'],
+            cordelia.id: ['wildcard_mentioned', 'has_alert_word'],
+            othello.id: ['mentioned', 'wildcard_mentioned'],
+            iago.id: ['wildcard_mentioned'],
+        })
+
+    def test_send_messages_in_batch(self) -> None:
+        sender = self.example_user('hamlet')
+        messages = [
+            internal_prep_stream_message(sender.realm, sender, 'Denmark', 'batch',
+                                         'message %d' % (i,))
+            for i in range(3)
+        ]
+
+        with mock.patch('zerver.lib.actions.get_recipient_info',
+                        wraps=get_recipient_info) as recipient_info_mock, \
+                mock.patch('zerver.tornado.event_queue.publish_notice') as publish_mock:
+            message_ids = do_send_messages(messages)
+
+        self.assertEqual(len(message_ids), 3)
+        recipient_info_mock.assert_called_once()
+        publish_mock.assert_called_once()
+        notices = publish_mock.call_args[0][1]['notices']
+        self.assertEqual([notice['event']['message'] for notice in notices], message_ids)
+
+        # Each message still got its own copies of the recipient sets.
+        self.assertEqual(
+            len({id(message['um_eligible_user_ids']) for message in messages}), 3)
+
     def _send_stream_message(self, email: Text, stream_name: Text, content: Text) -> Set[int]:
         with mock.patch('zerver.lib.actions.send_event') as m:
             self.send_stream_message(
@@ -822,6 +938,31 @@ class MessageDictTest(ZulipTestCase):
         error_content = '<p>[Zulip note: Sorry, we could not understand the formatting of your message]</p>'
         self.assertEqual(dct['rendered_content'], error_content)
 
+    def test_message_dict_codecs(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.login(hamlet.email)
+        message_id = self.send_stream_message(hamlet.email, 'Verona', content='foo')
+        result = self.client_patch("/json/messages/" + str(message_id), {
+            'message_id': message_id,
+            'content': 'bar',
+        })
+        self.assert_json_success(result)
+
+        row = MessageDict.get_raw_db_rows([message_id])[0]
+        message_dict = MessageDict.build_dict_from_raw_db_row(row)
+        self.assertIn('edit_history', message_dict)
+
+        encodings = []
+        for codec in MESSAGE_DICT_CODECS:
+            with self.settings(MESSAGE_DICT_CACHE_CODEC=codec):
+                message_bytes = stringify_message_dict(message_dict)
+            encodings.append(message_bytes)
+            # Whichever codec we're using, we can decode every codec's
+            # encodings.
+            self.assertEqual(extract_message_dict(message_bytes), message_dict)
+        self.assertEqual(len({message_bytes[0] for message_bytes in encodings}),
+                         len(MESSAGE_DICT_CODECS))
+
     def test_reaction(self) -> None:
         sender = self.example_user('othello')
         receiver = self.example_user('hamlet')
@@ -910,6 +1051,114 @@ class MessagePOSTTest(ZulipTestCase):
                                                      "subject": "Test subject"})
         self.assert_json_success(result)
 
+    def test_message_with_deferred_fanout(self) -> None:
+        self.login(self.example_email("hamlet"))
+        with mock.patch('zerver.lib.actions.queue_json_publish') as m:
+            result = self.client_post("/json/messages", {"type": "stream",
+                                                         "to": "Verona",
+                                                         "client": "test suite",
+                                                         "content": "Hi @**King Hamlet**",
+                                                         "subject": "Test subject",
+                                                         "defer_fanout": ujson.dumps(True)})
+        self.assert_json_success(result)
+        message_id = result.json()['id']
+
+        # The message is saved, but only the sender has received it yet.
+        message = Message.objects.get(id=message_id)
+        self.assertEqual(list(UserMessage.objects.filter(message=message)
+                              .values_list('user_profile_id', flat=True)),
+                         [message.sender_id])
+        queue_name, event = m.call_args[0]
+        self.assertEqual(queue_name, 'message_fanout')
+        self.assertTrue(PendingMessageFanout.objects.filter(message_id=message_id).exists())
+
+        # Until it's fanned out, later messages to the stream from
+        # the same sender are deferred too, so they can't overtake it.
+        with mock.patch('zerver.lib.actions.queue_json_publish') as m:
+            result = self.client_post("/json/messages", {"type": "stream",
+                                                         "to": "Verona",
+                                                         "client": "test suite",
+                                                         "content": "Second",
+                                                         "subject": "Test subject"})
+        self.assert_json_success(result)
+        second_queue_name, second_event = m.call_args[0]
+        self.assertEqual(second_queue_name, 'message_fanout')
+        self.assertEqual(second_event['message_id'], result.json()['id'])
+
+        # Other senders' messages aren't held up.
+        with mock.patch('zerver.lib.actions.queue_json_publish') as m:
+            self.send_stream_message(self.example_email("othello"), "Verona", "Meanwhile")
+        self.assertNotIn('message_fanout', [call[0][0] for call in m.call_args_list])
+
+        events = []  # type: List[Mapping[str, Any]]
+        with tornado_redirected_to_list(events):
+            do_fan_out_message(ujson.loads(ujson.dumps(event)))
+
+        subscribers = self.users_subscribed_to_stream("Verona", message.sender.realm)
+        self.assertEqual(set(UserMessage.objects.filter(message=message)
+                             .values_list('user_profile_id', flat=True)),
+                         {user.id for user in subscribers
+                          if user.bot_type != UserProfile.OUTGOING_WEBHOOK_BOT})
+        um = UserMessage.objects.get(message=message, user_profile=message.sender)
+        self.assertTrue(um.flags.mentioned.is_set)
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['event']['message'], message_id)
+        self.assertEqual({user['id'] for user in events[0]['users']},
+                         {user.id for user in subscribers})
+        sender_flags = [user['flags'] for user in events[0]['users']
+                        if user['id'] == message.sender_id]
+        self.assertEqual(sender_flags, [['mentioned']])
+
+        do_fan_out_message(ujson.loads(ujson.dumps(second_event)))
+        self.assertFalse(PendingMessageFanout.objects.exists())
+        with mock.patch('zerver.lib.actions.queue_json_publish') as m:
+            result = self.client_post("/json/messages", {"type": "stream",
+                                                         "to": "Verona",
+                                                         "client": "test suite",
+                                                         "content": "Third",
+                                                         "subject": "Test subject"})
+        self.assert_json_success(result)
+        self.assertNotIn('message_fanout', [call[0][0] for call in m.call_args_list])
+
+    def test_bulk_send_messages(self) -> None:
+        email = self.example_email("hamlet")
+        messages = [
+            dict(type="stream", to="Verona", subject="bridge", content="first"),
+            dict(type="stream", to="nonexistent", subject="bridge", content="lost"),
+            dict(type="private", to=[self.example_email("othello")], content="second"),
+            dict(type="stream", to="Verona", subject="bridge", content="   "),
+            dict(type="stream", to="Verona", subject="bridge", content="third"),
+        ]
+        with mock.patch('zerver.views.messages.do_send_messages',
+                        wraps=do_send_messages) as m:
+            result = self.api_post(email, "/api/v1/messages/bulk",
+                                   {"messages": ujson.dumps(messages)})
+        self.assert_json_success(result)
+        m.assert_called_once()
+
+        results = result.json()['messages']
+        self.assertEqual([r['result'] for r in results],
+                         ['success', 'error', 'success', 'error', 'success'])
+        self.assertEqual(results[1]['msg'], "Stream 'nonexistent' does not exist")
+        self.assertEqual(results[3]['msg'], "Message must not be empty")
+        for (r, content) in [(results[0], "first"), (results[2], "second"),
+                             (results[4], "third")]:
+            self.assertEqual(Message.objects.get(id=r['id']).content, content)
+
+        result = self.api_post(email, "/api/v1/messages/bulk",
+                               {"messages": ujson.dumps(messages * 21)})
+        self.assert_json_error(result, "Cannot send more than 100 messages at once")
+
+        result = self.api_post(email, "/api/v1/messages/bulk",
+                               {"messages": ujson.dumps([dict(type="stream", content="x")])})
+        self.assert_json_error(result, "to key is missing from messages[0]")
+
+        result = self.api_post(email, "/api/v1/messages/bulk",
+                               {"messages": ujson.dumps([dict(type="stream", to="Verona",
+                                                              subject=5, content="x")])})
+        self.assert_json_error(result, 'messages[0]["subject"] is not a string')
+
     def test_api_message_to_self(self) -> None:
         """
         Same as above, but for the API view
@@ -1728,6 +1977,55 @@ class EditMessageTest(ZulipTestCase):
         mention_user_ids = user_info['mention_user_ids']
         self.assertEqual(mention_user_ids, {cordelia.id})
 
+    def test_edit_message_mention_flags(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+
+        self.login(hamlet.email)
+        for user in [hamlet, cordelia, othello]:
+            self.subscribe(user, 'Scotland')
+
+        msg_id = self.send_stream_message(hamlet.email, 'Scotland',
+                                          content='@**Cordelia Lear**')
+
+        def flags(user: UserProfile) -> List[str]:
+            return UserMessage.objects.get(user_profile=user, message_id=msg_id).flags_list()
+
+        events = []  # type: List[Mapping[str, Any]]
+        with tornado_redirected_to_list(events):
+            result = self.client_patch("/json/messages/" + str(msg_id), {
+                'message_id': msg_id,
+                'content': '@**Othello, the Moor of Venice** @**all**',
+            })
+        self.assert_json_success(result)
+
+        self.assertNotIn('mentioned', flags(cordelia))
+        self.assertIn('wildcard_mentioned', flags(cordelia))
+        self.assertIn('mentioned', flags(othello))
+        self.assertIn('wildcard_mentioned', flags(othello))
+        self.assertIn('wildcard_mentioned', flags(hamlet))
+
+        # The event lists the recipients, with their flags grouped by value.
+        event = events[0]['event']
+        self.assertEqual(set(events[0]['users']), {hamlet.id, cordelia.id, othello.id})
+        flags_by_user_id = {
+            user_id: group['flags']
+            for group in event['user_flags_groups']
+            for user_id in group['user_ids']
+        }
+        self.assertEqual(flags_by_user_id[othello.id], flags(othello))
+        self.assertEqual(flags_by_user_id[cordelia.id], flags(cordelia))
+
+        result = self.client_patch("/json/messages/" + str(msg_id), {
+            'message_id': msg_id,
+            'content': 'no mentions',
+        })
+        self.assert_json_success(result)
+        self.assertNotIn('mentioned', flags(othello))
+        self.assertNotIn('wildcard_mentioned', flags(othello))
+        self.assertNotIn('wildcard_mentioned', flags(cordelia))
+
     def test_edit_cases(self) -> None:
         """This test verifies the accuracy of construction of Zulip's edit
         history data structures."""
@@ -2905,6 +3203,62 @@ class MessageHydrationTest(ZulipTestCase):
         self.assertIn('class="user-mention"', new_message['content'])
         self.assertEqual(new_message['flags'], ['mentioned'])
 
+    def test_messages_for_ids_lru(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.login(hamlet.email)
+        message_id = self.send_stream_message(hamlet.email, 'Verona', content='foo')
+
+        def fetch_content() -> Text:
+            return messages_for_ids(
+                message_ids=[message_id],
+                user_message_flags={message_id: []},
+                search_fields={},
+                apply_markdown=False,
+                client_gravatar=False,
+                allow_edit_history=False,
+            )[0]['content']
+
+        def check_fetch(content: Text, memcached_requests: int, decodes: int) -> None:
+            requests_before = get_remote_cache_requests()
+            with mock.patch('zerver.lib.message.extract_message_dict',
+                            wraps=extract_message_dict) as mock_extract:
+                self.assertEqual(fetch_content(), content)
+            self.assertEqual(get_remote_cache_requests() - requests_before,
+                             memcached_requests)
+            self.assertEqual(mock_extract.call_count, decodes)
+
+        # Cold: one get_many, then a set_many of the dict fetched from
+        # the database.
+        cache_delete(to_dict_cache_key_id(message_id))
+        message_dict_lru.clear()
+        check_fetch('foo', memcached_requests=2, decodes=0)
+
+        # The first memcached hit decodes the dict into the LRU; later
+        # ones still take just the one get_many, but don't decode it
+        # (and the dicts we return can be modified without affecting
+        # the LRU).
+        check_fetch('foo', memcached_requests=1, decodes=1)
+        check_fetch('foo', memcached_requests=1, decodes=0)
+        check_fetch('foo', memcached_requests=1, decodes=0)
+
+        # Editing the message changes its encoded dict in memcached, so
+        # every process's LRU misses on it, without being told.
+        result = self.client_patch("/json/messages/" + str(message_id), {
+            'message_id': message_id,
+            'content': 'bar',
+        })
+        self.assert_json_success(result)
+        check_fetch('bar', memcached_requests=1, decodes=1)
+        check_fetch('bar', memcached_requests=1, decodes=0)
+
+        # The LRU is bounded.
+        message_dict_lru.clear()
+        message_dict_lru[b'other'] = {}
+        with mock.patch('zerver.lib.cache.MESSAGE_DICT_LRU_SIZE', 1):
+            check_fetch('bar', memcached_requests=1, decodes=1)
+        self.assertNotIn(b'other', message_dict_lru)
+        self.assertEqual(len(message_dict_lru), 1)
+
 class MessageVisibilityTest(ZulipTestCase):
     def test_update_first_visible_message_id(self) -> None:
         Message.objects.all().delete()
@@ -1,7 +1,10 @@
 import time
 
+from django.http import HttpRequest
 from django.test import override_settings
-from unittest.mock import Mock, patch
+from unittest.mock import ANY, Mock, patch
+from zerver.lib import spans
+from zerver.lib.spans import span, start_span_recording, stop_span_recording
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.middleware import is_slow_query
 from zerver.middleware import write_log_line
@@ -48,3 +51,44 @@ class SlowQueryTest(ZulipTestCase):
         write_log_line(self.log_data, path='/socket/open', method='SOCKET',
                        remote_ip='123.456.789.012', email='unknown', client_name='?')
         mock_internal_send_message.assert_not_called()
+
+class SpanLoggingTest(ZulipTestCase):
+    def test_span(self) -> None:
+        request = HttpRequest()
+        start_span_recording(request)
+        with span('render'):
+            pass
+        with span('validate'):
+            pass
+        with span('render'):
+            pass
+        stop_span_recording()
+        with span('after'):
+            pass
+        self.assertEqual(list(request._spans.keys()), ['render', 'validate'])
+
+        # A new request starts with no spans of its own.
+        next_request = HttpRequest()
+        start_span_recording(next_request)
+        stop_span_recording()
+        self.assertEqual(next_request._spans, {})
+
+    @patch('zerver.middleware.statsd')
+    @patch('zerver.middleware.logger')
+    def test_send_message_spans(self, mock_logger: Mock, mock_statsd: Mock) -> None:
+        result = self.api_post(self.example_email('hamlet'), "/api/v1/messages",
+                               {"type": "stream",
+                                "to": "Verona",
+                                "client": "test suite",
+                                "content": "Test message",
+                                "subject": "Test subject"})
+        self.assert_json_success(result)
+
+        logger_line = mock_logger.info.call_args[0][0]
+        for name in ['validate', 'mention_data', 'recipient_info', 'render',
+                     'message_save', 'usermessage_insert', 'event_publish']:
+            self.assertIn("%s: " % (name,), logger_line)
+        mock_statsd.timing.assert_any_call("webreq.api.v1.messages.span.render", ANY)
+        # Recording stops when the request is done, so nothing leaks
+        # into whatever runs next.
+        self.assertIsNone(spans.current_spans)
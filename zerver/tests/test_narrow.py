@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db import connection
 from django.test import override_settings
 from sqlalchemy.sql import (
@@ -21,11 +23,12 @@ from zerver.lib.narrow import (
     build_narrow_filter,
 )
 from zerver.lib.request import JsonableError
-from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
+from zerver.lib.sqlalchemy_utils import execute_query_template, get_sqlalchemy_connection, \
+    query_template_cache
 from zerver.lib.test_helpers import (
     POSTRequestMock,
     TestCase,
-    get_user_messages, queries_captured,
+    get_user_messages, queries_captured, stdout_suppressed,
 )
 from zerver.lib.test_classes import (
     ZulipTestCase,
@@ -35,10 +38,12 @@ from zerver.lib.topic_mutes import (
 )
 from zerver.views.messages import (
     exclude_muting_conditions,
-    get_messages_backend, ok_to_include_history,
+    get_messages_backend, get_messages_for_rows, get_narrow_query, get_range_params, get_range_shape,
+    limit_query_to_range, ok_to_include_history,
     NarrowBuilder, BadNarrowOperator, Query,
     LARGER_THAN_MAX_MESSAGE_ID,
 )
+from zilencer.management.commands.explain_narrow_queries import NARROW_SHAPES
 
 from typing import Dict, List, Mapping, Sequence, Tuple, Generic, Union, Any, Optional, Text
 import mock
@@ -78,11 +83,11 @@ class NarrowBuilderTest(ZulipTestCase):
 
     def test_add_term_using_stream_operator(self) -> None:
         term = dict(operator='stream', operand='Scotland')
-        self._do_add_term_test(term, 'WHERE recipient_id = :recipient_id_1')
+        self._do_add_term_test(term, 'WHERE recipient_id = :narrow_1')
 
     def test_add_term_using_stream_operator_and_negated(self) -> None:  # NEGATED
         term = dict(operator='stream', operand='Scotland', negated=True)
-        self._do_add_term_test(term, 'WHERE recipient_id != :recipient_id_1')
+        self._do_add_term_test(term, 'WHERE recipient_id != :narrow_1')
 
     def test_add_term_using_stream_operator_and_non_existing_operand_should_raise_error(
             self) -> None:  # NEGATED
@@ -146,29 +151,29 @@ class NarrowBuilderTest(ZulipTestCase):
 
     def test_add_term_using_topic_operator_and_lunch_operand(self) -> None:
         term = dict(operator='topic', operand='lunch')
-        self._do_add_term_test(term, 'WHERE upper(subject) = upper(:param_1)')
+        self._do_add_term_test(term, 'WHERE upper(subject) = upper(:narrow_1)')
 
     def test_add_term_using_topic_operator_lunch_operand_and_negated(
             self) -> None:  # NEGATED
         term = dict(operator='topic', operand='lunch', negated=True)
-        self._do_add_term_test(term, 'WHERE upper(subject) != upper(:param_1)')
+        self._do_add_term_test(term, 'WHERE upper(subject) != upper(:narrow_1)')
 
     def test_add_term_using_topic_operator_and_personal_operand(self) -> None:
         term = dict(operator='topic', operand='personal')
-        self._do_add_term_test(term, 'WHERE upper(subject) = upper(:param_1)')
+        self._do_add_term_test(term, 'WHERE upper(subject) = upper(:narrow_1)')
 
     def test_add_term_using_topic_operator_personal_operand_and_negated(
             self) -> None:  # NEGATED
         term = dict(operator='topic', operand='personal', negated=True)
-        self._do_add_term_test(term, 'WHERE upper(subject) != upper(:param_1)')
+        self._do_add_term_test(term, 'WHERE upper(subject) != upper(:narrow_1)')
 
     def test_add_term_using_sender_operator(self) -> None:
         term = dict(operator='sender', operand=self.example_email("othello"))
-        self._do_add_term_test(term, 'WHERE sender_id = :param_1')
+        self._do_add_term_test(term, 'WHERE sender_id = :narrow_1')
 
     def test_add_term_using_sender_operator_and_negated(self) -> None:  # NEGATED
         term = dict(operator='sender', operand=self.example_email("othello"), negated=True)
-        self._do_add_term_test(term, 'WHERE sender_id != :param_1')
+        self._do_add_term_test(term, 'WHERE sender_id != :narrow_1')
 
     def test_add_term_using_sender_operator_with_non_existing_user_as_operand(
             self) -> None:  # NEGATED
@@ -177,30 +182,30 @@ class NarrowBuilderTest(ZulipTestCase):
 
     def test_add_term_using_pm_with_operator_and_not_the_same_user_as_operand(self) -> None:
         term = dict(operator='pm-with', operand=self.example_email("othello"))
-        self._do_add_term_test(term, 'WHERE sender_id = :sender_id_1 AND recipient_id = :recipient_id_1 OR sender_id = :sender_id_2 AND recipient_id = :recipient_id_2')
+        self._do_add_term_test(term, 'WHERE sender_id = :narrow_1 AND recipient_id = :narrow_2 OR sender_id = :narrow_3 AND recipient_id = :narrow_4')
 
     def test_add_term_using_pm_with_operator_not_the_same_user_as_operand_and_negated(
             self) -> None:  # NEGATED
         term = dict(operator='pm-with', operand=self.example_email("othello"), negated=True)
-        self._do_add_term_test(term, 'WHERE NOT (sender_id = :sender_id_1 AND recipient_id = :recipient_id_1 OR sender_id = :sender_id_2 AND recipient_id = :recipient_id_2)')
+        self._do_add_term_test(term, 'WHERE NOT (sender_id = :narrow_1 AND recipient_id = :narrow_2 OR sender_id = :narrow_3 AND recipient_id = :narrow_4)')
 
     def test_add_term_using_pm_with_operator_the_same_user_as_operand(self) -> None:
         term = dict(operator='pm-with', operand=self.example_email("hamlet"))
-        self._do_add_term_test(term, 'WHERE sender_id = :sender_id_1 AND recipient_id = :recipient_id_1')
+        self._do_add_term_test(term, 'WHERE sender_id = :narrow_1 AND recipient_id = :narrow_2')
 
     def test_add_term_using_pm_with_operator_the_same_user_as_operand_and_negated(
             self) -> None:  # NEGATED
         term = dict(operator='pm-with', operand=self.example_email("hamlet"), negated=True)
-        self._do_add_term_test(term, 'WHERE NOT (sender_id = :sender_id_1 AND recipient_id = :recipient_id_1)')
+        self._do_add_term_test(term, 'WHERE NOT (sender_id = :narrow_1 AND recipient_id = :narrow_2)')
 
     def test_add_term_using_pm_with_operator_and_more_than_user_as_operand(self) -> None:
         term = dict(operator='pm-with', operand='hamlet@zulip.com, othello@zulip.com')
-        self._do_add_term_test(term, 'WHERE recipient_id = :recipient_id_1')
+        self._do_add_term_test(term, 'WHERE recipient_id = :narrow_1')
 
     def test_add_term_using_pm_with_operator_more_than_user_as_operand_and_negated(
             self) -> None:  # NEGATED
         term = dict(operator='pm-with', operand='hamlet@zulip.com, othello@zulip.com', negated=True)
-        self._do_add_term_test(term, 'WHERE recipient_id != :recipient_id_1')
+        self._do_add_term_test(term, 'WHERE recipient_id != :narrow_1')
 
     def test_add_term_using_pm_with_operator_with_non_existing_user_as_operand(self) -> None:
         term = dict(operator='pm-with', operand='non-existing@zulip.com')
@@ -212,11 +217,11 @@ class NarrowBuilderTest(ZulipTestCase):
 
     def test_add_term_using_id_operator(self) -> None:
         term = dict(operator='id', operand=555)
-        self._do_add_term_test(term, 'WHERE id = :param_1')
+        self._do_add_term_test(term, 'WHERE id = :narrow_1')
 
     def test_add_term_using_id_operator_and_negated(self) -> None:  # NEGATED
         term = dict(operator='id', operand=555, negated=True)
-        self._do_add_term_test(term, 'WHERE id != :param_1')
+        self._do_add_term_test(term, 'WHERE id != :narrow_1')
 
     def test_add_term_using_group_pm_operator_and_not_the_same_user_as_operand(self) -> None:
         term = dict(operator='group-pm-with', operand=self.example_email("othello"))
@@ -238,24 +243,24 @@ class NarrowBuilderTest(ZulipTestCase):
     @override_settings(USING_PGROONGA=False)
     def test_add_term_using_search_operator(self) -> None:
         term = dict(operator='search', operand='"french fries"')
-        self._do_add_term_test(term, 'WHERE (lower(content) LIKE lower(:content_1) OR lower(subject) LIKE lower(:subject_1)) AND (search_tsvector @@ plainto_tsquery(:param_2, :param_3))')
+        self._do_add_term_test(term, 'WHERE (lower(content) LIKE lower(:narrow_2) OR lower(subject) LIKE lower(:narrow_2)) AND (search_tsvector @@ plainto_tsquery(:param_2, :narrow_1))')
 
     @override_settings(USING_PGROONGA=False)
     def test_add_term_using_search_operator_and_negated(
             self) -> None:  # NEGATED
         term = dict(operator='search', operand='"french fries"', negated=True)
-        self._do_add_term_test(term, 'WHERE NOT (lower(content) LIKE lower(:content_1) OR lower(subject) LIKE lower(:subject_1)) AND NOT (search_tsvector @@ plainto_tsquery(:param_2, :param_3))')
+        self._do_add_term_test(term, 'WHERE NOT (lower(content) LIKE lower(:narrow_2) OR lower(subject) LIKE lower(:narrow_2)) AND NOT (search_tsvector @@ plainto_tsquery(:param_2, :narrow_1))')
 
     @override_settings(USING_PGROONGA=True)
     def test_add_term_using_search_operator_pgroonga(self) -> None:
         term = dict(operator='search', operand='"french fries"')
-        self._do_add_term_test(term, 'WHERE search_pgroonga @@ :search_pgroonga_1')
+        self._do_add_term_test(term, 'WHERE search_pgroonga @@ :narrow_2')
 
     @override_settings(USING_PGROONGA=True)
     def test_add_term_using_search_operator_and_negated_pgroonga(
             self) -> None:  # NEGATED
         term = dict(operator='search', operand='"french fries"', negated=True)
-        self._do_add_term_test(term, 'WHERE NOT (search_pgroonga @@ :search_pgroonga_1)')
+        self._do_add_term_test(term, 'WHERE NOT (search_pgroonga @@ :narrow_2)')
 
     def test_add_term_using_has_operator_and_attachment_operand(self) -> None:
         term = dict(operator='has', operand='attachment')
@@ -321,6 +326,33 @@ class NarrowBuilderTest(ZulipTestCase):
         query = self._build_query(term)
         self.assertEqual(str(query), 'SELECT id \nFROM zerver_message')
 
+    def test_shape(self) -> None:
+        def get_shape(term: Dict[str, Any]) -> List[Tuple[Any, ...]]:
+            builder = NarrowBuilder(self.user_profile, column('id'))
+            builder.add_term(self.raw_query, term)
+            self.assertTrue(builder.cacheable)
+            return builder.shape
+
+        # The shape doesn't depend on operands that are just parameters...
+        self.assertEqual(get_shape(dict(operator='stream', operand='Scotland')), [('stream', False)])
+        self.assertEqual(get_shape(dict(operator='stream', operand='Verona')), [('stream', False)])
+        self.assertEqual(get_shape(dict(operator='stream', operand='Verona', negated=True)),
+                         [('stream', True)])
+
+        # ... but does on those that change the structure of the query.
+        self.assertEqual(get_shape(dict(operator='is', operand='private')), [('is', False, 'private')])
+        self.assertEqual(get_shape(dict(operator='pm-with', operand=self.example_email('hamlet'))),
+                         [('pm-with', False, 'self')])
+        self.assertEqual(get_shape(dict(operator='pm-with', operand=self.example_email('othello'))),
+                         [('pm-with', False, 'personal')])
+        with self.settings(USING_PGROONGA=False):
+            self.assertEqual(get_shape(dict(operator='search', operand='"french fries" steak')),
+                             [('search', False, 'tsearch', 'phrase')])
+
+        # We don't track the shape of the muting conditions.
+        self.builder.add_term(self.raw_query, dict(operator='in', operand='home'))
+        self.assertFalse(self.builder.cacheable)
+
     def _do_add_term_test(self, term: Dict[str, Any], where_clause: Text,
                           params: Optional[Dict[str, Any]]=None) -> None:
         query = self._build_query(term)
@@ -348,6 +380,13 @@ class BuildNarrowFilterTest(TestCase):
             for e in reject_events:
                 self.assertFalse(narrow_filter(e))
 
+    def test_build_narrow_filter_shared(self) -> None:
+        self.assertIs(build_narrow_filter([["stream", "Denmark"], ["topic", "hello"]]),
+                      build_narrow_filter([("stream", "Denmark"), ("topic", "hello")]))
+        self.assertIsNot(build_narrow_filter([["stream", "Denmark"]]),
+                         build_narrow_filter([["stream", "Verona"]]))
+        self.assertTrue(build_narrow_filter([])(dict(message={}, flags=[])))
+
     def test_build_narrow_filter_invalid(self) -> None:
         with self.assertRaises(JsonableError):
             build_narrow_filter(["invalid_operator", "operand"])
@@ -525,6 +564,196 @@ class GetOldMessagesTest(ZulipTestCase):
 
         self.get_and_check_messages(dict(narrow=ujson.dumps([dict(operator='pm-with', operand=self.example_email("othello"))])))
 
+    def test_get_messages_stream_results(self) -> None:
+        """
+        With stream_results, GET /json/messages streams the same response
+        it would otherwise return, fetching the messages in batches.
+        """
+        self.login(self.example_email("hamlet"))
+        for narrow in [[], [dict(operator='stream', operand='Verona')]]:
+            params = dict(anchor=LARGER_THAN_MAX_MESSAGE_ID, num_before=10, num_after=0,
+                          narrow=ujson.dumps(narrow))
+            expected = self.get_and_check_messages(params)['messages']
+            self.assertGreater(len(expected), 3)
+
+            with mock.patch('zerver.views.messages.STREAM_MESSAGES_BATCH_SIZE', 3), \
+                    mock.patch('zerver.views.messages.get_messages_for_rows',
+                               wraps=get_messages_for_rows) as mock_get_messages:
+                payload = self.client_get("/json/messages", dict(params, stream_results='true'))
+                self.assertEqual(payload.status_code, 200)
+                self.assertTrue(payload.streaming)
+                # Only the first batch is fetched before we start streaming.
+                self.assertEqual(mock_get_messages.call_count, 1)
+                content = b''.join(payload.streaming_content)
+            # One call per batch of 3 messages.
+            self.assertEqual(mock_get_messages.call_count, (len(expected) + 2) // 3)
+            result = ujson.loads(content)
+            self.assertEqual(result['result'], 'success')
+            self.assertEqual(result['messages'], expected)
+
+        # Errors are returned as usual, rather than in a streamed response.
+        narrow = [dict(operator='stream', operand='nonexistent stream')]
+        result = self.client_get("/json/messages", dict(anchor=LARGER_THAN_MAX_MESSAGE_ID,
+                                                        num_before=10, num_after=0,
+                                                        narrow=ujson.dumps(narrow),
+                                                        stream_results='true'))
+        self.assert_json_error_contains(result, 'Invalid narrow operator: unknown stream')
+
+    def test_get_messages_query_templates(self) -> None:
+        """
+        get_messages queries for narrows with the same shape share a
+        compiled template, filled in with each query's own parameters.
+        """
+        self.login(self.example_email("hamlet"))
+        query_template_cache.clear()
+
+        for stream_name in ['Denmark', 'Verona']:
+            self.send_stream_message(self.example_email("hamlet"), stream_name)
+            narrow = [dict(operator='stream', operand=stream_name)]
+            result = self.get_and_check_messages(dict(anchor=LARGER_THAN_MAX_MESSAGE_ID, num_before=10,
+                                                      num_after=0, narrow=ujson.dumps(narrow)))
+            self.assertGreater(len(result['messages']), 0)
+            for message in result['messages']:
+                self.assertEqual(message['display_recipient'], stream_name)
+        self.assertEqual(len(query_template_cache), 1)
+
+        # Once we have the template, fetching messages for another
+        # narrow of the same shape neither builds nor compiles a query.
+        self.send_stream_message(self.example_email("hamlet"), 'Scotland')
+        narrow = [dict(operator='stream', operand='Scotland')]
+        with mock.patch('zerver.views.messages.get_base_query') as mock_get_base_query, \
+                mock.patch('zerver.views.messages.limit_query_to_range') as mock_limit_query, \
+                mock.patch('sqlalchemy.sql.compiler.SQLCompiler.__init__') as mock_compile:
+            result = self.get_and_check_messages(dict(anchor=LARGER_THAN_MAX_MESSAGE_ID, num_before=10,
+                                                      num_after=0, narrow=ujson.dumps(narrow)))
+        mock_get_base_query.assert_not_called()
+        mock_limit_query.assert_not_called()
+        mock_compile.assert_not_called()
+        self.assertGreater(len(result['messages']), 0)
+        for message in result['messages']:
+            self.assertEqual(message['display_recipient'], 'Scotland')
+
+        narrow = [dict(operator='stream', operand='Verona', negated=True)]
+        result = self.get_and_check_messages(dict(anchor=LARGER_THAN_MAX_MESSAGE_ID, num_before=10,
+                                                  num_after=0, narrow=ujson.dumps(narrow)))
+        self.assertGreater(len(result['messages']), 0)
+        for message in result['messages']:
+            self.assertNotEqual(message['display_recipient'], 'Verona')
+        self.assertEqual(len(query_template_cache), 2)
+
+    def check_query_templates(self, user_profile: UserProfile,
+                              narrows: List[List[Dict[str, Any]]]) -> List[List[Any]]:
+        """
+        Runs the get_messages query for each of the narrows, which must all
+        have the same shape, through execute_query_template, checking
+        that each gets the rows it would have compiled from scratch.
+        """
+        query_template_cache.clear()
+        sa_conn = get_sqlalchemy_connection()
+        results = []
+        for (i, narrow) in enumerate(narrows):
+            (query, inner_msg_id_col, is_search, search_term, shape, params) = get_narrow_query(
+                user_profile, narrow, False)
+            self.assertIsNotNone(shape)
+            # Without building the query, we get the same shape and
+            # parameters as we do building it.
+            self.assertEqual(get_narrow_query(user_profile, narrow, False, shape_only=True)[4:],
+                             (shape, params))
+
+            (anchor, num_before, num_after) = (LARGER_THAN_MAX_MESSAGE_ID, 100 + i, 0)
+            query = limit_query_to_range(query, inner_msg_id_col, anchor, num_before, num_after)
+            shape += get_range_shape(anchor, num_before, num_after)
+            params.update(get_range_params(anchor, num_before, num_after))
+            expected = list(sa_conn.execute(query).fetchall())
+            with mock.patch('zerver.lib.sqlalchemy_utils.logging.warning') as mock_warning:
+                rows = list(execute_query_template(sa_conn, shape, params, lambda: query).fetchall())
+            mock_warning.assert_not_called()
+            self.assertEqual(rows, expected)
+            results.append(rows)
+        self.assertEqual(len(query_template_cache), 1)
+        return results
+
+    def test_query_templates_fill_in_each_querys_values(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.send_stream_message(hamlet.email, 'Denmark', topic_name='lunch')
+        self.send_stream_message(self.example_email('othello'), 'Verona', topic_name='dinner')
+        self.send_personal_message(self.example_email('othello'), hamlet.email)
+        self.send_personal_message(self.example_email('iago'), hamlet.email)
+
+        for (operator, operands) in [('stream', ['Denmark', 'Verona']),
+                                     ('topic', ['lunch', 'dinner']),
+                                     ('sender', [hamlet.email, self.example_email('othello')]),
+                                     ('pm-with', [self.example_email('othello'),
+                                                  self.example_email('iago')])]:
+            for negated in [False, True]:
+                narrows = [[dict(operator=operator, operand=operand, negated=negated)]
+                           for operand in operands]
+                results = self.check_query_templates(hamlet, narrows)
+                self.assertNotEqual(results[0], results[1])
+
+        # Several terms of the same shape, in a different order.
+        narrows = [[dict(operator='stream', operand='Denmark'), dict(operator='topic', operand='lunch'),
+                    dict(operator='sender', operand=hamlet.email)],
+                   [dict(operator='stream', operand='Verona'), dict(operator='topic', operand='dinner'),
+                    dict(operator='sender', operand=self.example_email('othello'))]]
+        results = self.check_query_templates(hamlet, narrows)
+        self.assertNotEqual(results[0], results[1])
+
+        with self.settings(USING_PGROONGA=False):
+            narrows = [[dict(operator='search', operand='"lunch" test')],
+                       [dict(operator='search', operand='"dinner" test')]]
+            self.check_query_templates(hamlet, narrows)
+
+    def test_query_templates_mit(self) -> None:
+        """
+        In the MIT realm, `stream` and `topic` terms match several
+        recipients or topics, each a parameter of its own.
+        """
+        starnine = self.mit_user('starnine')
+        for stream_name in ['alpha', 'alpha.d', 'beta', 'unbeta']:
+            self.subscribe(starnine, stream_name)
+            self.send_stream_message(starnine.email, stream_name, sender_realm="zephyr")
+        for topic_name in ['templates', 'templates.d', 'other templates.d.d', 'personal', '.d']:
+            self.send_stream_message(starnine.email, 'alpha', topic_name=topic_name,
+                                     sender_realm="zephyr")
+
+        narrows = [[dict(operator='stream', operand='alpha')],
+                   [dict(operator='stream', operand='beta')]]
+        results = self.check_query_templates(starnine, narrows)
+        self.assertEqual(len(results[0]), 7)
+        self.assertEqual(len(results[1]), 2)
+        self.assertNotEqual(results[0], results[1])
+
+        narrows = [[dict(operator='topic', operand='templates')],
+                   [dict(operator='topic', operand='other templates')]]
+        results = self.check_query_templates(starnine, narrows)
+        self.assertEqual(len(results[0]), 2)
+        self.assertEqual(len(results[1]), 1)
+
+        # The topics that "personal" matches aren't parameters at all.
+        narrows = [[dict(operator='topic', operand='personal')],
+                   [dict(operator='topic', operand='.d')]]
+        results = self.check_query_templates(starnine, narrows)
+        self.assertEqual(results[0], results[1])
+
+    def test_explain_narrow_queries(self) -> None:
+        # Every operator has at least one narrow shape checked.
+        operators = set(term.lstrip('-').partition(':')[0]
+                        for narrow_shape in NARROW_SHAPES for term in narrow_shape.split())
+        builder_operators = set(name[len('by_'):].replace('_', '-')
+                                for name in dir(NarrowBuilder) if name.startswith('by_'))
+        self.assertEqual(operators, builder_operators)
+
+        # The indexes on zerver_usermessage cover all of the narrows.
+        with stdout_suppressed():
+            call_command('explain_narrow_queries', self.example_email("hamlet"), '--disable-seqscan')
+
+        with stdout_suppressed(), \
+                mock.patch('zilencer.management.commands.explain_narrow_queries.get_query_plan',
+                           return_value=['Seq Scan on zerver_usermessage  (cost=0.00..1.00 rows=1 width=8)']):
+            with self.assertRaisesRegex(CommandError, "Sequential scans on zerver_usermessage"):
+                call_command('explain_narrow_queries', self.example_email("hamlet"))
+
     def test_client_avatar(self) -> None:
         """
         The client_gravatar flag determines whether we send avatar_url.
@@ -708,12 +937,19 @@ class GetOldMessagesTest(ZulipTestCase):
             num_after=100,
         )
 
-        payload = self.client_get('/json/messages', req)
+        with queries_captured() as queries:
+            payload = self.client_get('/json/messages', req)
         self.assert_json_success(payload)
         result = ujson.loads(payload.content)
         messages = result['messages']
         self.assertEqual(len(messages), 2)
 
+        # The user's flags come from the get_messages query itself.
+        usermessage_queries = [query for query in queries
+                               if 'zerver_usermessage' in query['sql']]
+        self.assertEqual(len(usermessage_queries), 1)
+        self.assertIn('/* get_messages */', usermessage_queries[0]['sql'])
+
         for message in messages:
             if message['id'] == old_message_id:
                 old_message = message
@@ -1765,7 +2001,7 @@ class GetOldMessagesTest(ZulipTestCase):
                                               'narrow': '[["sender", "%s"]]' % (self.example_email("othello"),)},
                                              sql)
 
-        sql_template = 'SELECT anon_1.message_id \nFROM (SELECT id AS message_id \nFROM zerver_message \nWHERE zerver_message.id >= 0 AND recipient_id = {scotland_recipient} AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
+        sql_template = 'SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT zerver_message.id AS message_id, zerver_usermessage.flags AS flags \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE zerver_message.id >= 0 AND recipient_id = {scotland_recipient} AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                               'narrow': '[["stream", "Scotland"]]'},
@@ -1777,7 +2013,7 @@ class GetOldMessagesTest(ZulipTestCase):
                                               'narrow': '[["topic", "blah"]]'},
                                              sql)
 
-        sql_template = "SELECT anon_1.message_id \nFROM (SELECT id AS message_id \nFROM zerver_message \nWHERE zerver_message.id >= 0 AND recipient_id = {scotland_recipient} AND upper(subject) = upper('blah') AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT zerver_message.id AS message_id, zerver_usermessage.flags AS flags \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE zerver_message.id >= 0 AND recipient_id = {scotland_recipient} AND upper(subject) = upper('blah') AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                               'narrow': '[["stream", "Scotland"], ["topic", "blah"]]'},
@@ -1806,7 +2042,7 @@ class GetOldMessagesTest(ZulipTestCase):
                                               'narrow': '[["search", "jumping"]]'},
                                              sql)
 
-        sql_template = "SELECT anon_1.message_id, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT id AS message_id, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM zerver_message \nWHERE zerver_message.id >= 0 AND recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT zerver_message.id AS message_id, zerver_usermessage.flags AS flags, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE zerver_message.id >= 0 AND recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                               'narrow': '[["stream", "Scotland"], ["search", "jumping"]]'},
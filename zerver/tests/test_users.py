@@ -23,6 +23,7 @@ from zerver.models import UserProfile, Recipient, \
     Message, get_context_for_message, ScheduledEmail
 
 from zerver.lib.avatar import avatar_url
+from zerver.lib.cache import stream_recipient_info_cache_key
 from zerver.lib.email_mirror import create_missed_message_address
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.send_email import send_future_email
@@ -33,7 +34,9 @@ from zerver.lib.actions import (
     do_reactivate_user,
     do_change_is_admin,
     do_create_user,
+    do_change_notification_settings,
 )
+from zerver.lib.soft_deactivation import do_soft_deactivate_users
 from zerver.lib.topic_mutes import add_topic_mute
 from zerver.lib.stream_topic import StreamTopicTarget
 from zerver.lib.users import user_ids_to_users
@@ -480,6 +483,67 @@ class RecipientInfoTest(ZulipTestCase):
         )
         self.assertEqual(info['default_bot_user_ids'], {normal_bot.id})
 
+    def test_stream_recipient_info_cache(self) -> None:
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        stream = self.subscribe(hamlet, 'Test Stream')
+        recipient = get_stream_recipient(stream.id)
+        stream_topic = StreamTopicTarget(
+            stream_id=stream.id,
+            topic_name='test topic',
+        )
+
+        def get_info() -> Dict[str, Any]:
+            return get_recipient_info(
+                recipient=recipient,
+                sender_id=hamlet.id,
+                stream_topic=stream_topic,
+            )
+
+        info = get_info()
+        with queries_captured() as queries:
+            self.assertEqual(get_info(), info)
+        # Only the topic mute lookup still goes to the database.
+        self.assert_length(queries, 1)
+
+        self.subscribe(othello, 'Test Stream')
+        self.assertEqual(get_info()['active_user_ids'], {hamlet.id, othello.id})
+
+        do_change_notification_settings(othello, 'enable_online_push_notifications', True)
+        self.assertEqual(get_info()['push_notify_user_ids'], {othello.id})
+
+        do_soft_deactivate_users([othello])
+        self.assertEqual(get_info()['long_term_idle_user_ids'], {othello.id})
+
+        do_deactivate_user(othello)
+        self.assertEqual(get_info()['active_user_ids'], {hamlet.id})
+
+        do_reactivate_user(othello)
+        self.unsubscribe(othello, 'Test Stream')
+        self.assertEqual(get_info()['active_user_ids'], {hamlet.id})
+
+    def test_stream_recipient_info_cache_flushed_on_commit(self) -> None:
+        hamlet = self.example_user('hamlet')
+        stream = self.subscribe(hamlet, 'Test Stream')
+        sub = get_subscription('Test Stream', hamlet)
+        key = stream_recipient_info_cache_key(stream.id)
+
+        # Tests run inside a transaction that never commits, so capture
+        # the callbacks rather than waiting for them.
+        with mock.patch('zerver.lib.cache.transaction.on_commit') as on_commit, \
+                mock.patch('zerver.lib.cache.cache_delete_many') as delete:
+            sub.push_notifications = True
+            sub.save()
+            delete.assert_called_once_with([key], None)
+            delete.reset_mock()
+            on_commit.call_args[0][0]()
+            delete.assert_called_once_with([key], None)
+
+        # Full saves of a user don't look up their subscriptions.
+        with queries_captured() as queries:
+            hamlet.save()
+        self.assertFalse(any('zerver_subscription' in query['sql'] for query in queries))
+
 class BulkUsersTest(ZulipTestCase):
     def test_client_gravatar_option(self) -> None:
         self.login(self.example_email('cordelia'))
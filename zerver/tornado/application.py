@@ -20,6 +20,8 @@ def create_tornado_application() -> tornado.web.Application:
     urls = (r"/notify_tornado",
             r"/json/events",
             r"/api/v1/events",
+            r"/tornado_stats",
+            r"/cleanup_event_queue",
             )
 
     # Application is an instance of Django's standard wsgi handler.
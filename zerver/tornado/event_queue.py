@@ -1,12 +1,13 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
-from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Text, Union
+from typing import cast, AbstractSet, Any, Callable, Dict, Iterator, List, \
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Text, Tuple, Union
 from mypy_extensions import TypedDict
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from collections import deque
+from contextlib import contextmanager
 import os
 import time
 import logging
@@ -18,6 +19,7 @@ import signal
 import tornado.autoreload
 import tornado.ioloop
 import random
+import heapq
 from zerver.models import UserProfile, Client
 from zerver.decorator import cachify
 from zerver.tornado.handlers import clear_handler_by_id, get_handler_by_id, \
@@ -28,8 +30,14 @@ from zerver.lib.message import MessageDict
 from zerver.lib.narrow import build_narrow_filter
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
+from zerver.lib.response import PreencodedDict, encode_event
+from zerver.lib.spans import span
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.stats import get_stats, merge_stats, record_stat
+from zerver.tornado.sharding import get_current_shard, get_tornado_uri, \
+    get_tornado_uri_for_user, get_user_shard, is_sharded, \
+    notify_tornado_queue_name, shard_filename
 import copy
 
 requests_client = requests.Session()
@@ -56,7 +64,32 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 # wireless routers that kill "inactive" http connections.
 HEARTBEAT_MIN_FREQ_SECS = 45
 
+# Per-client statistics (see zerver.tornado.stats) are only sampled
+# into statsd at this rate.
+CLIENT_STATS_STATSD_RATE = 0.01
+
+# Bound on the (approximate, JSON-encoded) size of the events held by a
+# single queue.  A queue that exceeds it (typically one whose client
+# has stopped polling but which hasn't been GC'd yet) discards its
+# events, and its client is told to re-register.
+EVENT_QUEUE_MAX_BYTES = 1024 * 1024
+
+# Changes to the event queues are appended to a journal between full
+# snapshots, so that a restart (or a crash) doesn't require dumping
+# every queue.  The journal buffer is written out this often...
+EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS = 1000
+# ...and folded into a new snapshot on the next GC pass once it grows
+# past this size.
+EVENT_QUEUE_JOURNAL_COMPACT_BYTES = 64 * 1024 * 1024
+
 class ClientDescriptor:
+    __slots__ = ['user_profile_id', 'user_profile_email', 'realm_id',
+                 'current_handler_id', 'current_client_name', 'event_queue',
+                 'queue_timeout', 'event_types', 'last_connection_time',
+                 'apply_markdown', 'client_gravatar', 'all_public_streams',
+                 'client_type_name', '_timeout_handle', '_coalesce_handle', 'narrow',
+                 'narrow_filter']
+
     def __init__(self,
                  user_profile_id: int,
                  user_profile_email: Text,
@@ -86,6 +119,8 @@ class ClientDescriptor:
         self.all_public_streams = all_public_streams
         self.client_type_name = client_type_name
         self._timeout_handle = None  # type: Any # TODO: should be return type of ioloop.call_later
+        # Pending completion of the current handler; see add_event.
+        self._coalesce_handle = None  # type: Any
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
 
@@ -145,13 +180,36 @@ class ClientDescriptor:
     def prepare_for_pickling(self) -> None:
         self.current_handler_id = None
         self._timeout_handle = None
+        self._coalesce_handle = None
 
     def add_event(self, event: Dict[str, Any]) -> None:
+        # Callers go through add_event_to_clients, which journals the event.
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_restart(handler._request)
 
         self.event_queue.push(event)
+
+        global events_added
+        events_added += 1
+
+        # For client types configured with a coalescing window, wait a
+        # few milliseconds before responding, so that a burst of events
+        # is delivered in one response rather than one round trip each.
+        coalesce_msecs = settings.EVENT_QUEUE_COALESCING_WINDOW_MSECS.get(self.client_type_name, 0)
+        if coalesce_msecs and self.current_handler_id is not None:
+            if self._coalesce_handle is None:
+                ioloop = tornado.ioloop.IOLoop.instance()
+                self._coalesce_handle = ioloop.call_later(coalesce_msecs / 1000,
+                                                          self.finish_coalesced_handler)
+            return
+
+        if self.finish_current_handler() and notification_start_time is not None:
+            record_stat('wakeup_latency', 1000 * (time.time() - notification_start_time),
+                        CLIENT_STATS_STATSD_RATE)
+
+    def finish_coalesced_handler(self) -> None:
+        self._coalesce_handle = None
         self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
@@ -178,6 +236,9 @@ class ClientDescriptor:
     def accepts_messages(self) -> bool:
         return self.event_types is None or "message" in self.event_types
 
+    def gc_deadline(self) -> float:
+        return self.last_connection_time + self.queue_timeout
+
     def idle(self, now: float) -> bool:
         if not hasattr(self, 'queue_timeout'):
             self.queue_timeout = IDLE_EVENT_QUEUE_TIMEOUT_SECS
@@ -190,11 +251,12 @@ class ClientDescriptor:
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
+        journal_queue_state(self.event_queue.id, last_connection_time=self.last_connection_time)
 
         def timeout_callback() -> None:
             self._timeout_handle = None
             # All clients get heartbeat events
-            self.add_event(dict(type='heartbeat'))
+            add_event_to_clients(dict(type='heartbeat'), [self])
         ioloop = tornado.ioloop.IOLoop.instance()
         interval = HEARTBEAT_MIN_FREQ_SECS + random.randint(0, 10)
         if self.client_type_name != 'API: heartbeat test':
@@ -214,6 +276,10 @@ class ClientDescriptor:
             ioloop = tornado.ioloop.IOLoop.instance()
             ioloop.remove_timeout(self._timeout_handle)
             self._timeout_handle = None
+        if self._coalesce_handle is not None:
+            ioloop = tornado.ioloop.IOLoop.instance()
+            ioloop.remove_timeout(self._coalesce_handle)
+            self._coalesce_handle = None
 
     def cleanup(self) -> None:
         # Before we can GC the event queue, we need to disconnect the
@@ -234,12 +300,53 @@ def compute_full_event_type(event: Mapping[str, Any]) -> str:
         return "flags/%s/%s" % (event["operation"], event["flag"])
     return event["type"]
 
+# The total of EventQueue.size over all queues, maintained
+# incrementally for the tornado.queue_memory gauge.
+queued_event_bytes = 0
+
+# How deep estimate_json_size looks into nested containers; below
+# that, each element is assumed to take ESTIMATED_ELEMENT_BYTES.
+ESTIMATE_MAX_DEPTH = 3
+ESTIMATED_ELEMENT_BYTES = 8
+
+def estimate_json_size(value: Any, depth: int=ESTIMATE_MAX_DEPTH) -> int:
+    if isinstance(value, PreencodedDict):
+        # Encoded once, and shared by every queue it's pushed to.
+        return len(value.to_json())
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, dict):
+        if depth == 0:
+            return ESTIMATED_ELEMENT_BYTES * len(value)
+        return 2 + sum(estimate_json_size(key, 0) + estimate_json_size(item, depth - 1) + 2
+                       for (key, item) in value.items())
+    if isinstance(value, (list, tuple)):
+        if depth == 0:
+            return ESTIMATED_ELEMENT_BYTES * len(value)
+        return 2 + sum(estimate_json_size(item, depth - 1) + 1 for item in value)
+    return 8
+
+def estimate_event_size(event: Dict[str, Any]) -> int:
+    """A rough size of the event's JSON encoding, for enforcing
+    EVENT_QUEUE_MAX_BYTES; encoding every event when it is pushed, as
+    well as when it is sent, would double the cost of serializing it."""
+    return estimate_json_size(event)
+
 class EventQueue:
+    __slots__ = ['queue', 'sizes', 'size', 'next_event_id', 'id', 'virtual_events',
+                 'overflowed']
+
     def __init__(self, id: str) -> None:
         self.queue = deque()  # type: ignore # Should be Deque[Dict[str, Any]], but Deque isn't available in Python 3.4
+        # The estimated size of each event in self.queue, and their total.
+        self.sizes = deque()  # type: ignore # Should be Deque[int]
+        self.size = 0  # type: int
         self.next_event_id = 0  # type: int
         self.id = id  # type: str
         self.virtual_events = {}  # type: Dict[str, Dict[str, Any]]
+        # Set once the queue has exceeded EVENT_QUEUE_MAX_BYTES and
+        # discarded its events; see fetch_events.
+        self.overflowed = False  # type: bool
 
     def to_dict(self) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
@@ -248,17 +355,32 @@ class EventQueue:
         return dict(id=self.id,
                     next_event_id=self.next_event_id,
                     queue=list(self.queue),
-                    virtual_events=self.virtual_events)
+                    sizes=list(self.sizes),
+                    virtual_events=self.virtual_events,
+                    overflowed=self.overflowed)
 
     @classmethod
     def from_dict(cls, d: Dict[str, Any]) -> 'EventQueue':
         ret = cls(d['id'])
         ret.next_event_id = d['next_event_id']
         ret.queue = deque(d['queue'])
+        if 'sizes' in d:
+            ret.sizes = deque(d['sizes'])
+        else:
+            ret.sizes = deque(estimate_event_size(event) for event in ret.queue)
+        ret.set_size(sum(ret.sizes))
         ret.virtual_events = d.get("virtual_events", {})
+        ret.overflowed = d.get("overflowed", False)
         return ret
 
+    def set_size(self, size: int) -> None:
+        global queued_event_bytes
+        queued_event_bytes += size - self.size
+        self.size = size
+
     def push(self, event: Dict[str, Any]) -> None:
+        if self.overflowed:
+            return
         event['id'] = self.next_event_id
         self.next_event_id += 1
         full_event_type = compute_full_event_type(event)
@@ -279,12 +401,27 @@ class EventQueue:
             elif full_event_type.startswith("flags/"):
                 virtual_event["messages"] += event["messages"]
         else:
+            event_size = estimate_event_size(event)
             self.queue.append(event)
+            self.sizes.append(event_size)
+            self.set_size(self.size + event_size)
+            if self.size > EVENT_QUEUE_MAX_BYTES:
+                self.overflow()
+
+    def overflow(self) -> None:
+        logging.info("Event queue %s exceeded %d bytes; discarding its events"
+                     % (self.id, EVENT_QUEUE_MAX_BYTES))
+        self.queue.clear()
+        self.sizes.clear()
+        self.set_size(0)
+        self.virtual_events = {}
+        self.overflowed = True
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self) -> Dict[str, Any]:
+        self.set_size(self.size - self.sizes.popleft())
         return self.queue.popleft()
 
     def empty(self) -> bool:
@@ -297,6 +434,7 @@ class EventQueue:
 
     def contents(self) -> List[Dict[str, Any]]:
         contents = []  # type: List[Dict[str, Any]]
+        sizes = deque()  # type: ignore # Should be Deque[int]
         virtual_id_map = {}  # type: Dict[str, Dict[str, Any]]
         for event_type in self.virtual_events:
             virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
@@ -305,17 +443,22 @@ class EventQueue:
         # Merge the virtual events into their final place in the queue
         index = 0
         length = len(virtual_ids)
-        for event in self.queue:
+        for (event, event_size) in zip(self.queue, self.sizes):
             while index < length and virtual_ids[index] < event["id"]:
                 contents.append(virtual_id_map[virtual_ids[index]])
+                sizes.append(estimate_event_size(contents[-1]))
                 index += 1
             contents.append(event)
+            sizes.append(event_size)
         while index < length:
             contents.append(virtual_id_map[virtual_ids[index]])
+            sizes.append(estimate_event_size(contents[-1]))
             index += 1
 
         self.virtual_events = {}
         self.queue = deque(contents)
+        self.sizes = sizes
+        self.set_size(sum(sizes))
         return contents
 
 # maps queue ids to client descriptors
@@ -324,6 +467,10 @@ clients = {}  # type: Dict[str, ClientDescriptor]
 user_clients = {}  # type: Dict[int, List[ClientDescriptor]]
 # maps realm id to list of client descriptors with all_public_streams=True
 realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
+# maps user id and event type to the user's client descriptors that
+# accept that event type; a lazily filled index into user_clients, so
+# that fan-out doesn't need to check every descriptor's event_types
+user_clients_by_event_type = {}  # type: Dict[int, Dict[str, List[ClientDescriptor]]]
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -332,6 +479,15 @@ realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
 # that is about to be deleted
 gc_hooks = []  # type: List[Callable[[int, ClientDescriptor, bool], None]]
 
+# A heap of (time, queue id) pairs, with an entry for each queue
+# giving the earliest time at which it could be garbage-collected.
+# Entries can be stale, since a queue's last_connection_time moves
+# forward as its client reconnects; gc_event_queues just re-checks
+# (and, if needed, re-adds) whatever entries have come due, so a GC
+# pass costs time proportional to the number of expiring queues rather
+# than the number of queues.
+gc_heap = []  # type: List[Tuple[float, str]]
+
 next_queue_id = 0
 
 def clear_client_event_queues_for_testing() -> None:
@@ -339,9 +495,14 @@ def clear_client_event_queues_for_testing() -> None:
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    user_clients_by_event_type.clear()
     gc_hooks.clear()
-    global next_queue_id
+    journal_buffer.clear()
+    journal_queue_states.clear()
+    gc_heap.clear()
+    global next_queue_id, queued_event_bytes
     next_queue_id = 0
+    queued_event_bytes = 0
 
 def add_client_gc_hook(hook: Callable[[int, ClientDescriptor, bool], None]) -> None:
     gc_hooks.append(hook)
@@ -349,25 +510,54 @@ def add_client_gc_hook(hook: Callable[[int, ClientDescriptor, bool], None]) -> N
 def get_client_descriptor(queue_id: str) -> ClientDescriptor:
     return clients.get(queue_id)
 
+def cleanup_event_queue_for_user(queue_id: str, user_profile_id: int) -> None:
+    client = get_client_descriptor(queue_id)
+    if client is None:
+        raise BadEventQueueIdError(queue_id)
+    if user_profile_id != client.user_profile_id:
+        raise JsonableError(_("You are not authorized to access this queue"))
+    client.cleanup()
+
 def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescriptor]:
     return user_clients.get(user_profile_id, [])
 
+def get_client_descriptors_for_user_event_type(user_profile_id: int,
+                                               event_type: str) -> List[ClientDescriptor]:
+    """The user's client descriptors whose event_types include
+    event_type.  For message events, callers still need to check each
+    client's narrow (via accepts_event)."""
+    if user_profile_id not in user_clients:
+        return []
+    clients_by_type = user_clients_by_event_type.setdefault(user_profile_id, {})
+    if event_type not in clients_by_type:
+        clients_by_type[event_type] = [
+            client for client in user_clients[user_profile_id]
+            if client.event_types is None or event_type in client.event_types]
+    return clients_by_type[event_type]
+
 def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
     return realm_clients_all_streams.get(realm_id, [])
 
 def add_to_client_dicts(client: ClientDescriptor) -> None:
     user_clients.setdefault(client.user_profile_id, []).append(client)
+    user_clients_by_event_type.pop(client.user_profile_id, None)
     if client.all_public_streams or client.narrow != []:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
     queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    if is_sharded():
+        # Prefix the shard, so the reverse proxy can route get_events
+        # requests to the process that owns the queue.
+        queue_id = '%d-%s' % (get_current_shard(), queue_id)
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    heapq.heappush(gc_heap, (client.gc_deadline(), queue_id))
+    journal_record("create", queue_id, client.to_dict())
     return client
 
 def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[int],
@@ -384,6 +574,7 @@ def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[
 
     for user_id in affected_users:
         filter_client_dict(user_clients, user_id)
+        user_clients_by_event_type.pop(user_id, None)
 
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
@@ -391,91 +582,289 @@ def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[
     for id in to_remove:
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
+        clients[id].event_queue.set_size(0)
         del clients[id]
+        journal_record("gc", id)
 
 def gc_event_queues() -> None:
     start = time.time()
     to_remove = set()  # type: Set[str]
     affected_users = set()  # type: Set[int]
     affected_realms = set()  # type: Set[int]
-    for (id, client) in clients.items():
+    while gc_heap and gc_heap[0][0] <= start:
+        (deadline, id) = heapq.heappop(gc_heap)
+        client = clients.get(id)
+        if client is None:
+            # Already removed, e.g. via cleanup()
+            continue
         if client.idle(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        else:
+            # Check again no earlier than the next GC pass.
+            next_deadline = max(client.gc_deadline(), start + EVENT_QUEUE_GC_FREQ_MSECS / 1000)
+            heapq.heappush(gc_heap, (next_deadline, id))
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle and thus
     # not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
 
+    gc_time = time.time() - start
     if settings.PRODUCTION:
         logging.info(('Tornado removed %d idle event queues owned by %d users in %.3fs.' +
                       '  Now %d active queues, %s')
-                     % (len(to_remove), len(affected_users), time.time() - start,
+                     % (len(to_remove), len(affected_users), gc_time,
                         len(clients), handler_stats_string()))
+    statsd.timing('tornado.gc_pause', int(1000 * gc_time))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
+    statsd.gauge('tornado.queue_memory', queued_event_bytes)
+
+    maybe_compact_event_queue_journal()
+
+# The event queue journal is a file of JSON lines, each of the form
+# [operation, queue_id, data].  Its first line is a "header" record
+# whose queue_id slot holds the journal ID; the snapshot written by
+# dump_event_queues records the ID of the journal that continues it,
+# so that a journal which was already folded into the snapshot (because
+# we crashed in the middle of compacting) is never replayed twice.
+#
+# An "event" record's queue_id slot holds the list of queues the event
+# was added to, so that an event is encoded once however many queues
+# receive it.  Clients connecting and acknowledging events don't get a
+# record each; instead, the latest such state of each queue is written
+# out as a "state" record when the journal is flushed.
+journal_enabled = False
+journal_buffer = []  # type: List[str]
+journal_queue_states = {}  # type: Dict[str, Dict[str, Any]]
+
+def journal_record(operation: str, queue_id: str, data: Any=None) -> None:
+    if not journal_enabled:
+        return
+    journal_buffer.append(ujson.dumps([operation, queue_id, data]))
+
+def journal_event(event: Dict[str, Any], event_clients: List[ClientDescriptor]) -> None:
+    if not journal_enabled or not event_clients:
+        return
+    queue_ids = [client.event_queue.id for client in event_clients]
+    # Encode immediately, since the event dicts may be mutated later.
+    journal_buffer.append('["event",%s,%s]' % (ujson.dumps(queue_ids), encode_event(event)))
+
+def journal_queue_state(queue_id: str, **state: Any) -> None:
+    if not journal_enabled:
+        return
+    journal_queue_states.setdefault(queue_id, {}).update(state)
+
+def add_event_to_clients(event: Dict[str, Any],
+                         event_clients: Iterable[ClientDescriptor]) -> None:
+    """Adds a copy of the event to each of the clients' queues, journaling
+    it just once for all of them."""
+    event_clients = list(event_clients)
+    journal_event(event, event_clients)
+    for client in event_clients:
+        client.add_event(dict(event))
+
+def flush_event_queue_journal() -> None:
+    for (queue_id, state) in journal_queue_states.items():
+        journal_buffer.append(ujson.dumps(["state", queue_id, state]))
+    journal_queue_states.clear()
+    if not journal_buffer:
+        return
+    with open(shard_filename(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME), "a") as journal:
+        journal.write("\n".join(journal_buffer) + "\n")
+    journal_buffer.clear()
+
+def replay_event_queue_journal(journal_id: Optional[str]) -> Tuple[int, Optional[int]]:
+    """Applies the journal on top of the already-loaded snapshot in
+    `clients`.  Returns the number of records replayed, and, if the
+    journal continues the snapshot, the length in bytes of its
+    complete records (for start_event_queue_journal)."""
+    replayed = 0
+    continues_snapshot = False
+    journal_length = 0
+    try:
+        with open(shard_filename(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME), "rb") as journal:
+            for (line_number, line) in enumerate(journal):
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Unterminated record")
+                    (operation, queue_id, data) = ujson.loads(line)
+                except ValueError:
+                    # A torn final write from a crash; everything
+                    # before it is still good.
+                    logging.warning("Ignoring corrupt event queue journal record on line %d"
+                                    % (line_number + 1,))
+                    break
+
+                if line_number == 0:
+                    header_id = queue_id if operation == "header" else None
+                    if header_id != journal_id:
+                        # Either this journal was already folded into
+                        # the snapshot, or the snapshot couldn't be
+                        # loaded; either way, it doesn't continue it.
+                        logging.warning("Skipping event queue journal %s, which doesn't "
+                                        "continue snapshot %s" % (header_id, journal_id))
+                        break
+                    continues_snapshot = True
+                journal_length += len(line)
+                if operation == "header":
+                    continue
+
+                if operation == "event":
+                    for event_queue_id in queue_id:
+                        if event_queue_id in clients:
+                            clients[event_queue_id].event_queue.push(dict(data))
+                elif operation == "create":
+                    clients[queue_id] = ClientDescriptor.from_dict(data)
+                elif queue_id not in clients:
+                    continue
+                elif operation == "state":
+                    client = clients[queue_id]
+                    if 'last_connection_time' in data:
+                        client.last_connection_time = data['last_connection_time']
+                    if 'pruned_through' in data:
+                        # The client received (and so acknowledged)
+                        # any virtual events up to this ID too.
+                        client.event_queue.prune(data['pruned_through'])
+                        client.event_queue.virtual_events = dict(
+                            (event_type, event) for (event_type, event)
+                            in client.event_queue.virtual_events.items()
+                            if event['id'] > data['pruned_through'])
+                elif operation == "gc":
+                    del clients[queue_id]
+                replayed += 1
+    except (IOError, EOFError):
+        pass
+    return (replayed, journal_length if continues_snapshot else None)
+
+def start_event_queue_journal(journal_id: Optional[str], journal_length: Optional[int]) -> None:
+    """Starts journaling on top of what load_event_queues just restored,
+    without writing a new snapshot.  A journal that continues the
+    snapshot is cut back to its complete records (dropping a torn
+    write from a crash, which would otherwise hide everything appended
+    after it) and appended to; otherwise, we start a new journal with
+    a fresh header continuing the snapshot.  Writing a full snapshot is
+    left to maybe_compact_event_queue_journal."""
+    filename = shard_filename(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME)
+    if journal_length is not None:
+        with open(filename, "r+b") as journal:
+            journal.truncate(journal_length)
+    else:
+        with open(filename, "w") as journal:
+            journal.write(ujson.dumps(["header", journal_id, None]) + "\n")
 
 def dump_event_queues() -> None:
+    """Writes a full snapshot of every event queue, and starts a fresh
+    journal continuing from it."""
     start = time.time()
 
-    with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in clients.items()],
+    flush_event_queue_journal()
+    journal_id = "%s:%s" % (settings.SERVER_GENERATION, start)
+    filename = shard_filename(settings.JSON_PERSISTENT_QUEUE_FILENAME)
+    with open(filename + ".tmp", "w") as stored_queues:
+        ujson.dump(dict(journal_id=journal_id,
+                        queues=[(qid, client.to_dict()) for (qid, client) in clients.items()]),
                    stored_queues)
+    os.rename(filename + ".tmp", filename)
+
+    with open(shard_filename(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME), "w") as journal:
+        journal.write(ujson.dumps(["header", journal_id, None]) + "\n")
 
     logging.info('Tornado dumped %d event queues in %.3fs'
                  % (len(clients), time.time() - start))
 
+def maybe_compact_event_queue_journal() -> None:
+    if not journal_enabled:
+        return
+    try:
+        journal_size = os.path.getsize(shard_filename(settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME))
+    except OSError:
+        journal_size = 0
+    if journal_size >= EVENT_QUEUE_JOURNAL_COMPACT_BYTES:
+        dump_event_queues()
+
 def load_event_queues() -> None:
-    global clients
+    global clients, queued_event_bytes
     start = time.time()
+    journal_id = None  # type: Optional[str]
 
     # ujson chokes on bad input pretty easily.  We separate out the actual
     # file reading from the loading so that we don't silently fail if we get
     # bad input.
     try:
-        with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "r") as stored_queues:
+        with open(shard_filename(settings.JSON_PERSISTENT_QUEUE_FILENAME), "r") as stored_queues:
             json_data = stored_queues.read()
         try:
+            snapshot = ujson.loads(json_data)
+            if isinstance(snapshot, dict):
+                journal_id = snapshot['journal_id']
+                snapshot = snapshot['queues']
             clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
+                           for (qid, client) in snapshot)
         except Exception:
             logging.exception("Could not deserialize event queues")
     except (IOError, EOFError):
         pass
 
+    replay_failed = False
+    try:
+        (replayed, journal_length) = replay_event_queue_journal(journal_id)
+    except Exception:
+        logging.exception("Could not replay event queue journal")
+        replay_failed = True
+        replayed = 0
+
+    queued_event_bytes = 0
     for client in clients.values():
         # Put code for migrations due to event queue data format changes here
 
         add_to_client_dicts(client)
-
-    logging.info('Tornado loaded %d event queues in %.3fs'
-                 % (len(clients), time.time() - start))
+        gc_heap.append((client.gc_deadline(), client.event_queue.id))
+        queued_event_bytes += client.event_queue.size
+    heapq.heapify(gc_heap)
+
+    logging.info('Tornado loaded %d event queues (%d journal records) in %.3fs'
+                 % (len(clients), replayed, time.time() - start))
+
+    if journal_enabled:
+        if replay_failed:
+            # We can't tell how much of the journal was applied, so
+            # only a new snapshot matches what we've loaded.
+            dump_event_queues()
+        else:
+            start_event_queue_journal(journal_id, journal_length)
 
 def send_restart_events(immediate: bool=False) -> None:
     event = dict(type='restart', server_generation=settings.SERVER_GENERATION)  # type: Dict[str, Any]
     if immediate:
         event['immediate'] = True
-    for client in clients.values():
-        if client.accepts_event(event):
-            client.add_event(event.copy())
+    add_event_to_clients(event, [client for client in clients.values()
+                                 if client.accepts_event(event)])
 
 def setup_event_queue() -> None:
+    global journal_enabled
+    ioloop = tornado.ioloop.IOLoop.instance()
+
     if not settings.TEST_SUITE:
+        # Enabled before loading, so that load_event_queues sets the
+        # journal up to continue from what it restores.
+        journal_enabled = True
         load_event_queues()
-        atexit.register(dump_event_queues)
-        # Make sure we dump event queues even if we exit via signal
+        # Since every change is journaled, shutting down only requires
+        # writing out what's still buffered.
+        atexit.register(flush_event_queue_journal)
+        # Make sure we flush the journal even if we exit via signal
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
-        tornado.autoreload.add_reload_hook(dump_event_queues)
+        tornado.autoreload.add_reload_hook(flush_event_queue_journal)
 
-    try:
-        os.rename(settings.JSON_PERSISTENT_QUEUE_FILENAME, "/var/tmp/event_queues.json.last")
-    except OSError:
-        pass
+        journal_pc = tornado.ioloop.PeriodicCallback(flush_event_queue_journal,
+                                                     EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS,
+                                                     ioloop)
+        journal_pc.start()
 
     # Set up event queue garbage collection
-    ioloop = tornado.ioloop.IOLoop.instance()
     pc = tornado.ioloop.PeriodicCallback(gc_event_queues,
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
@@ -498,6 +887,13 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
         extra_log_data = ""
         if queue_id is None:
             if dont_block:
+                if get_user_shard(user_profile_id) != get_current_shard():
+                    # send_event only routes this user's events to
+                    # their own shard, so a queue here would never get
+                    # any; they need to register through Django, which
+                    # allocates it on the right one.
+                    raise JsonableError(_("Event queues for this user are not hosted "
+                                          "by this server; use /register instead"))
                 client = allocate_client_descriptor(new_queue_data)
                 queue_id = client.event_queue.id
             else:
@@ -510,7 +906,13 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
                 raise BadEventQueueIdError(queue_id)
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
+            if client.event_queue.overflowed:
+                # The queue had to discard events, so the client
+                # needs to re-register to get a consistent state.
+                client.cleanup()
+                raise BadEventQueueIdError(queue_id)
             client.event_queue.prune(last_event_id)
+            journal_queue_state(queue_id, pruned_through=last_event_id)
             was_connected = client.finish_current_handler()
 
         if not client.event_queue.empty() or dont_block:
@@ -554,7 +956,8 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
                         event_types: Optional[Iterable[str]]=None,
                         all_public_streams: bool=False,
                         narrow: Iterable[Sequence[Text]]=[]) -> Optional[str]:
-    if settings.TORNADO_SERVER:
+    tornado_uri = get_tornado_uri_for_user(user_profile.id)
+    if tornado_uri:
         req = {'dont_block': 'true',
                'apply_markdown': ujson.dumps(apply_markdown),
                'client_gravatar': ujson.dumps(client_gravatar),
@@ -567,7 +970,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
             req['event_types'] = ujson.dumps(event_types)
 
         try:
-            resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+            resp = requests_client.get(tornado_uri + '/api/v1/events',
                                        auth=requests.auth.HTTPBasicAuth(
                                            user_profile.email, user_profile.api_key),
                                        params=req)
@@ -577,7 +980,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
                           (settings.ERROR_FILE_LOG_PATH, "tornado.log"))
             raise requests.adapters.ConnectionError(
                 "Django cannot connect to Tornado server (%s); try restarting" %
-                (settings.TORNADO_SERVER))
+                (tornado_uri,))
 
         resp.raise_for_status()
 
@@ -586,8 +989,9 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
     return None
 
 def get_user_events(user_profile: UserProfile, queue_id: str, last_event_id: int) -> List[Dict[Any, Any]]:
-    if settings.TORNADO_SERVER:
-        resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+    tornado_uri = get_tornado_uri_for_user(user_profile.id)
+    if tornado_uri:
+        resp = requests_client.get(tornado_uri + '/api/v1/events',
                                    auth=requests.auth.HTTPBasicAuth(
                                        user_profile.email, user_profile.api_key),
                                    params={'queue_id': queue_id,
@@ -600,6 +1004,32 @@ def get_user_events(user_profile: UserProfile, queue_id: str, last_event_id: int
         return extract_json_response(resp)['events']
     return []
 
+def fetch_tornado_stats() -> Dict[str, Dict[str, Any]]:
+    """The event delivery histograms of every Tornado shard, merged."""
+    all_stats = []
+    for shard in range(settings.TORNADO_PROCESSES):
+        tornado_uri = get_tornado_uri(shard)
+        if tornado_uri and not settings.RUNNING_INSIDE_TORNADO:
+            resp = requests_client.post(tornado_uri + '/tornado_stats',
+                                        data=dict(secret=settings.SHARED_SECRET))
+            resp.raise_for_status()
+            all_stats.append(extract_json_response(resp)['stats'])
+        else:
+            all_stats.append(get_stats())
+    return merge_stats(all_stats)
+
+def forward_cleanup_event_queue(shard: int, queue_id: str,
+                                user_profile_id: int) -> requests.Response:
+    """Deletes an event queue owned by another shard, on the user's behalf.
+    This blocks the calling Tornado process, but only on a local request
+    which doesn't wait on anything."""
+    tornado_uri = get_tornado_uri(shard)
+    assert tornado_uri is not None
+    return requests_client.post(tornado_uri + '/cleanup_event_queue',
+                                data=dict(queue_id=queue_id,
+                                          user_profile_id=user_profile_id,
+                                          secret=settings.SHARED_SECRET))
+
 # Send email notifications to idle users
 # after they are idle for 1 hour
 NOTIFY_AFTER_IDLE_HOURS = 1
@@ -674,8 +1104,7 @@ def missedmessage_hook(user_profile_id: int, client: ClientDescriptor, last_for_
 def receiver_is_off_zulip(user_profile_id: int) -> bool:
     # If a user has no message-receiving event queues, they've got no open zulip
     # session so we notify them
-    all_client_descriptors = get_client_descriptors_for_user(user_profile_id)
-    message_event_queues = [client for client in all_client_descriptors if client.accepts_messages()]
+    message_event_queues = get_client_descriptors_for_user_event_type(user_profile_id, "message")
     off_zulip = len(message_event_queues) == 0
     return off_zulip
 
@@ -754,7 +1183,7 @@ def get_client_info_for_message_event(event_template: Mapping[str, Any],
         user_profile_id = user_data['id']  # type: int
         flags = user_data.get('flags', [])  # type: Iterable[str]
 
-        for client in get_client_descriptors_for_user(user_profile_id):
+        for client in get_client_descriptors_for_user_event_type(user_profile_id, "message"):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=flags,
@@ -779,7 +1208,9 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
     def get_client_payload(apply_markdown: bool, client_gravatar: bool) -> Dict[str, Any]:
         dct = copy.deepcopy(wide_dict)
         MessageDict.finalize_payload(dct, apply_markdown, client_gravatar)
-        return dct
+        # Shared by every client using this variant, so that its JSON
+        # encoding is only computed once for all of their responses.
+        return PreencodedDict(dct)
 
     # Extra user-specific data to include
     extra_user_data = {}  # type: Dict[int, Any]
@@ -806,6 +1237,10 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
             result['stream_push_notify'] = stream_push_notify
             extra_user_data[user_profile_id] = result
 
+    # Clients that get identical events (e.g. a user's clients using the
+    # same payload variant) share a single event, which is journaled once.
+    events_by_key = {}  # type: Dict[Tuple[Any, ...], Tuple[Dict[str, Any], List[ClientDescriptor]]]
+
     for client_data in send_to_clients.values():
         client = client_data['client']
         flags = client_data['flags']
@@ -841,13 +1276,21 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
         if ('mirror' in sending_client and
                 sending_client.lower() == client.client_type_name.lower()):
             continue
-        client.add_event(user_event)
+
+        key = (id(message_dict), client.user_profile_id,
+               None if flags is None else tuple(flags), is_sender)
+        events_by_key.setdefault(key, (user_event, []))[1].append(client)
+
+    for (user_event, event_clients) in events_by_key.values():
+        add_event_to_clients(user_event, event_clients)
 
 def process_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
-    for user_profile_id in users:
-        for client in get_client_descriptors_for_user(user_profile_id):
-            if client.accepts_event(event):
-                client.add_event(dict(event))
+    # Only message events need a per-client check (of the narrow), and
+    # they go through process_message_event instead.
+    event_type = event["type"]
+    add_event_to_clients(dict(event), [
+        client for user_profile_id in users
+        for client in get_client_descriptors_for_user_event_type(user_profile_id, event_type)])
 
 def process_userdata_event(event_template: Mapping[str, Any], users: Iterable[Mapping[str, Any]]) -> None:
     for user_data in users:
@@ -857,12 +1300,20 @@ def process_userdata_event(event_template: Mapping[str, Any], users: Iterable[Ma
             if key != "id":
                 user_event[key] = user_data[key]
 
-        for client in get_client_descriptors_for_user(user_profile_id):
-            if client.accepts_event(user_event):
-                client.add_event(user_event)
+        add_event_to_clients(user_event, get_client_descriptors_for_user_event_type(
+            user_profile_id, user_event["type"]))
 
 def process_message_update_event(event_template: Mapping[str, Any],
-                                 users: Iterable[Mapping[str, Any]]) -> None:
+                                 users: Iterable[Union[int, Mapping[str, Any]]]) -> None:
+    # do_update_message sends a list of user IDs, with their flags
+    # grouped by value in the event; see get_message_update_event_users.
+    flags_by_user_id = {}  # type: Dict[int, List[str]]
+    if 'user_flags_groups' in event_template:
+        event_template = dict(event_template)
+        for group in event_template.pop('user_flags_groups'):
+            for user_id in group['user_ids']:
+                flags_by_user_id[user_id] = group['flags']
+
     prior_mention_user_ids = set(event_template.get('prior_mention_user_ids', []))
     mention_user_ids = set(event_template.get('mention_user_ids', []))
     presence_idle_user_ids = set(event_template.get('presence_idle_user_ids', []))
@@ -873,6 +1324,8 @@ def process_message_update_event(event_template: Mapping[str, Any],
     message_id = event_template['message_id']
 
     for user_data in users:
+        if isinstance(user_data, int):
+            user_data = dict(id=user_data, flags=flags_by_user_id.get(user_data, []))
         user_profile_id = user_data['id']
         user_event = dict(event_template)  # shallow copy, but deep enough for our needs
         for key in user_data.keys():
@@ -890,9 +1343,8 @@ def process_message_update_event(event_template: Mapping[str, Any],
             push_notify_user_ids=push_notify_user_ids,
         )
 
-        for client in get_client_descriptors_for_user(user_profile_id):
-            if client.accepts_event(user_event):
-                client.add_event(user_event)
+        add_event_to_clients(user_event, get_client_descriptors_for_user_event_type(
+            user_profile_id, user_event["type"]))
 
 def maybe_enqueue_notifications_for_message_update(user_profile_id: UserProfile,
                                                    message_id: int,
@@ -945,42 +1397,129 @@ def maybe_enqueue_notifications_for_message_update(user_profile_id: UserProfile,
         already_notified={},
     )
 
+# For instrumentation: the number of events added to any queue, and
+# the time at which we started processing the current notification.
+events_added = 0
+notification_start_time = None  # type: Optional[float]
+
 def process_notification(notice: Mapping[str, Any]) -> None:
+    global notification_start_time
+    if 'notices' in notice:
+        # A batch from batch_events(); handle it in a single pass.
+        for batched_notice in notice['notices']:
+            process_notification(batched_notice)
+        return
+
     event = notice['event']  # type: Mapping[str, Any]
     users = notice['users']  # type: Union[List[int], List[Mapping[str, Any]]]
     start_time = time.time()
-    if event['type'] == "message":
-        process_message_event(event, cast(Iterable[Mapping[str, Any]], users))
-    elif event['type'] == "update_message":
-        process_message_update_event(event, cast(Iterable[Mapping[str, Any]], users))
-    elif event['type'] == "delete_message":
-        process_userdata_event(event, cast(Iterable[Mapping[str, Any]], users))
-    else:
-        process_event(event, cast(Iterable[int], users))
+    start_events_added = events_added
+    notification_start_time = start_time
+    try:
+        if event['type'] == "message":
+            process_message_event(event, cast(Iterable[Mapping[str, Any]], users))
+        elif event['type'] == "update_message":
+            process_message_update_event(event, cast(Iterable[Union[int, Mapping[str, Any]]], users))
+        elif event['type'] == "delete_message":
+            process_userdata_event(event, cast(Iterable[Mapping[str, Any]], users))
+        else:
+            process_event(event, cast(Iterable[int], users))
+    finally:
+        notification_start_time = None
+
+    fanout_time = 1000 * (time.time() - start_time)
+    record_stat('fanout_time.%s' % (event['type'],), fanout_time)
+    record_stat('fanout_clients.%s' % (event['type'],), events_added - start_events_added)
     logging.debug("Tornado: Event %s for %s users took %sms" % (
-        event['type'], len(users), int(1000 * (time.time() - start_time))))
+        event['type'], len(users), int(fanout_time)))
 
 # Runs in the Django process to send a notification to Tornado.
 #
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(data: Mapping[str, Any]) -> None:
-    if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        requests_client.post(settings.TORNADO_SERVER + '/notify_tornado', data=dict(
+def send_notification_http(data: Mapping[str, Any], shard: int=0) -> None:
+    tornado_uri = get_tornado_uri(shard)
+    if tornado_uri and not settings.RUNNING_INSIDE_TORNADO:
+        requests_client.post(tornado_uri + '/notify_tornado', data=dict(
             data   = ujson.dumps(data),
             secret = settings.SHARED_SECRET))
     else:
-        process_notification(data)
+        # There's no per-notice overhead to save when delivering
+        # in-process, so unpack batches; this also means that code
+        # watching process_notification (e.g. in tests) sees the same
+        # notices with or without batching.
+        for notice in data.get('notices', [data]):
+            process_notification(notice)
 
 def send_notification(data: Dict[str, Any]) -> None:
     queue_json_publish("notify_tornado", data, send_notification_http)
 
+def publish_notice(shard: int, notice: Dict[str, Any]) -> None:
+    with span('event_publish'):
+        queue_json_publish(notify_tornado_queue_name(shard), notice,
+                           lambda data: send_notification_http(data, shard))
+
+# While inside a batch_events() block, the (shard, notice) pairs that
+# send_event has queued up for publishing when the block exits.
+batched_notices = None  # type: Optional[List[Tuple[int, Dict[str, Any]]]]
+
+@contextmanager
+def batch_events() -> Iterator[None]:
+    """Coalesces the events sent within the block into a single
+    notify_tornado message (per shard), which Tornado processes in one
+    pass, rather than publishing one message per send_event call.  This
+    is meant for bulk operations which send many small events; callers
+    must not modify events or user lists after passing them to
+    send_event.  Can also be used as a decorator, and nests.  If the
+    block raises, the events it sent before that are still published."""
+    global batched_notices
+    if batched_notices is not None:
+        yield
+        return
+
+    batched_notices = []
+    try:
+        yield
+    finally:
+        # Even if the block failed, the changes it had sent events for
+        # were already made, and may have been committed (e.g. by
+        # bulk_add_subscriptions), just as without batching.
+        notices = batched_notices
+        batched_notices = None
+        notices_by_shard = {}  # type: Dict[int, List[Dict[str, Any]]]
+        for (shard, notice) in notices:
+            notices_by_shard.setdefault(shard, []).append(notice)
+        for (shard, shard_notices) in notices_by_shard.items():
+            if len(shard_notices) == 1:
+                publish_notice(shard, shard_notices[0])
+            else:
+                publish_notice(shard, dict(notices=shard_notices))
+
 def send_event(event: Mapping[str, Any],
                users: Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None:
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    queue_json_publish("notify_tornado",
-                       dict(event=event, users=users),
-                       send_notification_http)
+    if not is_sharded():
+        notices = [(0, dict(event=event, users=users))]
+    else:
+        users_by_shard = {}  # type: Dict[int, List[Any]]
+        for user in users:
+            user_profile_id = user['id'] if isinstance(user, dict) else user
+            users_by_shard.setdefault(get_user_shard(user_profile_id), []).append(user)
+
+        shards = list(users_by_shard.keys())
+        if event['type'] == 'message' and 'stream_name' in event and not event.get('invite_only'):
+            # Clients registered for all public streams (or a narrow) get
+            # public stream messages regardless of the recipients, and
+            # can live on any shard.
+            shards = list(range(settings.TORNADO_PROCESSES))
+        notices = [(shard, dict(event=event, users=users_by_shard.get(shard, [])))
+                   for shard in shards]
+
+    if batched_notices is not None:
+        batched_notices.extend(notices)
+        return
+    for (shard, notice) in notices:
+        publish_notice(shard, notice)
@@ -23,6 +23,10 @@ from zerver.decorator import RespondAsynchronously
 from zerver.lib.response import json_response
 from zerver.middleware import async_request_restart, async_request_stop
 from zerver.tornado.descriptors import get_descriptor_by_handler_id
+from zerver.tornado.stats import record_stat
+
+# See CLIENT_STATS_STATSD_RATE in zerver.tornado.event_queue.
+RESPONSE_STATS_STATSD_RATE = 0.01
 
 current_handler_id = 0
 handlers = {}  # type: Dict[int, 'AsyncDjangoHandler']
@@ -349,4 +353,5 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # Pass through the content-type from Django, as json content should be
         # served as application/json
         self.set_header("Content-Type", django_response['Content-Type'])
+        record_stat('response_bytes', len(django_response.content), RESPONSE_STATS_STATSD_RATE)
         self.finish(django_response.content)
@@ -0,0 +1,65 @@
+from typing import Optional, Text
+
+from django.conf import settings
+
+# Support for running several Tornado processes, each owning the event
+# queues for a subset of users.  Django routes notices and queue
+# requests for a user to the process owning that user's shard; with the
+# default of a single process, everything goes to TORNADO_SERVER and
+# the `notify_tornado` queue, as before.
+
+# The shard owned by this process; set by runtornado.
+current_shard = 0
+
+def is_sharded() -> bool:
+    return settings.TORNADO_PROCESSES > 1
+
+def get_user_shard(user_profile_id: int) -> int:
+    return user_profile_id % settings.TORNADO_PROCESSES
+
+def get_shard_for_port(port: int) -> int:
+    if not is_sharded():
+        return 0
+    return settings.TORNADO_PORTS.index(port)
+
+def get_queue_shard(queue_id: Text) -> Optional[int]:
+    """The shard owning an event queue, from the prefix its ID gets when
+    sharded, or None if the ID doesn't name one."""
+    if not is_sharded():
+        return 0
+    (shard, sep, rest) = queue_id.partition('-')
+    if not sep or not shard.isdigit() or int(shard) >= settings.TORNADO_PROCESSES:
+        return None
+    return int(shard)
+
+def get_current_shard() -> int:
+    return current_shard
+
+def set_current_shard(shard: int) -> None:
+    global current_shard
+    current_shard = shard
+
+def get_tornado_uri(shard: int) -> Optional[Text]:
+    if not settings.TORNADO_SERVER or not is_sharded():
+        return settings.TORNADO_SERVER
+    return 'http://127.0.0.1:%d' % (settings.TORNADO_PORTS[shard],)
+
+def get_tornado_uri_for_user(user_profile_id: int) -> Optional[Text]:
+    return get_tornado_uri(get_user_shard(user_profile_id))
+
+def notify_tornado_queue_name(shard: int) -> str:
+    if shard == 0:
+        return 'notify_tornado'
+    return 'notify_tornado_%d' % (shard,)
+
+def tornado_return_queue_name(shard: int) -> str:
+    if shard == 0:
+        return 'tornado_return'
+    return 'tornado_return_%d' % (shard,)
+
+def shard_filename(filename: str) -> str:
+    """Per-process variant of a Tornado state file, so shards don't
+    clobber each other's persisted event queues."""
+    if not is_sharded():
+        return filename
+    return '%s.%d' % (filename, current_shard)
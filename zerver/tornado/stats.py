@@ -0,0 +1,76 @@
+import bisect
+from typing import Any, Dict, List, Optional
+
+from zerver.lib.utils import statsd
+
+# Histograms of how Tornado spends its time delivering events, exposed
+# via statsd and the /json/tornado/stats endpoint, which merges those of
+# every Tornado shard.  Buckets are powers of two, which suits both the
+# millisecond and the byte-count metrics.
+HISTOGRAM_BUCKETS = [2 ** i for i in range(25)]
+
+class Histogram:
+    def __init__(self) -> None:
+        # counts[i] counts the values <= HISTOGRAM_BUCKETS[i] (and greater
+        # than the previous bound); the final entry counts the rest.
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        buckets = [[bound, count] for (bound, count) in zip(HISTOGRAM_BUCKETS, self.counts)
+                   if count]
+        if self.counts[-1]:
+            buckets.append([None, self.counts[-1]])
+        return dict(count=self.count,
+                    mean=self.total / self.count if self.count else 0,
+                    max=self.max,
+                    buckets=buckets)
+
+histograms = {}  # type: Dict[str, Histogram]
+
+def record_stat(name: str, value: float, statsd_rate: float=1) -> None:
+    """Records a data point in the named histogram.  Metrics recorded
+    once per client (rather than once per event) should pass a low
+    statsd_rate, so we don't send statsd a packet per client."""
+    if name not in histograms:
+        histograms[name] = Histogram()
+    histograms[name].add(value)
+    statsd.timing('tornado.%s' % (name,), value, statsd_rate)
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: histogram.to_dict() for (name, histogram) in histograms.items()}
+
+def merge_stats(all_stats: List[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Combines the get_stats() results of several Tornado processes."""
+    merged = {}  # type: Dict[str, Dict[str, Any]]
+    for stats in all_stats:
+        for (name, histogram) in stats.items():
+            if name not in merged:
+                merged[name] = dict(count=0, total=0.0, max=0, buckets={})
+            totals = merged[name]
+            totals['count'] += histogram['count']
+            totals['total'] += histogram['mean'] * histogram['count']
+            totals['max'] = max(totals['max'], histogram['max'])
+            for (bound, count) in histogram['buckets']:
+                totals['buckets'][bound] = totals['buckets'].get(bound, 0) + count
+
+    # None, the bound of the overflow bucket, sorts last.
+    def bucket_order(bound: Optional[int]) -> float:
+        return float('inf') if bound is None else bound
+    return {name: dict(count=totals['count'],
+                       mean=totals['total'] / totals['count'] if totals['count'] else 0,
+                       max=totals['max'],
+                       buckets=[[bound, totals['buckets'][bound]]
+                                for bound in sorted(totals['buckets'], key=bucket_order)])
+            for (name, totals) in merged.items()}
+
+def clear_stats_for_testing() -> None:
+    histograms.clear()
@@ -5,17 +5,18 @@ from typing import Iterable, List, Optional, Sequence, Text, Union
 import ujson
 from django.core.handlers.base import BaseHandler
 from django.http import HttpRequest, HttpResponse
-from django.utils.translation import ugettext as _
 
 from zerver.decorator import REQ, RespondAsynchronously, \
     _RespondAsynchronously, asynchronous, \
     has_request_variables, internal_notify_view
-from zerver.lib.response import json_error, json_success
+from zerver.lib.response import json_success
 from zerver.lib.validator import check_bool, check_list, check_string
 from zerver.models import Client, UserProfile, get_client
-from zerver.tornado.event_queue import fetch_events, \
-    get_client_descriptor, process_notification
-from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.event_queue import cleanup_event_queue_for_user, fetch_events, \
+    forward_cleanup_event_queue, process_notification
+from zerver.tornado.sharding import get_current_shard, get_queue_shard, get_tornado_uri
+from zerver.tornado.handlers import RESPONSE_STATS_STATSD_RATE
+from zerver.tornado.stats import get_stats, record_stat
 
 @internal_notify_view(True)
 def notify(request: HttpRequest) -> HttpResponse:
@@ -25,13 +26,23 @@ def notify(request: HttpRequest) -> HttpResponse:
 @has_request_variables
 def cleanup_event_queue(request: HttpRequest, user_profile: UserProfile,
                         queue_id: Text=REQ()) -> HttpResponse:
-    client = get_client_descriptor(str(queue_id))
-    if client is None:
-        raise BadEventQueueIdError(queue_id)
-    if user_profile.id != client.user_profile_id:
-        return json_error(_("You are not authorized to access this queue"))
     request._log_data['extra'] = "[%s]" % (queue_id,)
-    client.cleanup()
+    shard = get_queue_shard(queue_id)
+    if shard is not None and shard != get_current_shard() and get_tornado_uri(shard):
+        # nginx routes requests to a queue's shard by the queue_id in
+        # the query string, but DELETE sends it in the body, so these
+        # arrive at shard 0; hand them on to the queue's owner.
+        resp = forward_cleanup_event_queue(shard, queue_id, user_profile.id)
+        return HttpResponse(resp.content, status=resp.status_code,
+                            content_type=resp.headers.get('Content-Type'))
+    cleanup_event_queue_for_user(str(queue_id), user_profile.id)
+    return json_success()
+
+@internal_notify_view(True)
+@has_request_variables
+def cleanup_event_queue_internal(request: HttpRequest, queue_id: Text=REQ(),
+                                 user_profile_id: int=REQ(converter=int)) -> HttpResponse:
+    cleanup_event_queue_for_user(str(queue_id), user_profile_id)
     return json_success()
 
 @asynchronous
@@ -87,4 +98,10 @@ def get_events_backend(request: HttpRequest, user_profile: UserProfile, handler:
         return RespondAsynchronously
     if result["type"] == "error":
         raise result["exception"]
-    return json_success(result["response"])
+    response = json_success(result["response"])
+    record_stat('response_bytes', len(response.content), RESPONSE_STATS_STATSD_RATE)
+    return response
+
+@internal_notify_view(True)
+def get_tornado_stats(request: HttpRequest) -> HttpResponse:
+    return json_success(dict(stats=get_stats()))
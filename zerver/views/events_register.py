@@ -2,11 +2,13 @@
 from django.http import HttpRequest, HttpResponse
 from typing import Iterable, Optional, Sequence, Text
 
+from zerver.decorator import require_server_admin_api
 from zerver.lib.events import do_events_register
 from zerver.lib.request import REQ, has_request_variables
 from zerver.lib.response import json_success
 from zerver.lib.validator import check_string, check_list, check_bool
 from zerver.models import Stream, UserProfile
+from zerver.tornado.event_queue import fetch_tornado_stats
 
 def _default_all_public_streams(user_profile: UserProfile,
                                 all_public_streams: Optional[bool]) -> bool:
@@ -43,3 +45,7 @@ def events_register_backend(
                              narrow=narrow, include_subscribers=include_subscribers,
                              fetch_event_types=fetch_event_types)
     return json_success(ret)
+
+@require_server_admin_api
+def get_tornado_stats_backend(request: HttpRequest, user_profile: UserProfile) -> HttpResponse:
+    return json_success(dict(stats=fetch_tornado_stats()))
@@ -5,12 +5,12 @@ from django.conf import settings
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.db import connection
-from django.http import HttpRequest, HttpResponse
-from typing import Dict, List, Set, Text, Any, Callable, Iterable, \
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from typing import Dict, List, Set, Text, Any, Callable, Iterable, Iterator, \
     Optional, Tuple, Union, Sequence
 from zerver.lib.exceptions import JsonableError, ErrorCode
 from zerver.lib.html_diff import highlight_html_differences
-from zerver.decorator import has_request_variables, \
+from zerver.decorator import has_request_variables, rate_limit_user, \
     REQ, to_non_negative_int
 from django.utils.html import escape as escape_html
 from zerver.lib import bugdown
@@ -19,7 +19,9 @@ from zerver.lib.actions import recipient_for_emails, do_update_message_flags, \
     create_mirror_user_if_needed, check_send_message, do_update_message, \
     extract_recipients, truncate_body, render_incoming_message, do_delete_message, \
     do_mark_all_as_read, do_mark_stream_messages_as_read, \
-    get_user_info_for_message_updates, check_schedule_message
+    get_user_info_for_message_updates, check_schedule_message, check_message, \
+    do_send_messages
+from zerver.lib.addressee import Addressee
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.message import (
     access_message,
@@ -28,14 +30,15 @@ from zerver.lib.message import (
     get_first_visible_message_id,
 )
 from zerver.lib.response import json_success, json_error
-from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
+from zerver.lib.sqlalchemy_utils import execute_query_template, get_query_template, \
+    get_sqlalchemy_connection
 from zerver.lib.streams import access_stream_by_id, is_public_stream_by_name
 from zerver.lib.timestamp import datetime_to_timestamp, convert_to_UTC
 from zerver.lib.timezone import get_timezone
 from zerver.lib.topic_mutes import exclude_topic_mutes
 from zerver.lib.utils import statsd
 from zerver.lib.validator import \
-    check_list, check_int, check_dict, check_string, check_bool
+    check_list, check_int, check_dict, check_string, check_bool, check_variable_type
 from zerver.models import Message, UserProfile, Stream, Subscription, Client,\
     Realm, RealmDomain, Recipient, UserMessage, bulk_get_recipients, get_personal_recipient, \
     get_stream, email_to_domain, get_realm, get_active_streams, \
@@ -43,7 +46,8 @@ from zerver.models import Message, UserProfile, Stream, Subscription, Client,\
 
 from sqlalchemy import func
 from sqlalchemy.sql import select, join, column, literal_column, literal, and_, \
-    or_, not_, union_all, alias, Selectable, Select, ColumnElement, table
+    or_, not_, union_all, alias, Selectable, Select, ColumnElement, table, bindparam
+from sqlalchemy.sql.elements import BindParameter
 
 from dateutil.parser import parse as dateparser
 import re
@@ -69,6 +73,24 @@ Query = Any
 # TODO: should be Callable[[ColumnElement], ColumnElement], but sqlalchemy stubs are busted
 ConditionTransform = Any
 
+class ShapeOnlyQuery:
+    '''
+    Stands in for the query when we only need a narrow's shape and
+    parameters from NarrowBuilder (see get_narrow_query), so that we
+    don't build a query we already have compiled.  Everything the
+    `by_*` methods add to it is dropped.
+    '''
+    froms = [table("zerver_message")]
+
+    def where(self, *args: Any) -> 'ShapeOnlyQuery':
+        return self
+
+    def column(self, *args: Any) -> 'ShapeOnlyQuery':
+        return self
+
+    def select_from(self, *args: Any) -> 'ShapeOnlyQuery':
+        return self
+
 # When you add a new operator to this, also update zerver/lib/narrow.py
 class NarrowBuilder:
     '''
@@ -96,6 +118,33 @@ class NarrowBuilder:
         self.user_profile = user_profile
         self.msg_id_column = msg_id_column
         self.user_realm = user_profile.realm
+        # The shape of the query built so far: for each term, its
+        # operator and whether it's negated, plus whatever else (like
+        # which branch a `by_*` method took) determines the structure of
+        # the SQL, as opposed to just the values of its parameters.
+        # Queries with the same shape compile to the same SQL; see
+        # get_query_template.  A method which adds conditions whose
+        # structure we don't track sets `cacheable` to False.
+        self.shape = []  # type: List[Tuple[Any, ...]]
+        self.cacheable = True
+        # The values of the parameters added with `bind`, by name.
+        self.params = {}  # type: Dict[str, Any]
+
+    def note_shape(self, *details: Any) -> None:
+        self.shape[-1] += details
+
+    def bind(self, value: Any) -> BindParameter:
+        '''
+        A bound parameter for a value which can differ between queries of
+        the same shape (e.g. an operand, or an ID looked up from one).
+        These are named by the order the builder adds them in, which
+        only depends on the shape, so that get_query_template can fill
+        them into the template by name.  Values which are the same for
+        every query of a shape (e.g. flag masks) can be plain literals.
+        '''
+        name = 'narrow_%d' % (len(self.params) + 1,)
+        self.params[name] = value
+        return bindparam(name, value)
 
     def add_term(self, query: Query, term: Dict[str, Any]) -> Query:
         """
@@ -122,6 +171,7 @@ class NarrowBuilder:
         method = getattr(self, method_name, None)
         if method is None:
             raise BadNarrowOperator('unknown operator ' + operator)
+        self.shape.append((operator, negated))
 
         if negated:
             maybe_negate = not_
@@ -134,12 +184,16 @@ class NarrowBuilder:
         if operand not in ['attachment', 'image', 'link']:
             raise BadNarrowOperator("unknown 'has' operand " + operand)
         col_name = 'has_' + operand
+        self.note_shape(operand)
         cond = column(col_name)
         return query.where(maybe_negate(cond))
 
     def by_in(self, query: Query, operand: str, maybe_negate: ConditionTransform) -> Query:
+        self.note_shape(operand)
         if operand == 'home':
             conditions = exclude_muting_conditions(self.user_profile, [])
+            # These depend on how many streams and topics the user has muted.
+            self.cacheable = False
             return query.where(and_(*conditions))
         elif operand == 'all':
             return query
@@ -147,6 +201,7 @@ class NarrowBuilder:
         raise BadNarrowOperator("unknown 'in' operand " + operand)
 
     def by_is(self, query: Query, operand: str, maybe_negate: ConditionTransform) -> Query:
+        self.note_shape(operand)
         if operand == 'private':
             # The `.select_from` method extends the query with a join.
             query = query.select_from(join(query.froms[0], table("zerver_recipient"),
@@ -223,11 +278,13 @@ class NarrowBuilder:
                 name__iregex=r'^(un)*%s(\.d)*$' % (self._pg_re_escape(base_stream_name),))
             matching_stream_ids = [matching_stream.id for matching_stream in matching_streams]
             recipients_map = bulk_get_recipients(Recipient.STREAM, matching_stream_ids)
-            cond = column("recipient_id").in_([recipient.id for recipient in recipients_map.values()])
+            self.note_shape('zephyr', len(recipients_map))
+            cond = column("recipient_id").in_([self.bind(recipient.id)
+                                               for recipient in recipients_map.values()])
             return query.where(maybe_negate(cond))
 
         recipient = get_stream_recipient(stream.id)
-        cond = column("recipient_id") == recipient.id
+        cond = column("recipient_id") == self.bind(recipient.id)
         return query.where(maybe_negate(cond))
 
     def by_topic(self, query: Query, operand: str, maybe_negate: ConditionTransform) -> Query:
@@ -242,6 +299,7 @@ class NarrowBuilder:
             # Additionally, MIT users expect the empty instance and
             # instance "personal" to be the same.
             if base_topic in ('', 'personal', '(instance "")'):
+                self.note_shape('zephyr', 'personal')
                 cond = or_(
                     func.upper(column("subject")) == func.upper(literal("")),
                     func.upper(column("subject")) == func.upper(literal(".d")),
@@ -263,16 +321,17 @@ class NarrowBuilder:
                 # We limit `.d` counts, since postgres has much better
                 # query planning for this than they do for a regular
                 # expression (which would sometimes table scan).
+                self.note_shape('zephyr')
                 cond = or_(
-                    func.upper(column("subject")) == func.upper(literal(base_topic)),
-                    func.upper(column("subject")) == func.upper(literal(base_topic + ".d")),
-                    func.upper(column("subject")) == func.upper(literal(base_topic + ".d.d")),
-                    func.upper(column("subject")) == func.upper(literal(base_topic + ".d.d.d")),
-                    func.upper(column("subject")) == func.upper(literal(base_topic + ".d.d.d.d")),
+                    func.upper(column("subject")) == func.upper(self.bind(base_topic)),
+                    func.upper(column("subject")) == func.upper(self.bind(base_topic + ".d")),
+                    func.upper(column("subject")) == func.upper(self.bind(base_topic + ".d.d")),
+                    func.upper(column("subject")) == func.upper(self.bind(base_topic + ".d.d.d")),
+                    func.upper(column("subject")) == func.upper(self.bind(base_topic + ".d.d.d.d")),
                 )
             return query.where(maybe_negate(cond))
 
-        cond = func.upper(column("subject")) == func.upper(literal(operand))
+        cond = func.upper(column("subject")) == func.upper(self.bind(operand))
         return query.where(maybe_negate(cond))
 
     def by_sender(self, query: Query, operand: str, maybe_negate: ConditionTransform) -> Query:
@@ -281,14 +340,14 @@ class NarrowBuilder:
         except UserProfile.DoesNotExist:
             raise BadNarrowOperator('unknown user ' + operand)
 
-        cond = column("sender_id") == literal(sender.id)
+        cond = column("sender_id") == self.bind(sender.id)
         return query.where(maybe_negate(cond))
 
     def by_near(self, query: Query, operand: str, maybe_negate: ConditionTransform) -> Query:
         return query
 
     def by_id(self, query: Query, operand: str, maybe_negate: ConditionTransform) -> Query:
-        cond = self.msg_id_column == literal(operand)
+        cond = self.msg_id_column == self.bind(operand)
         return query.where(maybe_negate(cond))
 
     def by_pm_with(self, query: Query, operand: str, maybe_negate: ConditionTransform) -> Query:
@@ -301,15 +360,17 @@ class NarrowBuilder:
                                                  self.user_profile, self.user_profile)
             except ValidationError:
                 raise BadNarrowOperator('unknown recipient ' + operand)
-            cond = column("recipient_id") == recipient.id
+            self.note_shape('huddle')
+            cond = column("recipient_id") == self.bind(recipient.id)
             return query.where(maybe_negate(cond))
         else:
             # Personal message
             self_recipient = get_personal_recipient(self.user_profile.id)
             if operand == self.user_profile.email:
                 # Personals with self
-                cond = and_(column("sender_id") == self.user_profile.id,
-                            column("recipient_id") == self_recipient.id)
+                self.note_shape('self')
+                cond = and_(column("sender_id") == self.bind(self.user_profile.id),
+                            column("recipient_id") == self.bind(self_recipient.id))
                 return query.where(maybe_negate(cond))
 
             # Personals with other user; include both directions.
@@ -319,10 +380,11 @@ class NarrowBuilder:
                 raise BadNarrowOperator('unknown user ' + operand)
 
             narrow_recipient = get_personal_recipient(narrow_profile.id)
-            cond = or_(and_(column("sender_id") == narrow_profile.id,
-                            column("recipient_id") == self_recipient.id),
-                       and_(column("sender_id") == self.user_profile.id,
-                            column("recipient_id") == narrow_recipient.id))
+            self.note_shape('personal')
+            cond = or_(and_(column("sender_id") == self.bind(narrow_profile.id),
+                            column("recipient_id") == self.bind(self_recipient.id)),
+                       and_(column("sender_id") == self.bind(self.user_profile.id),
+                            column("recipient_id") == self.bind(narrow_recipient.id)))
             return query.where(maybe_negate(cond))
 
     def by_group_pm_with(self, query: Query, operand: str,
@@ -346,7 +408,9 @@ class NarrowBuilder:
             ).values("recipient_id")]
 
         recipient_ids = set(self_recipient_ids) & set(narrow_recipient_ids)
-        cond = column("recipient_id").in_(recipient_ids)
+        self.note_shape(len(recipient_ids))
+        cond = column("recipient_id").in_([self.bind(recipient_id)
+                                           for recipient_id in sorted(recipient_ids)])
         return query.where(maybe_negate(cond))
 
     def by_search(self, query: Query, operand: str, maybe_negate: ConditionTransform) -> Query:
@@ -359,17 +423,18 @@ class NarrowBuilder:
                             maybe_negate: ConditionTransform) -> Query:
         match_positions_character = func.pgroonga.match_positions_character
         query_extract_keywords = func.pgroonga.query_extract_keywords
-        keywords = query_extract_keywords(operand)
+        keywords = query_extract_keywords(self.bind(operand))
+        self.note_shape('pgroonga')
         query = query.column(match_positions_character(column("rendered_content"),
                                                        keywords).label("content_matches"))
         query = query.column(match_positions_character(column("subject"),
                                                        keywords).label("subject_matches"))
-        condition = column("search_pgroonga").op("@@")(operand)
+        condition = column("search_pgroonga").op("@@")(self.bind(operand))
         return query.where(maybe_negate(condition))
 
     def _by_search_tsearch(self, query: Query, operand: str,
                            maybe_negate: ConditionTransform) -> Query:
-        tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
+        tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), self.bind(operand))
         ts_locs_array = func.ts_match_locs_array
         query = query.column(ts_locs_array(literal("zulip.english_us_search"),
                                            column("rendered_content"),
@@ -383,10 +448,13 @@ class NarrowBuilder:
         # search here so we can ignore punctuation and do
         # stemming, but there isn't a standard phrase search
         # mechanism in Postgres
+        self.note_shape('tsearch')
         for term in re.findall('"[^"]+"|\S+', operand):
             if term[0] == '"' and term[-1] == '"':
+                self.note_shape('phrase')
                 term = term[1:-1]
                 term = '%' + connection.ops.prep_for_like_query(term) + '%'
+                term = self.bind(term)
                 cond = or_(column("content").ilike(term),
                            column("subject").ilike(term))
                 query = query.where(maybe_negate(cond))
@@ -558,67 +626,175 @@ def exclude_muting_conditions(user_profile: UserProfile,
 
     return conditions
 
-@has_request_variables
-def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
-                         anchor: int=REQ(converter=int),
-                         num_before: int=REQ(converter=to_non_negative_int),
-                         num_after: int=REQ(converter=to_non_negative_int),
-                         narrow: Optional[List[Dict[str, Any]]]=REQ('narrow', converter=narrow_parameter,
-                                                                    default=None),
-                         use_first_unread_anchor: bool=REQ(validator=check_bool, default=False),
-                         client_gravatar: bool=REQ(validator=check_bool, default=False),
-                         apply_markdown: bool=REQ(validator=check_bool, default=True)) -> HttpResponse:
-    include_history = ok_to_include_history(narrow, user_profile.realm)
+def get_messages_for_rows(rows: Sequence[Sequence[Any]], user_profile: UserProfile,
+                          is_search: bool, search_term: Dict[str, Any],
+                          apply_markdown: bool, client_gravatar: bool) -> List[Dict[str, Any]]:
+    # Each row of a get_messages query starts with the message ID and
+    # the user's flags for the message, which we attach to the message
+    # dicts (which we bulk-fetch from the cache) before returning them.
+    message_ids = []  # type: List[int]
+    user_message_flags = {}  # type: Dict[int, List[str]]
+    for row in rows:
+        message_id = row[0]
+        flags = row[1]
+        if flags is None:
+            # With include_history, the user may not have received
+            # the message at all.
+            user_message_flags[message_id] = ["read", "historical"]
+        else:
+            user_message_flags[message_id] = UserMessage.flags_list_for_flags(flags)
+        message_ids.append(message_id)
 
-    if include_history and not use_first_unread_anchor:
+    search_fields = dict()  # type: Dict[int, Dict[str, Text]]
+    if is_search:
+        for row in rows:
+            message_id = row[0]
+            (subject, rendered_content, content_matches, subject_matches) = row[-4:]
+
+            try:
+                search_fields[message_id] = get_search_fields(rendered_content, subject,
+                                                              content_matches, subject_matches)
+            except UnicodeDecodeError as err:  # nocoverage
+                # No coverage for this block since it should be
+                # impossible, and we plan to remove it once we've
+                # debugged the case that makes it happen.
+                raise Exception(str(err), message_id, search_term)
+
+    return messages_for_ids(
+        message_ids=message_ids,
+        user_message_flags=user_message_flags,
+        search_fields=search_fields,
+        apply_markdown=apply_markdown,
+        client_gravatar=client_gravatar,
+        allow_edit_history=user_profile.realm.allow_edit_history,
+    )
+
+# How many rows of a get_messages query we fetch from the database (and
+# encode) at a time when streaming the response.
+STREAM_MESSAGES_BATCH_SIZE = 1000
+
+def stream_messages_json(cursor: Any, message_list: List[Dict[str, Any]],
+                         user_profile: UserProfile, is_search: bool, search_term: Dict[str, Any],
+                         apply_markdown: bool, client_gravatar: bool) -> Iterator[bytes]:
+    '''
+    Generates the same JSON response as get_messages_backend, starting
+    with the first batch of messages (which the view fetched, so that
+    any error in the query is raised before we start the response),
+    and then fetching the remaining rows from the cursor (a server-side
+    one, so that they aren't all loaded at once) and encoding their
+    messages a batch at a time.  Our memory use thus doesn't depend on
+    how many messages were requested.
+
+    Django only closes the database connection once the response has
+    been sent, so we can keep using it here.  Should fetching a later
+    batch fail anyway, the response is cut short before its "result"
+    key, so clients can't mistake it for a successful one.
+    '''
+    num_messages = 0
+    try:
+        yield b'{"messages":['
+        while message_list:
+            encoded = b','.join(ujson.dumps(message).encode('utf-8') for message in message_list)
+            if num_messages > 0:
+                encoded = b',' + encoded
+            num_messages += len(message_list)
+            yield encoded
+
+            rows = cursor.fetchmany(STREAM_MESSAGES_BATCH_SIZE)
+            message_list = []
+            if rows:
+                message_list = get_messages_for_rows(rows, user_profile, is_search, search_term,
+                                                     apply_markdown, client_gravatar)
+    finally:
+        cursor.close()
+
+    statsd.incr('loaded_old_messages', num_messages)
+    yield b'],"result":"success","msg":""}\n'
+
+def get_base_query(user_profile: UserProfile, query_kind: str) -> Query:
+    if query_kind == 'history':
         # The initial query in this case doesn't use `zerver_usermessage`,
         # and isn't yet limited to messages the user is entitled to see!
         #
         # This is OK only because we've made sure this is a narrow that
         # will cause us to limit the query appropriately later.
         # See `ok_to_include_history` for details.
-        query = select([column("id").label("message_id")], None, table("zerver_message"))
-        inner_msg_id_col = literal_column("zerver_message.id")
-    elif narrow is None and not use_first_unread_anchor:
+        #
+        # We outer join with the user's UserMessage rows, so that we get
+        # their flags for the messages they did receive in the same query.
+        return select([literal_column("zerver_message.id").label("message_id"),
+                       literal_column("zerver_usermessage.flags").label("flags")],
+                      None,
+                      join(table("zerver_message"), table("zerver_usermessage"),
+                           and_(literal_column("zerver_usermessage.message_id") ==
+                                literal_column("zerver_message.id"),
+                                literal_column("zerver_usermessage.user_profile_id") ==
+                                bindparam('user_profile_id', user_profile.id)),
+                           isouter=True))
+    elif query_kind == 'usermessage':
         # This is limited to messages the user received, as recorded in `zerver_usermessage`.
-        query = select([column("message_id"), column("flags")],
-                       column("user_profile_id") == literal(user_profile.id),
-                       table("zerver_usermessage"))
-        inner_msg_id_col = column("message_id")
+        return select([column("message_id"), column("flags")],
+                      column("user_profile_id") == bindparam('user_profile_id', user_profile.id),
+                      table("zerver_usermessage"))
     else:
         # This is limited to messages the user received, as recorded in `zerver_usermessage`.
         # TODO: Don't do this join if we're not doing a search
-        query = select([column("message_id"), column("flags")],
-                       column("user_profile_id") == literal(user_profile.id),
-                       join(table("zerver_usermessage"), table("zerver_message"),
-                            literal_column("zerver_usermessage.message_id") ==
-                            literal_column("zerver_message.id")))
+        return select([column("message_id"), column("flags")],
+                      column("user_profile_id") == bindparam('user_profile_id', user_profile.id),
+                      join(table("zerver_usermessage"), table("zerver_message"),
+                           literal_column("zerver_usermessage.message_id") ==
+                           literal_column("zerver_message.id")))
+
+NarrowQuery = Tuple[Query, ColumnElement, bool, Dict[str, Any],
+                    Optional[Tuple[Any, ...]], Dict[str, Any]]
+
+def get_narrow_query(user_profile: UserProfile, narrow: Optional[List[Dict[str, Any]]],
+                     use_first_unread_anchor: bool, shape_only: bool=False) -> NarrowQuery:
+    '''
+    Builds the query for the messages in the narrow that the user can
+    see, before limiting it to a range of messages around the anchor.
+
+    Returns the query, its message ID column, whether it's a search
+    (and the combined search term), its shape (see NarrowBuilder), or
+    None if the query's shape isn't tracked, and the values of its
+    named parameters.  With shape_only, the query isn't built at all
+    (we return a ShapeOnlyQuery), since to fetch the messages, we only
+    need the shape and parameters of a query we've compiled before.
+    '''
+    include_history = ok_to_include_history(narrow, user_profile.realm)
+
+    if include_history and not use_first_unread_anchor:
+        query_kind = 'history'
+        inner_msg_id_col = literal_column("zerver_message.id")
+    elif narrow is None and not use_first_unread_anchor:
+        query_kind = 'usermessage'
+        inner_msg_id_col = column("message_id")
+    else:
+        query_kind = 'usermessage_join'
         inner_msg_id_col = column("message_id")
 
+    if shape_only:
+        query = ShapeOnlyQuery()
+    else:
+        query = get_base_query(user_profile, query_kind)
+
     first_visible_message_id = get_first_visible_message_id(user_profile.realm)
-    query = query.where(inner_msg_id_col >= first_visible_message_id)
+    query = query.where(inner_msg_id_col >= bindparam('first_visible_message_id',
+                                                      first_visible_message_id))
+    params = dict(user_profile_id=user_profile.id,
+                  first_visible_message_id=first_visible_message_id)
 
-    num_extra_messages = 1
     is_search = False
+    search_term = {}  # type: Dict[str, Any]
+    builder = NarrowBuilder(user_profile, inner_msg_id_col)
 
     if narrow is not None:
-        # Add some metadata to our logging data for narrows
-        verbose_operators = []
-        for term in narrow:
-            if term['operator'] == "is":
-                verbose_operators.append("is:" + term['operand'])
-            else:
-                verbose_operators.append(term['operator'])
-        request._log_data['extra'] = "[%s]" % (",".join(verbose_operators),)
-
         # Build the query for the narrow
-        num_extra_messages = 0
-        builder = NarrowBuilder(user_profile, inner_msg_id_col)
-        search_term = {}  # type: Dict[str, Any]
         for term in narrow:
             if term['operator'] == 'search':
                 if not is_search:
-                    search_term = term
+                    # A copy, since we add any other search terms to it.
+                    search_term = dict(term)
                     query = query.column(column("subject")).column(column("rendered_content"))
                     is_search = True
                 else:
@@ -629,6 +805,102 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         if is_search:
             query = builder.add_term(query, search_term)
 
+    params.update(builder.params)
+    if not builder.cacheable:
+        return (query, inner_msg_id_col, is_search, search_term, None, params)
+    shape = (query_kind, is_search, tuple(builder.shape))
+    return (query, inner_msg_id_col, is_search, search_term, shape, params)
+
+def get_range_shape(anchor: int, num_before: int, num_after: int) -> Tuple[bool, bool, bool]:
+    '''The part of the shape of a get_messages query that limit_query_to_range adds.'''
+    return (num_before != 0, num_after != 0, anchor == LARGER_THAN_MAX_MESSAGE_ID)
+
+def get_range_params(anchor: int, num_before: int, num_after: int) -> Dict[str, int]:
+    '''The values of the named parameters that limit_query_to_range adds.'''
+    params = {}  # type: Dict[str, int]
+    if num_before != 0:
+        params['num_before'] = num_before
+        params['before_anchor'] = anchor
+        if num_after != 0:
+            # Don't include the anchor in both the before query and the after query
+            params['before_anchor'] = anchor - 1
+    # There's no need for an after_query if we're targeting just the target message.
+    if num_after != 0 and anchor != LARGER_THAN_MAX_MESSAGE_ID:
+        params['num_after'] = num_after
+        params['anchor'] = anchor
+    if not params:
+        # We just fetch the anchor message.
+        params['anchor'] = anchor
+    return params
+
+def limit_query_to_range(query: Query, inner_msg_id_col: ColumnElement,
+                         anchor: int, num_before: int, num_after: int) -> Query:
+    '''
+    Limits a query from get_narrow_query to the `num_before` messages
+    before the anchor and the `num_after` messages from the anchor on,
+    in order of message ID.  Its shape depends on which of those are
+    nonzero, and whether the anchor is LARGER_THAN_MAX_MESSAGE_ID (see
+    get_range_shape); its parameters are those from get_range_params.
+    '''
+    params = get_range_params(anchor, num_before, num_after)
+    before_query = None
+    after_query = None
+    if 'num_before' in params:
+        before_anchor = bindparam('before_anchor', params['before_anchor'])
+        before_query = query.where(inner_msg_id_col <= before_anchor) \
+                            .order_by(inner_msg_id_col.desc()) \
+                            .limit(bindparam('num_before', num_before))
+    if 'num_after' in params:
+        after_query = query.where(inner_msg_id_col >= bindparam('anchor', anchor)) \
+                           .order_by(inner_msg_id_col.asc()) \
+                           .limit(bindparam('num_after', num_after))
+
+    if before_query is not None:
+        if after_query is not None:
+            query = union_all(before_query.self_group(), after_query.self_group())
+        else:
+            query = before_query
+    elif after_query is not None:
+        query = after_query
+    else:
+        # This can happen when a narrow is specified.
+        query = query.where(inner_msg_id_col == bindparam('anchor', anchor))
+
+    main_query = alias(query)
+    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+    # This is a hack to tag the query we use for testing
+    query = query.prefix_with("/* get_messages */")
+    return query
+
+@has_request_variables
+def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
+                         anchor: int=REQ(converter=int),
+                         num_before: int=REQ(converter=to_non_negative_int),
+                         num_after: int=REQ(converter=to_non_negative_int),
+                         narrow: Optional[List[Dict[str, Any]]]=REQ('narrow', converter=narrow_parameter,
+                                                                    default=None),
+                         use_first_unread_anchor: bool=REQ(validator=check_bool, default=False),
+                         client_gravatar: bool=REQ(validator=check_bool, default=False),
+                         apply_markdown: bool=REQ(validator=check_bool, default=True),
+                         stream_results: bool=REQ(validator=check_bool, default=False)) -> HttpResponse:
+    num_extra_messages = 1
+    if narrow is not None:
+        # Add some metadata to our logging data for narrows
+        verbose_operators = []
+        for term in narrow:
+            if term['operator'] == "is":
+                verbose_operators.append("is:" + term['operand'])
+            else:
+                verbose_operators.append(term['operator'])
+        request._log_data['extra'] = "[%s]" % (",".join(verbose_operators),)
+        num_extra_messages = 0
+
+    # We only need to build the query to find the first unread message,
+    # or if we haven't compiled one of its shape yet (see build_query).
+    shape_only = not use_first_unread_anchor
+    (query, inner_msg_id_col, is_search, search_term, shape, params) = get_narrow_query(
+        user_profile, narrow, use_first_unread_anchor, shape_only=shape_only)
+
     # We add 1 to the number of messages requested if no narrow was
     # specified to ensure that the resulting list always contains the
     # anchor message.  If a narrow was specified, the anchor message
@@ -670,90 +942,41 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         else:
             anchor = LARGER_THAN_MAX_MESSAGE_ID
 
-    before_query = None
-    after_query = None
-    if num_before != 0:
-        before_anchor = anchor
-        if num_after != 0:
-            # Don't include the anchor in both the before query and the after query
-            before_anchor = anchor - 1
-        before_query = query.where(inner_msg_id_col <= before_anchor) \
-                            .order_by(inner_msg_id_col.desc()).limit(num_before)
-    if num_after != 0:
-        after_query = query.where(inner_msg_id_col >= anchor) \
-                           .order_by(inner_msg_id_col.asc()).limit(num_after)
-
-    if anchor == LARGER_THAN_MAX_MESSAGE_ID:
-        # There's no need for an after_query if we're targeting just the target message.
-        after_query = None
-
-    if before_query is not None:
-        if after_query is not None:
-            query = union_all(before_query.self_group(), after_query.self_group())
-        else:
-            query = before_query
-    elif after_query is not None:
-        query = after_query
-    else:
-        # This can happen when a narrow is specified.
-        query = query.where(inner_msg_id_col == anchor)
-
-    main_query = alias(query)
-    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
-    # This is a hack to tag the query we use for testing
-    query = query.prefix_with("/* get_messages */")
-    query_result = list(sa_conn.execute(query).fetchall())
-
-    # The following is a little messy, but ensures that the code paths
-    # are similar regardless of the value of include_history.  The
-    # 'user_messages' dictionary maps each message to the user's
-    # UserMessage object for that message, which we will attach to the
-    # rendered message dict before returning it.  We attempt to
-    # bulk-fetch rendered message dicts from remote cache using the
-    # 'messages' list.
-    message_ids = []  # type: List[int]
-    user_message_flags = {}  # type: Dict[int, List[str]]
-    if include_history:
-        message_ids = [row[0] for row in query_result]
-
-        # TODO: This could be done with an outer join instead of two queries
-        um_rows = UserMessage.objects.filter(user_profile=user_profile,
-                                             message__id__in=message_ids)
-        user_message_flags = {um.message_id: um.flags_list() for um in um_rows}
-
-        for message_id in message_ids:
-            if message_id not in user_message_flags:
-                user_message_flags[message_id] = ["read", "historical"]
-    else:
-        for row in query_result:
-            message_id = row[0]
-            flags = row[1]
-            user_message_flags[message_id] = UserMessage.flags_list_for_flags(flags)
-            message_ids.append(message_id)
-
-    search_fields = dict()  # type: Dict[int, Dict[str, Text]]
-    if is_search:
-        for row in query_result:
-            message_id = row[0]
-            (subject, rendered_content, content_matches, subject_matches) = row[-4:]
-
-            try:
-                search_fields[message_id] = get_search_fields(rendered_content, subject,
-                                                              content_matches, subject_matches)
-            except UnicodeDecodeError as err:  # nocoverage
-                # No coverage for this block since it should be
-                # impossible, and we plan to remove it once we've
-                # debugged the case that makes it happen.
-                raise Exception(str(err), message_id, search_term)
-
-    message_list = messages_for_ids(
-        message_ids=message_ids,
-        user_message_flags=user_message_flags,
-        search_fields=search_fields,
-        apply_markdown=apply_markdown,
-        client_gravatar=client_gravatar,
-        allow_edit_history=user_profile.realm.allow_edit_history,
-    )
+    if shape is not None:
+        shape += get_range_shape(anchor, num_before, num_after)
+    params.update(get_range_params(anchor, num_before, num_after))
+
+    def build_query() -> Query:
+        narrow_query = query
+        msg_id_col = inner_msg_id_col
+        if shape_only:
+            (narrow_query, msg_id_col, _, _, _, _) = get_narrow_query(
+                user_profile, narrow, use_first_unread_anchor)
+        return limit_query_to_range(narrow_query, msg_id_col, anchor, num_before, num_after)
+
+    if stream_results:
+        # Fetch the rows through a server-side cursor (see
+        # stream_messages_json), but fetch and build the first batch of
+        # messages here, so that any error is raised before we've
+        # started sending the response.
+        compiled = get_query_template(sa_conn, shape, params, build_query)
+        cursor = connection.chunked_cursor()
+        try:
+            cursor.execute(str(compiled), compiled.construct_params(params))
+            rows = cursor.fetchmany(STREAM_MESSAGES_BATCH_SIZE)
+            message_list = get_messages_for_rows(rows, user_profile, is_search, search_term,
+                                                 apply_markdown, client_gravatar)
+        except Exception:
+            cursor.close()
+            raise
+        return StreamingHttpResponse(
+            stream_messages_json(cursor, message_list, user_profile, is_search, search_term,
+                                 apply_markdown, client_gravatar),
+            content_type='application/json')
+
+    query_result = list(execute_query_template(sa_conn, shape, params, build_query).fetchall())
+    message_list = get_messages_for_rows(query_result, user_profile, is_search, search_term,
+                                         apply_markdown, client_gravatar)
 
     statsd.incr('loaded_old_messages', len(message_list))
     ret = {'messages': message_list,
@@ -955,7 +1178,8 @@ def send_message_backend(request: HttpRequest, user_profile: UserProfile,
                          queue_id: Optional[Text]=REQ(default=None),
                          delivery_type: Optional[Text]=REQ('delivery_type', default='send_now'),
                          defer_until: Optional[Text]=REQ('deliver_at', default=None),
-                         tz_guess: Optional[Text]=REQ('tz_guess', default=None)) -> HttpResponse:
+                         tz_guess: Optional[Text]=REQ('tz_guess', default=None),
+                         defer_fanout: bool=REQ(validator=check_bool, default=False)) -> HttpResponse:
     client = request.client
     is_super_user = request.user.is_api_super_user
     if forged and not is_super_user:
@@ -1014,9 +1238,64 @@ def send_message_backend(request: HttpRequest, user_profile: UserProfile,
                              topic_name, message_content, forged=forged,
                              forged_timestamp = request.POST.get('time'),
                              forwarder_user_profile=user_profile, realm=realm,
-                             local_id=local_id, sender_queue_id=queue_id)
+                             local_id=local_id, sender_queue_id=queue_id,
+                             defer_fanout=defer_fanout)
     return json_success({"id": ret})
 
+MAX_BULK_SEND_MESSAGES = 100
+
+@has_request_variables
+def send_messages_backend(request: HttpRequest, user_profile: UserProfile,
+                          messages: List[Dict[str, Any]]=REQ(validator=check_list(check_dict([
+                              ('type', check_string),
+                              ('to', check_variable_type([check_string, check_list(check_string)])),
+                              ('content', check_string),
+                          ], optional_keys=[
+                              ('subject', check_string),
+                          ]))),
+                          defer_fanout: bool=REQ(validator=check_bool, default=False)) -> HttpResponse:
+    """Sends several messages with a single request, for the benefit of
+    bridges and importers.  Each message is validated separately, and
+    the response has a result for each, in order; the valid ones are
+    all sent together with one do_send_messages call."""
+    if len(messages) > MAX_BULK_SEND_MESSAGES:
+        return json_error(_("Cannot send more than %d messages at once") % (MAX_BULK_SEND_MESSAGES,))
+    if getattr(request, '_ratelimit_applied_limits', False) and len(messages) > 1:
+        # Charge for each message, as if they had been sent separately;
+        # the decorator has already charged for the first.
+        rate_limit_user(request, user_profile, domain='all', calls=len(messages) - 1)
+
+    results = []  # type: List[Dict[str, Any]]
+    checked_messages = []  # type: List[Dict[str, Any]]
+    for message_spec in messages:
+        try:
+            message_to = message_spec['to']
+            if isinstance(message_to, str):
+                try:
+                    message_to = extract_recipients(message_to)
+                except ValueError:
+                    raise JsonableError(_("Invalid recipients"))
+            topic_name = message_spec.get('subject')
+            if topic_name is not None:
+                topic_name = topic_name.strip()
+            addressee = Addressee.legacy_build(user_profile, message_spec['type'],
+                                               message_to, topic_name)
+            checked_message = check_message(user_profile, request.client, addressee,
+                                            message_spec['content'])
+            checked_messages.append(checked_message)
+            results.append(dict(result='success', message=checked_message))
+        except JsonableError as e:
+            results.append(e.to_json())
+
+    do_send_messages(checked_messages, defer_fanout=defer_fanout)
+    for result in results:
+        if result['result'] == 'success':
+            # For zephyr mirror messages that were already sent,
+            # check_message gives us the existing message's ID.
+            message = result.pop('message')['message']
+            result['id'] = message if isinstance(message, int) else message.id
+    return json_success({"messages": results})
+
 def fill_edit_history_entries(message_history: List[Dict[str, Any]], message: Message) -> None:
     """This fills out the message edit history entries from the database,
     which are designed to have the minimum data possible, to instead
@@ -25,7 +25,8 @@ from zerver.lib.push_notifications import handle_push_notification
 from zerver.lib.actions import do_send_confirmation_email, \
     do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
     internal_send_message, check_send_message, extract_recipients, \
-    render_incoming_message, do_update_embedded_data, do_mark_stream_messages_as_read
+    render_incoming_message, do_update_embedded_data, do_mark_stream_messages_as_read, \
+    do_fan_out_message
 from zerver.lib.url_preview import preview as url_preview
 from zerver.lib.digest import handle_digest_email
 from zerver.lib.send_email import send_future_email, send_email_from_dict, \
@@ -429,6 +430,13 @@ class MessageSenderWorker(QueueProcessingWorker):
         queue_json_publish(server_meta['return_queue'], result,
                            respond_send_message)
 
+@assign_queue('message_fanout')
+class MessageFanoutWorker(QueueProcessingWorker):
+    # Finishes sending messages sent with defer_fanout; this queue
+    # must have a single consumer, to preserve message ordering.
+    def consume(self, event: Mapping[str, Any]) -> None:
+        do_fan_out_message(event)
+
 @assign_queue('digest_emails')
 class DigestWorker(QueueProcessingWorker):
     # Who gets a digest is entirely determined by the enqueue_digest_emails
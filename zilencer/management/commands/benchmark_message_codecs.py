@@ -0,0 +1,62 @@
+import time
+from typing import Any
+
+from django.core.management.base import CommandParser
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.message import MESSAGE_DICT_CODECS, MessageDict, extract_message_dict
+from zerver.models import Message
+
+
+class Command(ZulipBaseCommand):
+    help = """Compare the codecs for message dicts in the to_dict cache (see
+MESSAGE_DICT_CODECS), on the most recent messages in the database."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--messages',
+                            dest='num_messages',
+                            type=int,
+                            default=1000,
+                            help="How many recent messages to encode.")
+        parser.add_argument('--rounds',
+                            dest='rounds',
+                            type=int,
+                            default=10,
+                            help="How many times to encode and decode each message.")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        message_ids = list(Message.objects.order_by('-id').values_list(
+            'id', flat=True)[:options['num_messages']])
+        if not message_ids:
+            print("No messages to benchmark with!")
+            return
+
+        message_dicts = [MessageDict.build_dict_from_raw_db_row(row)
+                         for row in MessageDict.get_raw_db_rows(message_ids)]
+        rounds = options['rounds']
+        num_operations = len(message_dicts) * rounds
+
+        print("%d messages, %d rounds" % (len(message_dicts), rounds))
+        print("%-12s %12s %12s %14s" % ("codec", "encode (us)", "decode (us)", "bytes/message"))
+        for (codec, (encoder, decoder)) in sorted(MESSAGE_DICT_CODECS.items()):
+            start = time.time()
+            for i in range(rounds):
+                encoded = [encoder(message_dict) for message_dict in message_dicts]
+            encode_time = time.time() - start
+
+            start = time.time()
+            for i in range(rounds):
+                for message_bytes in encoded:
+                    decoder(message_bytes)
+            decode_time = time.time() - start
+
+            # Make sure the codec round-trips, and that
+            # extract_message_dict recognizes its encodings.
+            for (message_dict, message_bytes) in zip(message_dicts, encoded):
+                assert extract_message_dict(message_bytes) == message_dict
+
+            print("%-12s %12.1f %12.1f %14.0f" % (
+                codec,
+                1000000 * encode_time / num_operations,
+                1000000 * decode_time / num_operations,
+                sum(len(message_bytes) for message_bytes in encoded) / len(encoded)))
@@ -0,0 +1,174 @@
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+from django.core.management.base import CommandError, CommandParser
+from django.db import connection, transaction
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
+from zerver.models import Recipient, UserMessage, UserProfile, get_display_recipient
+from zerver.views.messages import Query, get_narrow_query, limit_query_to_range
+
+# The narrows whose get_messages queries we check, in the search
+# syntax: each term is an operator, negated with a leading `-`.  Terms
+# have an operand only where the operand determines the shape of the
+# query (see NarrowBuilder); the others get theirs from the user's
+# recent messages (see get_sample_operands).
+NARROW_SHAPES = [
+    "",
+    "stream", "-stream", "stream topic", "stream -topic", "topic",
+    "sender", "-sender", "stream sender",
+    "pm-with", "is:private pm-with", "group-pm-with",
+    "is:private", "-is:private", "is:starred", "is:unread", "-is:unread",
+    "is:mentioned", "is:alerted", "stream is:starred", "stream is:unread",
+    "has:link", "has:image", "has:attachment", "stream has:link",
+    "in:home", "in:all",
+    "search", "stream search", "stream topic search", "is:private search",
+    "id", "near",
+]
+
+SEQ_SCAN_RE = re.compile(r'Seq Scan on zerver_usermessage\b')
+
+def get_sample_operands(user_profile: UserProfile, search: str) -> Dict[str, str]:
+    operands = dict(search=search)
+    user_messages = UserMessage.objects.filter(user_profile=user_profile).select_related(
+        'message', 'message__sender', 'message__recipient').order_by('-message_id')
+
+    stream_user_message = user_messages.filter(
+        message__recipient__type=Recipient.STREAM).first()
+    if stream_user_message is not None:
+        message = stream_user_message.message
+        operands['stream'] = get_display_recipient(message.recipient)
+        operands['topic'] = message.subject
+        operands['sender'] = message.sender.email
+        operands['id'] = operands['near'] = str(message.id)
+
+    personal_user_message = user_messages.filter(
+        message__recipient__type=Recipient.PERSONAL).exclude(message__sender=user_profile).first()
+    if personal_user_message is not None:
+        operands['pm-with'] = personal_user_message.message.sender.email
+    else:
+        operands['pm-with'] = user_profile.email
+
+    huddle_user_message = user_messages.filter(
+        message__recipient__type=Recipient.HUDDLE).exclude(message__sender=user_profile).first()
+    if huddle_user_message is not None:
+        operands['group-pm-with'] = huddle_user_message.message.sender.email
+
+    return operands
+
+def build_narrow(narrow_shape: str, operands: Dict[str, str]) -> Optional[List[Dict[str, Any]]]:
+    """Raises KeyError if there's no sample operand for one of the terms."""
+    narrow = []
+    for term in narrow_shape.split():
+        negated = term.startswith('-')
+        (operator, _, operand) = term.lstrip('-').partition(':')
+        if not operand:
+            operand = operands[operator]
+        narrow.append(dict(operator=operator, operand=operand, negated=negated))
+    if not narrow:
+        return None
+    return narrow
+
+def get_query_plan(query: Query, analyze: bool) -> List[str]:
+    compiled = query.compile(dialect=get_sqlalchemy_connection().dialect)
+    explain = "EXPLAIN ANALYZE " if analyze else "EXPLAIN "
+    with connection.cursor() as cursor:
+        cursor.execute(explain + str(compiled), compiled.params)
+        return [row[0] for row in cursor.fetchall()]
+
+class Command(ZulipBaseCommand):
+    help = """Run EXPLAIN on the get_messages query for each narrow shape in
+NARROW_SHAPES, as the given user, and fail if any of the query plans
+does a sequential scan on zerver_usermessage.
+
+Use this against a populated database to check changes to
+NarrowBuilder for query plan regressions.  With -v 2, prints the
+query plan for every narrow."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("email", metavar="<email>", type=str, help="Email address of the user")
+        parser.add_argument('--anchor',
+                            dest='anchor',
+                            type=int,
+                            help="The anchor message ID (default: the user's pointer).")
+        parser.add_argument('--num-before',
+                            dest='num_before',
+                            type=int,
+                            default=200,
+                            help="How many messages before the anchor to fetch.")
+        parser.add_argument('--num-after',
+                            dest='num_after',
+                            type=int,
+                            default=200,
+                            help="How many messages after the anchor to fetch.")
+        parser.add_argument('--search',
+                            dest='search',
+                            type=str,
+                            default="zulip",
+                            help="The operand for search terms.")
+        parser.add_argument('--analyze',
+                            dest='analyze',
+                            action="store_true",
+                            default=False,
+                            help="Run EXPLAIN ANALYZE, actually running each query.")
+        parser.add_argument('--disable-seqscan',
+                            dest='disable_seqscan',
+                            action="store_true",
+                            default=False,
+                            help="Set enable_seqscan = off, so that only plans which can't "
+                            "use an index are flagged.  Use this with small databases, "
+                            "where a sequential scan is often the cheapest plan.")
+        self.add_realm_args(parser)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        user_profile = self.get_user(options["email"], realm)
+        anchor = options['anchor']
+        if anchor is None:
+            anchor = user_profile.pointer
+        operands = get_sample_operands(user_profile, options['search'])
+
+        flagged = []  # type: List[str]
+        # EXPLAIN ANALYZE runs the queries, but never changes anything;
+        # the transaction is just for the `SET LOCAL`.
+        with transaction.atomic():
+            if options['disable_seqscan']:
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+
+            for narrow_shape in NARROW_SHAPES:
+                label = narrow_shape or "(no narrow)"
+                try:
+                    narrow = build_narrow(narrow_shape, operands)
+                except KeyError as e:
+                    print("%-32s skipped: no messages to take a %s operand from" % (label, e))
+                    continue
+
+                (query, inner_msg_id_col, is_search, search_term, shape, params) = get_narrow_query(
+                    user_profile, narrow, False)
+                query = limit_query_to_range(query, inner_msg_id_col, anchor,
+                                             options['num_before'], options['num_after'])
+
+                start = time.time()
+                plan = get_query_plan(query, options['analyze'])
+                elapsed = time.time() - start
+
+                seq_scans = [line for line in plan if SEQ_SCAN_RE.search(line)]
+                if seq_scans:
+                    flagged.append(label)
+                status = "SEQ SCAN" if seq_scans else "ok"
+                if options['analyze']:
+                    status += " (%.1f ms)" % (1000 * elapsed,)
+                print("%-32s %s" % (label, status))
+                verbose = options['verbosity'] >= 2
+                if verbose:
+                    print("    shape: %s" % (shape,))
+                if verbose or seq_scans:
+                    for line in plan:
+                        print("    " + line)
+
+        if flagged:
+            raise CommandError("Sequential scans on zerver_usermessage for: %s" % (
+                ", ".join(flagged),))
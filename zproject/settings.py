@@ -337,6 +337,24 @@ DEFAULT_SETTINGS.update({
     # Hostname used for Zulip's statsd logging integration.
     'STATSD_HOST': '',
 
+    # Number of Tornado processes to shard event queues across; users
+    # are assigned to a process by user ID.  Set this via
+    # `tornado_processes` in the `[application_server]` section of
+    # /etc/zulip/zulip.conf, which puppet also uses to configure nginx
+    # and supervisord for the shards.
+    'TORNADO_PROCESSES': int(config_file.get('application_server', 'tornado_processes'))
+    if config_file.has_option('application_server', 'tornado_processes') else 1,
+
+    # Optionally, how long (in milliseconds) Tornado should wait after
+    # an event arrives for a waiting get_events request before
+    # responding, to batch bursts of events, keyed by client name
+    # (e.g. {'website': 20}).  By default, responses are immediate.
+    'EVENT_QUEUE_COALESCING_WINDOW_MSECS': {},
+
+    # How message dicts are encoded in the to_dict cache in memcached;
+    # one of the MESSAGE_DICT_CODECS in zerver/lib/message.py.
+    'MESSAGE_DICT_CACHE_CODEC': 'zlib_json',
+
     # Configuration for JWT auth.
     'JWT_AUTH_KEYS': {},
 
@@ -511,6 +529,8 @@ ZILENCER_ENABLED = 'zilencer' in INSTALLED_APPS
 # We set it to None when running backend tests or populate_db.
 # We override the port number when running frontend tests.
 TORNADO_SERVER = 'http://127.0.0.1:9993'
+# With TORNADO_PROCESSES > 1, shard N listens on TORNADO_PORTS[N].
+TORNADO_PORTS = [9993 + shard for shard in range(TORNADO_PROCESSES)]
 RUNNING_INSIDE_TORNADO = False
 AUTORELOAD = DEBUG
 
@@ -1232,6 +1252,7 @@ ZULIP_PATHS = [
     ("MANAGEMENT_LOG_PATH", "/var/log/zulip/manage.log"),
     ("WORKER_LOG_PATH", "/var/log/zulip/workers.log"),
     ("JSON_PERSISTENT_QUEUE_FILENAME", "/home/zulip/tornado/event_queues.json"),
+    ("JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME", "/home/zulip/tornado/event_queues.journal"),
     ("EMAIL_LOG_PATH", "/var/log/zulip/send_email.log"),
     ("EMAIL_MIRROR_LOG_PATH", "/var/log/zulip/email_mirror.log"),
     ("EMAIL_DELIVERER_LOG_PATH", "/var/log/zulip/email-deliverer.log"),
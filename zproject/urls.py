@@ -159,6 +159,8 @@ v1_api_and_json_patterns = [
         {'GET': 'zerver.views.messages.json_fetch_raw_message',
          'PATCH': 'zerver.views.messages.update_message_backend',
          'DELETE': 'zerver.views.messages.delete_message_backend'}),
+    url(r'^messages/bulk$', rest_dispatch,
+        {'POST': 'zerver.views.messages.send_messages_backend'}),
     url(r'^messages/render$', rest_dispatch,
         {'POST': 'zerver.views.messages.render_message_backend'}),
     url(r'^messages/flags$', rest_dispatch,
@@ -323,6 +325,8 @@ v1_api_and_json_patterns = [
     url(r'^events$', rest_dispatch,
         {'GET': 'zerver.tornado.views.get_events_backend',
          'DELETE': 'zerver.tornado.views.cleanup_event_queue'}),
+    url(r'^tornado/stats$', rest_dispatch,
+        {'GET': 'zerver.views.events_register.get_tornado_stats_backend'}),
 
     # report -> zerver.views.report
     url(r'^report/error$', rest_dispatch,
@@ -572,6 +576,10 @@ for app_name in settings.EXTRA_INSTALLED_APPS:
 urls += [
     # Used internally for communication between Django and Tornado processes
     url(r'^notify_tornado$', zerver.tornado.views.notify, name='zerver.tornado.views.notify'),
+    url(r'^tornado_stats$', zerver.tornado.views.get_tornado_stats,
+        name='zerver.tornado.views.get_tornado_stats'),
+    url(r'^cleanup_event_queue$', zerver.tornado.views.cleanup_event_queue_internal,
+        name='zerver.tornado.views.cleanup_event_queue_internal'),
 ]
 
 # Python Social Auth